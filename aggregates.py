@@ -0,0 +1,64 @@
+from math import isfinite
+
+SECONDS_PER_DAY = 86400
+MOVING_AVERAGE_WINDOW = 7  # datapoints
+EWMA_ALPHA = 0.3
+summary_fields = ["n", "last_date", "sum_x", "sum_y", "sum_xx", "sum_xy", "min_y", "max_y", "ewma"]
+
+
+def empty_summary():
+    return dict(n=0, last_date=None, sum_x=0.0, sum_y=0.0, sum_xx=0.0, sum_xy=0.0, min_y=None, max_y=None, ewma=None)
+
+
+def update_summary(summary, date, value):
+    # O(1) update for a datapoint appended after summary["last_date"]
+    x = date / SECONDS_PER_DAY  # days keep the sums small enough for float precision
+    summary["n"] += 1
+    summary["last_date"] = date
+    summary["sum_x"] += x
+    summary["sum_y"] += value
+    summary["sum_xx"] += x * x
+    summary["sum_xy"] += x * value
+    summary["min_y"] = value if summary["min_y"] is None else min(summary["min_y"], value)
+    summary["max_y"] = value if summary["max_y"] is None else max(summary["max_y"], value)
+    summary["ewma"] = value if summary["ewma"] is None else EWMA_ALPHA * value + (1 - EWMA_ALPHA) * summary["ewma"]
+    return summary
+
+
+def summarize(stats, categories):
+    # one pass over rows of (date, <one column per category>) ordered by date
+    summaries = [empty_summary() for _ in categories]
+    for row in stats:
+        date = row[0]
+        for summary, value in zip(summaries, row[1:]):
+            update_summary(summary, date, value)
+    return dict(zip(categories, summaries))
+
+
+def trend(summary):
+    # least squares fit value = intercept + slope * day, None if there is no spread in time
+    n = summary["n"]
+    denominator = n * summary["sum_xx"] - summary["sum_x"] ** 2
+    if n < 2 or not isfinite(denominator) or denominator <= 0:
+        return None
+    slope = (n * summary["sum_xy"] - summary["sum_x"] * summary["sum_y"]) / denominator
+    intercept = (summary["sum_y"] - slope * summary["sum_x"]) / n
+    return slope, intercept
+
+
+def trend_line(summary, dates, round_to):
+    if not (fit := trend(summary)):
+        return []
+    slope, intercept = fit
+    return [round(intercept + slope * date / SECONDS_PER_DAY, round_to) for date in dates]
+
+
+def moving_average(datapoints, window, round_to):
+    averages = []
+    total = 0
+    for i, datapoint in enumerate(datapoints):
+        total += datapoint
+        if i >= window:
+            total -= datapoints[i - window]
+        averages.append(round(total / min(i + 1, window), round_to))
+    return averages
@@ -0,0 +1,102 @@
+import json
+
+from aggregates import SECONDS_PER_DAY, trend
+
+PACE_BUCKET = 0.05  # min/km, resolution of the stored pace distribution
+ROLLING_BEST_WEEKS = 4
+route_summary_fields = ["n", "best_time", "best_time_date", "best_pace", "best_speed", "sum_time", "sum_speed",
+                        "efficiency_n", "sum_efficiency", "best_efficiency", "sum_x", "sum_y", "sum_xx", "sum_xy",
+                        "pace_histogram"]
+
+
+def empty_route_summary():
+    summary = dict.fromkeys(route_summary_fields)
+    summary.update(n=0, sum_time=0, sum_speed=0.0, efficiency_n=0, sum_efficiency=0.0, sum_x=0.0, sum_y=0.0,
+                   sum_xx=0.0, sum_xy=0.0, pace_histogram={})
+    return summary
+
+
+def update_route_summary(summary, date, time, pace, speed, heart_rate):
+    # O(1) in the number of activities, independent of the order activities are added in
+    summary["n"] += 1
+    if summary["best_time"] is None or time < summary["best_time"]:
+        summary["best_time"], summary["best_time_date"] = time, date
+    summary["best_pace"] = pace if summary["best_pace"] is None else min(summary["best_pace"], pace)
+    summary["best_speed"] = speed if summary["best_speed"] is None else max(summary["best_speed"], speed)
+    summary["sum_time"] += time
+    summary["sum_speed"] += speed
+    if heart_rate:
+        efficiency = speed / heart_rate  # km/h per bpm
+        summary["efficiency_n"] += 1
+        summary["sum_efficiency"] += efficiency
+        best = summary["best_efficiency"]
+        summary["best_efficiency"] = efficiency if best is None else max(best, efficiency)
+    # progression, pace over days
+    x = date / SECONDS_PER_DAY
+    summary["sum_x"] += x
+    summary["sum_y"] += pace
+    summary["sum_xx"] += x * x
+    summary["sum_xy"] += x * pace
+    bucket = str(int(pace / PACE_BUCKET))
+    summary["pace_histogram"][bucket] = summary["pace_histogram"].get(bucket, 0) + 1
+    return summary
+
+
+def summarize_route(activities):
+    # activities are rows of (date, time, pace, speed, heart_rate)
+    summary = empty_route_summary()
+    for row in activities:
+        update_route_summary(summary, *row)
+    return summary
+
+
+def encode_route_summary(summary):
+    return [json.dumps(summary[f]) if f == "pace_histogram" else summary[f] for f in route_summary_fields]
+
+
+def decode_route_summary(row):
+    summary = dict(zip(route_summary_fields, row))
+    summary["pace_histogram"] = json.loads(summary["pace_histogram"])
+    return summary
+
+
+def pace_percentiles(summary, percentiles=(10, 50, 90)):
+    # read from the histogram, accurate to PACE_BUCKET
+    counts = sorted((int(b), c) for b, c in summary["pace_histogram"].items())
+    result = []
+    for p in percentiles:
+        rank, seen = p / 100 * summary["n"], 0
+        for bucket, count in counts:
+            seen += count
+            if seen >= rank:
+                result.append(round((bucket + 0.5) * PACE_BUCKET, 2))
+                break
+        else:
+            result.append(None)
+    return result
+
+
+def route_report(summary, rolling_best):
+    # summary and the (best pace, best speed, best time) of the last ROLLING_BEST_WEEKS as displayable values
+    n = summary["n"]
+    if n == 0:
+        return {}
+    fit = trend(summary)
+    return {
+        "activities": n,
+        "best_time": summary["best_time"],
+        "best_time_date": summary["best_time_date"],
+        "best_pace": summary["best_pace"],
+        "best_speed": summary["best_speed"],
+        "average_time": round(summary["sum_time"] / n),
+        "average_speed": round(summary["sum_speed"] / n, 2),
+        "pace_percentiles": dict(zip(("p10", "p50", "p90"), pace_percentiles(summary))),
+        "average_efficiency": round(summary["sum_efficiency"] / summary["efficiency_n"], 4)
+        if summary["efficiency_n"] else None,
+        "best_efficiency": round(summary["best_efficiency"], 4) if summary["best_efficiency"] else None,
+        "pace_trend_per_week": round(fit[0] * 7, 3) if fit else None,  # min/km, negative is getting faster
+        "rolling_weeks": ROLLING_BEST_WEEKS,
+        "rolling_best_pace": rolling_best[0],
+        "rolling_best_speed": rolling_best[1],
+        "rolling_best_time": rolling_best[2],
+    }
@@ -0,0 +1,475 @@
+from functools import wraps
+from hashlib import sha256
+from time import time
+
+from flask import Blueprint, jsonify, make_response, request, session
+
+from analytics import ROLLING_BEST_WEEKS, route_report
+from cache import view_cache
+from db import PAGE_SIZE, admit, categories, db_login, get_stats_series, get_data_version, get_stats_page, add_stats, \
+    add_stats_many, edit_stats, delete_stats, get_routes, get_route_details, get_route_summary, \
+    get_route_bests_since, add_route, add_routes_many, edit_route, delete_route, get_activities_page, add_activity, \
+    add_activities_many, edit_activity, delete_activity, get_route_geometry, get_routes_near, set_route_geometry, \
+    get_stats_by_period, get_activities_by_period
+from geo import ascent, path_length
+from downsample import lttb
+from periods import period_kinds, period_label, timezone
+from hashing import HashingBusy
+from utils import auth_user, parse_date, check_stats_values, check_route_values, check_activity_values, \
+    activity_metrics
+
+api = Blueprint("api", __name__, url_prefix="/api")
+default_points = 500
+max_points = 5000
+
+
+@api.route("/stats/<category>")
+def stats_series(category):
+    if auth_user not in session:
+        return jsonify(error="Not logged in"), 401
+    if category not in categories:
+        return jsonify(error="Unknown category"), 404
+    try:
+        start = _int64(request.args.get("from", 0))
+        end = _int64(request.args.get("to", 2**62))
+        points = int(request.args.get("points", default_points))
+    except (ValueError, OverflowError):
+        return jsonify(error="from, to and points must be integers"), 400
+    if not 0 < points <= max_points:
+        return jsonify(error=f"points must be between 1 and {max_points}"), 400
+
+    resolution, rows = get_stats_series(session[auth_user], category, start, end, points)
+    keep = lttb([r[0] for r in rows], [r[1] for r in rows], points)
+    rows = [rows[i] for i in keep]
+    round_to = 1
+    return jsonify(category=category, resolution=resolution,  # bucket width in seconds, 0 for raw datapoints
+                   dates=[r[0] for r in rows], date_labels=[parse_date(r[0]) for r in rows],
+                   datapoints=[round(r[1], round_to) for r in rows],
+                   min=[round(r[2], round_to) for r in rows], max=[round(r[3], round_to) for r in rows])
+
+
+@api.route("/cache")
+def cache_info():
+    if auth_user not in session:
+        return jsonify(error="Not logged in"), 401
+    return jsonify(view_cache.info())
+
+
+# v1, json api for sync clients, log in with /api/v1/login (or the /login form) to get a session cookie
+api_v1 = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+max_page_size = 1000
+max_batch_size = 10_000
+max_track_points = 100_000
+max_near_radius = 50_000  # meters
+stats_fields = ["date", "weight", "body_fat", "water", "muscles"]
+routes_fields = ["route_name", "distance", "height"]
+activities_fields = ["route_name", "date", "time", "pace", "speed", "heart_rate"]
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@api_v1.errorhandler(ApiError)
+def api_error(e):
+    return jsonify(error=str(e)), e.status
+
+
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if auth_user not in session:
+            raise ApiError("Not logged in", 401)
+        return view(session[auth_user], *args, **kwargs)
+    return wrapper
+
+
+def _etag(username, collections):
+    # version based, unchanged collections are answered with 304 without querying or serializing them
+    versions = "\0".join(f"{c}\0{get_data_version(username, c)}" for c in collections)
+    key = f"{username}\0{versions}\0{request.full_path}"
+    return sha256(key.encode()).hexdigest()[:32]
+
+
+def cached_collection(*collections):
+    # collections are all those the response is computed from
+    def decorator(view):
+        @wraps(view)
+        def wrapper(username, *args, **kwargs):
+            etag = _etag(username, collections)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(username, *args, **kwargs))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+def _json_body():
+    body = request.get_json(silent=True)
+    if body is None:
+        raise ApiError("Body must be json")
+    return body
+
+
+def _batch_body():
+    body = _json_body()
+    if not isinstance(body, list) or not 0 < len(body) <= max_batch_size:
+        raise ApiError(f"Body must be a list of 1 to {max_batch_size} entries")
+    return body
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _int64(value):
+    # sqlite integers are signed 64 bit, larger ones fail when they are bound
+    value = int(value)
+    if not -2**63 <= value < 2**63:
+        raise OverflowError(f"{value} does not fit 64 bits")
+    return value
+
+
+def _int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return _int64(value)
+    except (ValueError, OverflowError):
+        raise ApiError(f"{name} must be a 64 bit integer")
+
+
+def _limit():
+    limit = _int_arg("limit", PAGE_SIZE)
+    if not 0 < limit <= max_page_size:
+        raise ApiError(f"limit must be between 1 and {max_page_size}")
+    return limit
+
+
+def _parse_stats(entry, date=None):
+    if not isinstance(entry, dict):
+        raise ApiError("Entries must be objects")
+    ok, err = check_stats_values(*(_str(entry.get(f)) for f in stats_fields[1:]))
+    if not ok:
+        raise ApiError(err)
+    try:
+        date = _int64(date if date is not None else entry.get("date", time()))
+    except (TypeError, ValueError, OverflowError):
+        raise ApiError("date must be an epoch timestamp")
+    return (date, *(float(entry[f]) for f in stats_fields[1:]))
+
+
+def _parse_route(entry, route_name=None):
+    if not isinstance(entry, dict):
+        raise ApiError("Entries must be objects")
+    route_name = route_name or entry.get("route_name")
+    ok, err = check_route_values(route_name, _str(entry.get("distance")), _str(entry.get("height")))
+    if not ok:
+        raise ApiError(err)
+    return route_name, int(float(entry["distance"])), int(float(entry["height"]))
+
+
+def _parse_points(entry):
+    # [[lat, lon], ...] or [[lat, lon, ele], ...] -> [(lat, lon, ele)], ele is None where it is missing
+    points = entry.get("points") if isinstance(entry, dict) else None
+    if not isinstance(points, list) or not 2 <= len(points) <= max_track_points:
+        raise ApiError(f"points must be a list of 2 to {max_track_points} [lat, lon, ele] points")
+    try:
+        points = [(float(p[0]), float(p[1]), float(p[2]) if len(p) > 2 and p[2] is not None else None)
+                  for p in points]
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise ApiError("points must be [lat, lon, ele] lists of numbers")
+    if not all(-90 <= lat <= 90 and -180 <= lon <= 180 for lat, lon, _ in points):
+        raise ApiError("lat must be between -90 and 90, lon between -180 and 180")
+    return points
+
+
+def _parse_activity(username, entry, routes, route_name=None, date=None):
+    # routes caches route details while parsing a batch
+    if not isinstance(entry, dict):
+        raise ApiError("Entries must be objects")
+    route_name = route_name or entry.get("route_name")
+    if not isinstance(route_name, str):
+        raise ApiError("route_name is required and must be a string")
+    for field in ("time_min", "heart_rate"):
+        if entry.get(field) is None:
+            raise ApiError(f"{field} is required")
+    if "time_sec" in entry and entry["time_sec"] is None:
+        raise ApiError("time_sec must be a number, leave it out for 0")
+    time_min, time_sec = _str(entry.get("time_min")), _str(entry.get("time_sec", 0))
+    ok, err = check_activity_values(route_name, time_min, time_sec, _str(entry.get("heart_rate")))
+    if not ok:
+        raise ApiError(err)
+    if route_name not in routes:
+        routes[route_name] = get_route_details(username, route_name)
+    if routes[route_name] is None:
+        raise ApiError(f"Unknown route '{route_name}'", 404)
+    try:
+        date = _int64(date if date is not None else entry.get("date", time()))
+    except (TypeError, ValueError, OverflowError):
+        raise ApiError("date must be an epoch timestamp")
+    if int(time_min) * 60 + int(time_sec) <= 0:
+        raise ApiError("Time must be positive")
+    distance, height = routes[route_name]
+    if distance + 10 * height <= 0:  # routes stored before check_route_values required it
+        raise ApiError(f"Route '{route_name}' needs a positive distance")
+    total_time_sec, pace, speed = activity_metrics(int(time_min), int(time_sec), distance, height)
+    return route_name, date, total_time_sec, pace, speed, int(entry["heart_rate"])
+
+
+def _parse_batch(parse):
+    entries, errors = [], []
+    for i, entry in enumerate(_batch_body()):
+        try:
+            entries.append(parse(entry))
+        except ApiError as e:
+            errors.append({"index": i, "error": str(e)})
+    if errors:  # a batch is stored completely or not at all
+        return None, (jsonify(errors=errors), 400)
+    return entries, None
+
+
+@api_v1.route("/login", methods=["POST"])
+def login():
+    body = _json_body()
+    if not isinstance(body, dict):
+        raise ApiError("Body must be an object")
+    username, password = body.get("username"), body.get("password")
+    if not isinstance(username, (str, type(None))) or not isinstance(password, (str, type(None))):
+        raise ApiError("username and password must be strings")
+    try:
+        if username and password and admit(request.remote_addr, username) and db_login(username, password):
+            session[auth_user] = username
+            return jsonify(username=username)
+    except HashingBusy as e:
+        raise ApiError(str(e), 429)
+    raise ApiError("Username or Password wrong", 401)
+
+
+# stats
+@api_v1.route("/stats")
+@login_required
+@cached_collection("stats")
+def stats_list(username):
+    rows, next_after = get_stats_page(username, _int_arg("after"), _limit())
+    return jsonify(stats=[dict(zip(stats_fields, r)) for r in rows], next_after=next_after)
+
+
+def _period_args():
+    # (period, tz, start, end) of the period queries, ValueErrors become 400s
+    try:
+        tz = timezone(request.args.get("tz"))
+    except ValueError as e:
+        raise ApiError(str(e))
+    period = request.args.get("period", "week")
+    if period not in period_kinds:
+        raise ApiError(f"period must be one of {', '.join(period_kinds)}")
+    return period, tz, _int_arg("from"), _int_arg("to")
+
+
+def _periods_response(rows, period, tz, fields):
+    try:
+        rows = rows()
+    except ValueError as e:
+        raise ApiError(str(e))
+    return jsonify(period=period, timezone=str(tz),
+                   periods=[{"label": period_label(day, period), "start": start,
+                             **{f: round(v, 2) if isinstance(v, float) else v for f, v in zip(fields, values)}}
+                            for day, start, *values in rows])
+
+
+@api_v1.route("/stats/periods")
+@login_required
+@cached_collection("stats")
+def stats_periods(username):
+    period, tz, start, end = _period_args()
+    return _periods_response(lambda: get_stats_by_period(username, period, tz, start, end), period, tz,
+                             ["n", *stats_fields[1:]])
+
+
+@api_v1.route("/stats", methods=["POST"])
+@login_required
+def stats_add(username):
+    row = _parse_stats(_json_body())
+    if not add_stats(username, *row):
+        raise ApiError("Stats for this date exist already", 409)
+    return jsonify(dict(zip(stats_fields, row))), 201
+
+
+@api_v1.route("/stats/batch", methods=["POST"])
+@login_required
+def stats_add_batch(username):
+    rows, error = _parse_batch(_parse_stats)
+    if error:
+        return error
+    return jsonify(received=len(rows), inserted=add_stats_many(username, rows)), 201
+
+
+@api_v1.route("/stats/<int:date>", methods=["PUT"])
+@login_required
+def stats_edit(username, date):
+    row = _parse_stats(_json_body(), date)
+    if not edit_stats(username, *row):
+        raise ApiError("No stats for this date", 404)
+    return jsonify(dict(zip(stats_fields, row)))
+
+
+@api_v1.route("/stats/<int:date>", methods=["DELETE"])
+@login_required
+def stats_delete(username, date):
+    if not delete_stats(username, date):
+        raise ApiError("No stats for this date", 404)
+    return "", 204
+
+
+# routes
+@api_v1.route("/routes")
+@login_required
+@cached_collection("routes")
+def routes_list(username):
+    return jsonify(routes=[dict(zip(routes_fields, r)) for r in get_routes(username)])
+
+
+@api_v1.route("/routes", methods=["POST"])
+@login_required
+def routes_add(username):
+    row = _parse_route(_json_body())
+    if not add_route(username, *row):
+        raise ApiError("Route exists already", 409)
+    return jsonify(dict(zip(routes_fields, row))), 201
+
+
+@api_v1.route("/routes/batch", methods=["POST"])
+@login_required
+def routes_add_batch(username):
+    rows, error = _parse_batch(_parse_route)
+    if error:
+        return error
+    return jsonify(received=len(rows), inserted=add_routes_many(username, rows)), 201
+
+
+@api_v1.route("/routes/<route_name>/summary")
+@login_required
+def routes_summary(username, route_name):
+    if get_route_details(username, route_name) is None:
+        raise ApiError("Unknown route", 404)
+    since = int(time()) - ROLLING_BEST_WEEKS * 7 * 86400
+    return jsonify(route_report(get_route_summary(username, route_name),
+                                get_route_bests_since(username, route_name, since)))
+
+
+@api_v1.route("/routes/near")
+@login_required
+def routes_near(username):
+    try:
+        lat, lon = float(request.args["lat"]), float(request.args["lon"])
+        radius = float(request.args.get("radius", 500))
+    except (KeyError, ValueError):
+        raise ApiError("lat and lon are required, lat, lon and radius must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= max_near_radius):
+        raise ApiError(f"lat, lon out of range or radius not between 0 and {max_near_radius} m")
+    return jsonify(routes=[{"route_name": route_name, "distance": round(meters)}
+                           for route_name, meters in get_routes_near(username, lat, lon, radius)])
+
+
+@api_v1.route("/routes/<route_name>/geometry")
+@login_required
+def routes_geometry(username, route_name):
+    points = get_route_geometry(username, route_name)
+    if points is None:
+        raise ApiError("No geometry for this route", 404)
+    return jsonify(route_name=route_name, points=points)
+
+
+@api_v1.route("/routes/<route_name>/geometry", methods=["PUT"])
+@login_required
+def routes_set_geometry(username, route_name):
+    # stores the track of a route, distance and height of the route are measured on it
+    points = _parse_points(_json_body())
+    row = route_name, int(path_length(points)), int(ascent(points))
+    if not edit_route(username, *row):
+        raise ApiError("Unknown route", 404)
+    set_route_geometry(username, route_name, points)
+    return jsonify(dict(zip(routes_fields, row)))
+
+
+@api_v1.route("/routes/<route_name>", methods=["PUT"])
+@login_required
+def routes_edit(username, route_name):
+    row = _parse_route(_json_body(), route_name)
+    if not edit_route(username, *row):
+        raise ApiError("Unknown route", 404)
+    return jsonify(dict(zip(routes_fields, row)))
+
+
+@api_v1.route("/routes/<route_name>", methods=["DELETE"])
+@login_required
+def routes_delete(username, route_name):
+    if not delete_route(username, route_name):
+        raise ApiError("Unknown route", 404)
+    return "", 204
+
+
+# activities
+@api_v1.route("/activities")
+@login_required
+@cached_collection("activities")
+def activities_list(username):
+    after = _int_arg("after")
+    after = (after, request.args.get("after_route", "")) if after is not None else None
+    rows, next_after = get_activities_page(username, request.args.get("route", ""), after, _limit())
+    return jsonify(activities=[dict(zip(activities_fields, r)) for r in rows],
+                   next_after=next_after and {"after": next_after[0], "after_route": next_after[1]})
+
+
+@api_v1.route("/activities/periods")
+@login_required
+@cached_collection("activities", "routes")  # distances and heights are those of the routes
+def activities_periods(username):
+    period, tz, start, end = _period_args()
+    route_name = request.args.get("route", "")
+    return _periods_response(lambda: get_activities_by_period(username, period, tz, start, end, route_name), period,
+                             tz, ["n", "distance", "time", "height", "heart_rate"])
+
+
+@api_v1.route("/activities", methods=["POST"])
+@login_required
+def activities_add(username):
+    row = _parse_activity(username, _json_body(), {})
+    if not add_activity(username, *row):
+        raise ApiError("Activity for this route and date exists already", 409)
+    return jsonify(dict(zip(activities_fields, row))), 201
+
+
+@api_v1.route("/activities/batch", methods=["POST"])
+@login_required
+def activities_add_batch(username):
+    routes = {}
+    rows, error = _parse_batch(lambda entry: _parse_activity(username, entry, routes))
+    if error:
+        return error
+    return jsonify(received=len(rows), inserted=add_activities_many(username, rows)), 201
+
+
+@api_v1.route("/activities/<route_name>/<int:date>", methods=["PUT"])
+@login_required
+def activities_edit(username, route_name, date):
+    row = _parse_activity(username, _json_body(), {}, route_name, date)
+    if not edit_activity(username, *row):
+        raise ApiError("No activity for this route and date", 404)
+    return jsonify(dict(zip(activities_fields, row)))
+
+
+@api_v1.route("/activities/<route_name>/<int:date>", methods=["DELETE"])
+@login_required
+def activities_delete(username, route_name, date):
+    if not delete_activity(username, route_name, date):
+        raise ApiError("No activity for this route and date", 404)
+    return "", 204
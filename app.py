@@ -1,18 +1,68 @@
-from flask import Flask, redirect, render_template, request, session
-from secrets import token_bytes
-
+from flask import Flask, Response, jsonify, redirect, render_template, request, session, stream_with_context
+from hashlib import sha256
+from logging import getLogger
+from os import environ, getpid
+from time import monotonic, perf_counter, process_time, time
+from xml.etree.ElementTree import ParseError
+
+from aggregates import MOVING_AVERAGE_WINDOW, SECONDS_PER_DAY, moving_average, trend, trend_line
+from analytics import ROLLING_BEST_WEEKS, route_report
+from api import api, api_v1, default_points as chart_points
+from assets import init_app as init_assets
+from backup import last_backup, start_backup_thread
+from cache import VIEW_CACHE_SHARED, view_cache
+from charts import chart_formats, format_available as chart_available, renderers
 from db import category_info, categories, beautified_categories, category_to_beautified, default_category, \
-    db_init, db_login, db_register, delete_user, get_stats, add_stats, edit_stats, delete_stats, get_route_names, \
-    get_routes, add_route, edit_route, delete_route, get_activities, add_activity, edit_activity, delete_activity
+    admit, db_init, db_login, db_register, delete_user, get_stats_page, get_stats_series, get_stats_summary, \
+    add_stats, edit_stats, delete_stats, get_route_names, get_routes, get_route_details, get_route_summary, \
+    get_route_bests_since, get_data_version, add_route, edit_route, delete_route, get_activities_page, add_activity, \
+    edit_activity, delete_activity, set_route_geometry, check_health, get_stats_by_period, get_activities_by_period, \
+    channels, get_events
+from downsample import lttb
+from events import EVENTS_KEEPALIVE, EVENTS_MAX_AGE, EVENTS_MAX_STREAMS, sse
+from export import export_columns, export_formats, export_rows, format_available, serializers
+from geo import ascent, path_length
+from hashing import HashingBusy, load_secret_key
+from importer import import_file, import_kinds, read_gpx_track
+from metrics import gauges, init_app as init_metrics
+from periods import TIMEZONE, period_kinds, timezone
 from utils import check_stats_submission, parse_stats_submission, check_routes_submission, parse_route_submission, \
-    check_activity_submission, parse_activity_submission, beautify_stats, beautify_routes, beautify_activities, \
-    parse_stats_for_category, get_y_boarder, stats_headers, routes_headers, activities_headers, margin_per_category
+    check_activity_submission, parse_activity_submission, check_route_values, beautify_stats, beautify_routes, \
+    beautify_activities, beautify_page, parse_date, get_y_boarder, stats_headers, routes_headers, \
+    activities_headers, margin_per_category, auth_user, beautify_route_report, stats_periods_headers, \
+    activities_periods_headers, beautify_stats_periods, beautify_activities_periods
 
-app = Flask(__name__)
-app.secret_key = token_bytes(16)
-auth_user = "user"
+STARTUP_BUDGET_MS = float(environ.get("STARTUP_BUDGET_MS", 1000))  # cpu time of importing the app without migrations
 
-db_init()
+log = getLogger(__name__)
+app = Flask(__name__)
+app.secret_key = load_secret_key()
+app.register_blueprint(api)
+app.register_blueprint(api_v1)
+init_assets(app)  # registered first, so responses are compressed after every other after_request handler
+init_metrics(app)
+gauges["tracker_view_cache"] = lambda: {f'stat="{k}"': v for k, v in view_cache.info().items()}
+gauges["tracker_last_backup"] = lambda: {f'stat="{k}"': v for k, v in last_backup.items() if k != "file"}
+gauges["tracker_live_connections"] = lambda: {'stat="open"': channels.connections()}
+app.jinja_env.globals["live_updates"] = EVENTS_MAX_STREAMS > 0
+
+migrate_start, migrate_cpu = perf_counter(), process_time()  # cpu time so far is the import of the app
+migrations = db_init()
+startup = {"migrations": len(migrations), "migration_seconds": perf_counter() - migrate_start,
+           "cpu_seconds": migrate_cpu}
+gauges["tracker_startup"] = lambda: {f'stat="{k}"': v for k, v in startup.items()}
+if startup["cpu_seconds"] * 1000 > STARTUP_BUDGET_MS:
+    log.warning("startup took %.0f ms of cpu time, over the budget of %.0f ms", startup["cpu_seconds"] * 1000,
+                STARTUP_BUDGET_MS)
+if not environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):  # gunicorn starts it in the workers, see post_fork
+    start_backup_thread()
+
+
+def cached(collection, view, compute, *args):
+    # compute(username, *args) is only run if the collection changed since it was last cached
+    username = session[auth_user]
+    version = get_data_version(username, collection) if VIEW_CACHE_SHARED else None
+    return view_cache.get(username, collection, (view, *args), version, lambda: compute(username, *args))
 
 
 @app.route("/")
@@ -20,15 +70,28 @@ def index():
     return render_template("index.html")
 
 
+@app.route("/health")
+def health():
+    # for load balancers and the startup check of gunicorn.conf.py, needs no login
+    try:
+        status = check_health()
+    except Exception as e:
+        return jsonify(status="error", error=repr(e), pid=getpid()), 503
+    return jsonify(status="ok", pid=getpid(), **status)
+
+
 @app.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "GET":
         return render_template("register.html")
     username = request.form.get("username")
     password = request.form.get("password")
-    if username and password and db_register(username, password):
-        session[auth_user] = username
-        return redirect("/")
+    try:
+        if username and password and admit(request.remote_addr) and db_register(username, password):
+            session[auth_user] = username
+            return redirect("/")
+    except HashingBusy as e:
+        return render_template("register.html", error=str(e)), 429
     return render_template("register.html", error="Username already taken")
 
 
@@ -38,9 +101,12 @@ def login():
         return render_template("login.html")
     username = request.form.get("username")
     password = request.form.get("password")
-    if username and password and db_login(username, password):
-        session[auth_user] = username
-        return redirect("/")
+    try:
+        if username and password and admit(request.remote_addr, username) and db_login(username, password):
+            session[auth_user] = username
+            return redirect("/")
+    except HashingBusy as e:
+        return render_template("login.html", error=str(e)), 429
     return render_template("login.html", error="Username or Password wrong")
 
 
@@ -57,6 +123,7 @@ def delete_my_user():
     if request.method == "GET":
         return render_template("delete_user.html")
     delete_user(session[auth_user])
+    session.clear()
     return render_template("index.html")
 
 
@@ -70,19 +137,67 @@ def stats_overview(category):
     if category == "" or category not in categories:
         category = default_category
     category_label = category_to_beautified[category]
+    version = get_data_version(session[auth_user], "stats")  # before the data, live updates add what came after
+    return render_template("stats.html", category_info=category_info, selected_category=category, label=category_label,
+                           version=version, moving_average_window=MOVING_AVERAGE_WINDOW,
+                           seconds_per_day=SECONDS_PER_DAY, **stats_chart(session[auth_user], category))
+
 
-    stats = get_stats(session[auth_user], category)
+def stats_chart(username, category):
+    # everything the stats page and the chart images draw. long histories come from the rollups and are downsampled
+    # to chart_points like /api/stats. the moving average runs over the series read, weigh-ins or rollup buckets,
+    # before it is downsampled too. thinned pages reload on live updates, they cannot average the new rows themselves
+    resolution, series = get_stats_series(username, category, 0, 2**62, chart_points)
+    keep = lttb([row[0] for row in series], [row[1] for row in series], chart_points)
+    stats = [series[i] for i in keep]
     round_to = 1  # round all datapoints to 1 decimal
-    datapoints, date_labels = parse_stats_for_category(stats, round_to)
+    datapoints, date_labels = [round(row[1], round_to) for row in stats], [parse_date(row[0]) for row in stats]
 
+    moving_averages, trend_points, smoothed, trend_per_week = [], [], None, None
     if datapoints:
+        summary = get_stats_summary(username, category)
         margin = margin_per_category[category]
-        start_y, end_y = get_y_boarder(datapoints, margin)
+        start_y, end_y = get_y_boarder([round(summary["min_y"], round_to), round(summary["max_y"], round_to)], margin)
+        averages = moving_average([row[1] for row in series], MOVING_AVERAGE_WINDOW, round_to)
+        moving_averages = [averages[i] for i in keep]
+        trend_points = trend_line(summary, [row[0] for row in stats], round_to)
+        smoothed = round(summary["ewma"], round_to)
+        if fit := trend(summary):
+            trend_per_week = "%+.2f" % (fit[0] * 7)
     else:
         start_y, end_y = 0, 100
+    return dict(date_labels=date_labels, datapoints=datapoints, start_y=start_y, end_y=end_y,
+                moving_averages=moving_averages, trend_points=trend_points, smoothed=smoothed,
+                trend_per_week=trend_per_week, dates=[row[0] for row in stats],
+                thinned=resolution > 0 or len(keep) < len(series))
 
-    return render_template("stats.html", category_info=category_info, selected_category=category, label=category_label,
-                           date_labels=date_labels, datapoints=datapoints, start_y=start_y, end_y=end_y)
+
+@app.route("/stats/<category>.<chart_format>")
+def stats_chart_image(category, chart_format):
+    # rendered once per data version, repeat views are a version lookup and a cache hit or a 304
+    if auth_user not in session:
+        return redirect("/login")
+    if category not in categories or not chart_available(chart_format):
+        return "Unknown category or format", 404
+
+    username = session[auth_user]
+    version = get_data_version(username, "stats")
+    # per user like api._etag, every user's versions start at 1
+    etag = sha256(f"{username}\0stats\0{version}\0{request.path}".encode()).hexdigest()[:32]
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        def render():
+            chart = stats_chart(username, category)
+            series = [("data", chart["datapoints"]), ("Moving Average", chart["moving_averages"]),
+                      ("Trend", chart["trend_points"])]
+            return renderers[chart_format](category_to_beautified[category], chart["date_labels"], series,
+                                           chart["start_y"], chart["end_y"])
+        image = view_cache.get(username, "stats", ("chart", category, chart_format), version, render)
+        response = Response(image, mimetype=chart_formats[chart_format])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 @app.route("/stats/all")
@@ -90,10 +205,13 @@ def stats_show_all():
     if auth_user not in session:
         return redirect("/login")
 
-    stats = get_stats(session[auth_user])
-    beautified_stats = beautify_stats(stats)
+    after = request.args.get("after", type=int)
+    version = get_data_version(session[auth_user], "stats")
+    beautified_stats, next_after, last_date = cached(
+        "stats", "page", lambda username, a: beautify_page(beautify_stats, get_stats_page(username, a), 0), after)
     return render_template("all_stats.html", categories=beautified_categories, headers=stats_headers,
-                           stats=beautified_stats)
+                           stats=beautified_stats, first_page=after is None, next_after=next_after,
+                           version=version, last_date=last_date)
 
 
 @app.route("/stats/add", methods=["GET", "POST"])
@@ -109,7 +227,7 @@ def stats_add_entry():
         return render_template("add_stats.html", error=err)
 
     date, weight, body_fat, water, muscles = parse_stats_submission(request)
-    add_stats(session[auth_user], date, weight, body_fat, water, muscles)
+    add_stats(session[auth_user], date, weight, body_fat, water, muscles, wait=False)
     return redirect("/stats")
 
 
@@ -146,8 +264,7 @@ def routes_overview():
     if auth_user not in session:
         return redirect("/login")
 
-    routes = get_routes(session[auth_user])
-    routes = beautify_routes(routes)
+    routes = cached("routes", "all", lambda username: beautify_routes(get_routes(username)))
     return render_template("routes.html", headers=routes_headers, routes=routes)
 
 
@@ -159,15 +276,42 @@ def routes_add_entry():
     if request.method == "GET":
         return render_template("add_route.html")
 
-    ok, err = check_routes_submission(request)
+    track = request.files.get("track")
+    points = None
+    if track and track.filename:  # distance and ascent are measured on the recorded track
+        try:
+            points = read_gpx_track(track.stream)
+        except (ParseError, TypeError, ValueError):  # broken xml, a trkpt without lat or lon, bad numbers
+            points = []
+        if len(points) < 2:
+            return render_template("add_route.html", error="The track needs at least two points")
+        route_name, distance, height = request.form.get("route_name"), int(path_length(points)), int(ascent(points))
+        ok, err = check_route_values(route_name, str(distance), str(height))
+    else:
+        ok, err = check_routes_submission(request)
+        route_name, distance, height = parse_route_submission(request) if ok else (None, None, None)
     if not ok:
-        return render_template("add_routes.html", error=err)
+        return render_template("add_route.html", error=err)
 
-    route_name, distance, height = parse_route_submission(request)
-    add_route(session[auth_user], route_name, distance, height)
+    add_route(session[auth_user], route_name, distance, height, wait=False)
+    if points:
+        set_route_geometry(session[auth_user], route_name, points)
     return redirect("/routes")
 
 
+@app.route("/routes/<route_name>")
+def route_dashboard(route_name):
+    if auth_user not in session:
+        return redirect("/login")
+    if get_route_details(session[auth_user], route_name) is None:
+        return redirect("/routes")
+
+    since = int(time()) - ROLLING_BEST_WEEKS * 7 * 86400
+    report = route_report(get_route_summary(session[auth_user], route_name),
+                          get_route_bests_since(session[auth_user], route_name, since))
+    return render_template("route.html", route_name=route_name, report=beautify_route_report(report))
+
+
 # activities, TODO
 @app.route("/activities", defaults={"route": ""})
 @app.route("/activities/<route>")
@@ -182,12 +326,16 @@ def activities_overview(route):
     else:
         selected_route = route
 
-    activities = get_activities(session[auth_user], route)
-    activities = beautify_activities(activities)
-    route_names = get_route_names(session[auth_user])
-    route_names.insert(0, "All Routes")
-    return render_template("activities.html", selected_route=selected_route, route_names=route_names,
-                           headers=activities_headers, activities=activities)
+    after = request.args.get("after", type=int)
+    after = (after, request.args.get("after_route", "")) if after is not None else None
+    version = get_data_version(session[auth_user], "activities")
+    activities, next_after, last_date = cached(
+        "activities", "page",
+        lambda username, r, a: beautify_page(beautify_activities, get_activities_page(username, r, a), 1), route, after)
+    route_names = ["All Routes"] + cached("routes", "names", get_route_names)
+    return render_template("activities.html", selected_route=selected_route, route=route, route_names=route_names,
+                           headers=activities_headers, activities=activities, first_page=after is None,
+                           next_after=next_after, version=version, last_date=last_date)
 
 
 @app.route("/activities/add", methods=["GET", "POST"])
@@ -206,10 +354,147 @@ def activities_add_entry():
         return render_template("add_activity.html", error=err)
 
     date, route_name, time, pace, speed, heart_rate = parse_activity_submission(request, session[auth_user])
-    add_activity(session[auth_user], route_name, date, time, pace, speed, heart_rate)
+    add_activity(session[auth_user], route_name, date, time, pace, speed, heart_rate, wait=False)
     return redirect(f"/activities/{route_name}")
 
 
+# bulk import
+@app.route("/import", methods=["GET", "POST"])
+def import_entries():
+    if auth_user not in session:
+        return redirect("/login")
+
+    if request.method == "GET":
+        return render_template("import.html", kinds=import_kinds)
+
+    kind = request.form.get("kind")
+    files = [f for f in request.files.getlist("files") if f.filename]
+    if kind not in import_kinds or not files:
+        return render_template("import.html", kinds=import_kinds, error="Select what to import and at least one file")
+
+    report = None
+    for f in files:
+        report = import_file(session[auth_user], kind, f.filename, f.stream, report)
+    return render_template("import.html", kinds=import_kinds, report=report)
+
+
+# weekly, monthly ... totals
+@app.route("/periods")
+def periods_overview():
+    if auth_user not in session:
+        return redirect("/login")
+    period = request.args.get("period", "week")
+    tz_name = request.args.get("tz", TIMEZONE)
+    start, end = request.args.get("from", type=int), request.args.get("to", type=int)
+    try:
+        tz = timezone(tz_name)
+        stats = get_stats_by_period(session[auth_user], period, tz, start, end)
+        activities = get_activities_by_period(session[auth_user], period, tz, start, end)
+    except ValueError as e:
+        return render_template("periods.html", periods=period_kinds, period=period, tz=tz_name, error=str(e)), 400
+    return render_template("periods.html", periods=period_kinds, period=period, tz=tz_name,
+                           stats_headers=stats_periods_headers, stats=beautify_stats_periods(stats, period),
+                           activities_headers=activities_periods_headers,
+                           activities=beautify_activities_periods(activities, period))
+
+
+# export
+@app.route("/export")
+def export_overview():
+    if auth_user not in session:
+        return redirect("/login")
+    formats = [f for f in export_formats if format_available(f)]
+    return render_template("export.html", tables=export_columns.keys(), formats=formats)
+
+
+@app.route("/export/<table>.<export_format>")
+def export_entries(table, export_format):
+    if auth_user not in session:
+        return redirect("/login")
+    if table not in export_columns or not format_available(export_format):
+        return "Unknown table or format", 404
+    try:
+        start = request.args.get("from", 0, type=int)
+        end = request.args.get("to", 2**62, type=int)
+        rows = export_rows(session[auth_user], table, start, end, request.args.get("after"),
+                           request.args.get("after_route", ""))
+    except ValueError:
+        return "after must be a date for stats and activities", 400
+    # rows are streamed from the db cursor to the client, the full history is never held in memory
+    return Response(stream_with_context(serializers[export_format](table, rows)),
+                    mimetype=export_formats[export_format],
+                    headers={"Content-Disposition": f"attachment; filename={table}.{export_format}"})
+
+
+# live updates
+live_collections = ["stats", "activities"]
+
+
+def live_update(username, collection, version, rows):
+    # what an open page needs to show a write: the new rows formatted like its table, for stats also the chart
+    # points and the axes and trend from the summaries. the cost depends on the rows written, not on the history
+    if rows is None:
+        return {"version": version, "reload": True}
+    if collection == "activities":
+        return {"version": version, "rows": [{"route_name": row[0], "date": row[1], "cells": cells}
+                                             for row, cells in zip(rows, beautify_activities(rows))]}
+    update = {"version": version, "rows": [{"date": row[0], "label": cells[0], "cells": cells}
+                                           for row, cells in zip(rows, beautify_stats(rows))], "charts": {}}
+    for i, category in enumerate(categories, 1):
+        if not rows:
+            break
+        summary = get_stats_summary(username, category)
+        start_y, end_y = get_y_boarder([round(summary["min_y"], 1), round(summary["max_y"], 1)],
+                                       margin_per_category[category])
+        fit = trend(summary)
+        update["charts"][category] = {"points": [round(row[i], 1) for row in rows], "start_y": start_y,
+                                      "end_y": end_y, "smoothed": round(summary["ewma"], 1), "trend": fit,
+                                      "trend_per_week": "%+.2f" % (fit[0] * 7) if fit else None}
+    return update
+
+
+def live_stream(username, versions):
+    # versions: collection -> data version the page shows
+    with channels.subscribe(username) as subscription:
+        for collection, after in versions.items():  # written between rendering and connecting, or while offline
+            current = get_data_version(username, collection)
+            if current > after:
+                missed = get_events(username, collection, after)
+                for version, rows in missed if len(missed) == current - after else [(current, None)]:
+                    yield sse(collection, live_update(username, collection, version, rows))
+                versions[collection] = current
+        deadline = monotonic() + EVENTS_MAX_AGE
+        while (left := deadline - monotonic()) > 0:
+            event = subscription.get(min(EVENTS_KEEPALIVE, left))
+            if event is None:
+                yield ": keepalive\n\n"  # also finds out whether the page is still open
+                continue
+            collection, version, rows = event
+            if collection not in versions or version <= versions[collection]:
+                continue
+            if version > versions[collection] + 1:  # events were dropped, the page reloads
+                rows = None
+            versions[collection] = version
+            yield sse(collection, live_update(username, collection, version, rows))
+
+
+@app.route("/events")
+def live_events():
+    # server-sent events of the writes to the collections given as ?stats=<version>&activities=<version>
+    if auth_user not in session:
+        return redirect("/login")
+    versions = {c: request.args.get(c, type=int) for c in live_collections}
+    versions = {c: version for c, version in versions.items() if version is not None}
+    if not versions:
+        return "Name the collections to follow and their versions", 400
+    if channels.connections() >= EVENTS_MAX_STREAMS:
+        # every stream holds a thread of a gthread worker, the rest stays for requests. a page told that there is
+        # no content does not reconnect on its own, live.js tries again later and is sent what it missed
+        return "", 204
+    return Response(stream_with_context(live_stream(session[auth_user], versions)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 # debug
 if __name__ == "__main__":
     app.run("127.0.0.1", 8811)
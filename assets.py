@@ -0,0 +1,141 @@
+import gzip
+import zlib
+from argparse import ArgumentParser
+from hashlib import sha256
+from logging import getLogger
+from mimetypes import guess_type
+from os import environ, makedirs, path, walk
+from urllib.request import urlopen
+
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # assets are only precompressed with gzip without brotli
+
+COMPRESS_MIN_SIZE = int(environ.get("COMPRESS_MIN_SIZE", 1024))  # bytes, smaller responses are sent as they are
+COMPRESS_LEVEL = int(environ.get("COMPRESS_LEVEL", 6))            # gzip level of dynamic responses
+ASSET_MAX_AGE = 365 * 86400  # hashed asset urls never change their content
+compressible_types = {"text/html", "text/css", "text/csv", "text/plain", "application/json", "application/x-ndjson",
+                      "application/javascript", "text/javascript", "image/svg+xml"}
+CHART_JS_VERSION = "4.4.1"
+CHART_JS_URL = f"https://cdn.jsdelivr.net/npm/chart.js@{CHART_JS_VERSION}/dist/chart.umd.js"
+CHART_JS_FILE = "vendor/chart.umd.js"
+
+log = getLogger(__name__)
+
+# static file name -> (hashed name, mimetype, {encoding: bytes}), built once per process by init_app
+manifest = {}
+_by_hashed_name = {}
+
+
+def _encodings(data, mimetype):
+    # identity always, gzip and brotli where they are smaller
+    encoded = {"identity": data}
+    if mimetype not in compressible_types:
+        return encoded
+    candidates = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        candidates["br"] = brotli.compress(data, quality=11)
+    encoded.update((name, body) for name, body in candidates.items() if len(body) < len(data))
+    return encoded
+
+
+def build_manifest(static_folder):
+    manifest.clear()
+    _by_hashed_name.clear()
+    for directory, _, files in walk(static_folder):
+        for file in files:
+            name = path.relpath(path.join(directory, file), static_folder).replace(path.sep, "/")
+            with open(path.join(directory, file), "rb") as f:
+                data = f.read()
+            stem, extension = path.splitext(name)
+            hashed_name = f"{stem}.{sha256(data).hexdigest()[:12]}{extension}"
+            mimetype = guess_type(file)[0] or "application/octet-stream"
+            manifest[name] = (hashed_name, mimetype, _encodings(data, mimetype))
+            _by_hashed_name[hashed_name] = manifest[name]
+
+
+def asset(name, fallback=None):
+    # url of a static file that can be cached forever, fallback if the file is not there
+    if name not in manifest:
+        return fallback or f"/static/{name}"
+    return f"/assets/{manifest[name][0]}"
+
+
+def _accepted(encodings):
+    # best encoding of an asset the client accepts
+    accepted = request.accept_encodings
+    return next((e for e in ("br", "gzip") if e in encodings and accepted[e]), "identity")
+
+
+def _send_asset(hashed_name):
+    if hashed_name not in _by_hashed_name:
+        abort(404)
+    _, mimetype, encodings = _by_hashed_name[hashed_name]
+    encoding = _accepted(encodings)
+    response = Response(encodings[encoding], mimetype=mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def compress_response(response):
+    # gzips dynamic responses of text types from COMPRESS_MIN_SIZE bytes on, streamed responses are left alone
+    if response.direct_passthrough or response.is_streamed or response.status_code < 200 or \
+            response.status_code in (204, 304) or "Content-Encoding" in response.headers or \
+            response.mimetype not in compressible_types:
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if not request.accept_encodings["gzip"] or len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(zlib.compress(data, COMPRESS_LEVEL, wbits=31))  # wbits=31 writes the gzip format
+    response.headers["Content-Encoding"] = "gzip"
+    etag, weak = response.get_etag()
+    if etag and not weak:  # the bytes differ from the uncompressed response, so the tag only holds semantically
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    build_manifest(app.static_folder)
+    if CHART_JS_FILE not in manifest:
+        log.warning("static/%s is missing, the stats page loads chart.js from %s until `python assets.py vendor` "
+                    "saved it", CHART_JS_FILE, CHART_JS_URL)
+    app.jinja_env.globals["asset"] = asset
+    app.jinja_env.globals["chart_js"] = lambda: asset(CHART_JS_FILE, CHART_JS_URL)
+    app.add_url_rule("/assets/<path:hashed_name>", "asset", _send_asset)
+    app.after_request(compress_response)
+
+
+def vendor():
+    # downloads the pinned chart.js build into static/, run once when installing or upgrading
+    target = path.join(path.dirname(path.abspath(__file__)), "static", CHART_JS_FILE)
+    makedirs(path.dirname(target), exist_ok=True)
+    with urlopen(CHART_JS_URL, timeout=30) as response:
+        data = response.read()
+    with open(target, "wb") as f:
+        f.write(data)
+    return target, len(data)
+
+
+def main():
+    parser = ArgumentParser(description="static asset pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("vendor", help=f"download chart.js {CHART_JS_VERSION} into static/{CHART_JS_FILE}")
+    commands.add_parser("list", help="hashed names and encoded sizes of the static files")
+    args = parser.parse_args()
+    if args.command == "vendor":
+        print("saved %s, %d bytes" % vendor())
+    else:
+        build_manifest(path.join(path.dirname(path.abspath(__file__)), "static"))
+        for name, (hashed_name, _, encodings) in sorted(manifest.items()):
+            print(hashed_name, ", ".join(f"{e} {len(body)}" for e, body in encodings.items()))
+
+
+if __name__ == "__main__":
+    main()
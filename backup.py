@@ -0,0 +1,225 @@
+import gzip
+from argparse import ArgumentParser
+from datetime import datetime
+from fcntl import LOCK_EX, LOCK_NB, flock
+from hashlib import sha256
+from logging import getLogger
+from os import environ, listdir, makedirs, path, remove
+from shutil import copyfileobj, rmtree
+from sqlite3 import connect
+from tempfile import NamedTemporaryFile
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+import db
+from migrations import MIGRATION_LOCK
+
+BACKUP_DIR = environ.get("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(environ.get("BACKUP_INTERVAL", 0))  # seconds between backups, 0 disables the scheduler
+BACKUP_KEEP = int(environ.get("BACKUP_KEEP", 7))          # newest backups kept
+BACKUP_COMPRESS = environ.get("BACKUP_COMPRESS", "1") == "1"
+BACKUP_PAGES = 256    # pages copied per step, each step holds a read lock on the source
+BACKUP_PAUSE = 0.01   # seconds between steps, gives writers room during large backups
+BACKUP_PREFIX = "db-"
+
+log = getLogger(__name__)
+last_backup = {}  # instrumentation of the latest backup of this process
+
+
+def _sha256(file):
+    digest = sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_db_backup(f):
+    return f.endswith(".sqlite") or f.endswith(".sqlite.gz")
+
+
+def list_backups(directory=BACKUP_DIR):
+    # files, or directories holding DB and every shard when users are sharded
+    if not path.isdir(directory):
+        return []
+    return sorted(path.join(directory, f) for f in listdir(directory)
+                  if f.startswith(BACKUP_PREFIX) and (_is_db_backup(f) or path.isdir(path.join(directory, f))))
+
+
+def _files_of(backup):
+    if not path.isdir(backup):
+        return [backup]
+    return sorted(path.join(backup, f) for f in listdir(backup) if _is_db_backup(f))
+
+
+def verify(backup_file):
+    if path.isdir(backup_file):
+        files = _files_of(backup_file)
+        return bool(files) and all(map(verify, files))
+    checksum_file = backup_file + ".sha256"
+    if not path.exists(checksum_file):
+        return False
+    with open(checksum_file) as f:
+        return f.read().split()[0] == _sha256(backup_file)
+
+
+def _copy_online(source_file, target_file):
+    # sqlite online backup in small steps, the source stays usable by request handlers the whole time
+    steps = []
+    step_start = [perf_counter()]
+
+    def progress(status, remaining, total):
+        steps.append(perf_counter() - step_start[0])  # time of this step, locks are released between steps
+        sleep(BACKUP_PAUSE)
+        step_start[0] = perf_counter()
+
+    source, target = connect(source_file, isolation_level=None), connect(target_file)
+    try:
+        # an open read transaction pins a WAL snapshot, otherwise every concurrent write restarts the backup
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=BACKUP_PAGES, progress=progress)
+        source.execute("COMMIT")
+        ok = target.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    finally:
+        source.close()
+        target.close()
+    return steps, ok
+
+
+def _backup_file(source_file, backup_file, compress):
+    steps, ok = _copy_online(source_file, backup_file)
+    if not ok:
+        remove(backup_file)
+        raise RuntimeError(f"integrity check of {backup_file} failed")
+    if compress:
+        with open(backup_file, "rb") as f_in, gzip.open(backup_file + ".gz", "wb") as f_out:
+            copyfileobj(f_in, f_out)
+        remove(backup_file)
+        backup_file += ".gz"
+    with open(backup_file + ".sha256", "w") as f:
+        f.write(f"{_sha256(backup_file)}  {path.basename(backup_file)}\n")
+    return backup_file, steps
+
+
+def backup_once(directory=BACKUP_DIR, compress=BACKUP_COMPRESS, keep=BACKUP_KEEP):
+    makedirs(directory, exist_ok=True)
+    start = perf_counter()
+    backup_file = path.join(directory, f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    if db.SHARDS:  # every file is copied on its own, each is consistent but they are not one snapshot
+        makedirs(backup_file)
+        steps = []
+        for db_file in [db.DB, *db.shard_files()]:
+            steps += _backup_file(db_file, path.join(backup_file, path.basename(db_file)), compress)[1]
+    else:
+        backup_file, steps = _backup_file(db.DB, backup_file + ".sqlite", compress)
+
+    for old in list_backups(directory)[:-keep] if keep > 0 else []:
+        if path.isdir(old):
+            rmtree(old)
+            continue
+        remove(old)
+        if path.exists(old + ".sha256"):
+            remove(old + ".sha256")
+
+    last_backup.update(file=backup_file, seconds=perf_counter() - start, steps=len(steps),
+                       longest_step=max(steps, default=0), total_step_time=sum(steps),
+                       size=sum(map(path.getsize, _files_of(backup_file))))
+    log.info("backup %(file)s: %(size)d bytes in %(seconds).2fs, %(steps)d steps, longest step (lock held) "
+             "%(longest_step).4fs", last_backup)
+    return backup_file
+
+
+def _restore_file(backup_file, db_file):
+    source_file = backup_file
+    if backup_file.endswith(".gz"):
+        with gzip.open(backup_file, "rb") as f_in, NamedTemporaryFile(delete=False, suffix=".sqlite") as f_out:
+            copyfileobj(f_in, f_out)
+            source_file = f_out.name
+    try:
+        source, target = connect(source_file), connect(db_file)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+    finally:
+        if source_file != backup_file:
+            remove(source_file)
+
+
+def restore(backup_file, db_file=None):
+    # copies a verified backup over the live db with the backup api, so open connections see a consistent db
+    if not verify(backup_file):
+        raise RuntimeError(f"checksum of {backup_file} does not match")
+    if not path.isdir(backup_file):
+        _restore_file(backup_file, db_file or db.DB)
+        db.db_close()  # pooled connections may have cached the old schema
+        return
+
+    db.db_close()
+    makedirs(db.shard_dir(), exist_ok=True)
+    restored = set()
+    for f in _files_of(backup_file):
+        name = path.basename(f).removesuffix(".gz")
+        target = db.DB if name == path.basename(db.DB) else path.join(db.shard_dir(), name)
+        _restore_file(f, target)
+        restored.add(target)
+    for shard in db.shard_files():  # users registered after the backup are not in the restored user table
+        if shard not in restored:
+            for suffix in ("", "-wal", "-shm", MIGRATION_LOCK):
+                if path.exists(shard + suffix):
+                    remove(shard + suffix)
+    db.db_close()
+
+
+def _scheduler(stop, interval):
+    # with several gunicorn workers only the worker holding the lock file runs backups, the others keep trying,
+    # so a recycled worker's backups are taken over
+    lock_file = open(path.join(BACKUP_DIR, ".lock"), "w")
+    while True:
+        try:
+            flock(lock_file, LOCK_EX | LOCK_NB)
+            break
+        except OSError:
+            if stop.wait(interval):
+                lock_file.close()
+                return
+    while not stop.wait(interval):
+        try:
+            backup_once()
+        except Exception:
+            log.exception("scheduled backup failed")
+
+
+def start_backup_thread(interval=BACKUP_INTERVAL):
+    stop = Event()
+    if interval > 0:
+        makedirs(BACKUP_DIR, exist_ok=True)
+        Thread(target=_scheduler, args=(stop, interval), daemon=True, name="backup").start()
+    return stop
+
+
+def main():
+    parser = ArgumentParser(description="back up or restore the tracker db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backup")
+    commands.add_parser("list")
+    commands.add_parser("verify").add_argument("file")
+    commands.add_parser("restore").add_argument("file")
+    args = parser.parse_args()
+    if args.command == "backup":
+        print(backup_once(), last_backup)
+    elif args.command == "list":
+        for backup_file in list_backups():
+            print(backup_file, "ok" if verify(backup_file) else "CHECKSUM MISMATCH")
+    elif args.command == "verify":
+        ok = verify(args.file)
+        print("ok" if ok else "CHECKSUM MISMATCH")
+        raise SystemExit(0 if ok else 1)
+    else:
+        restore(args.file)
+
+
+if __name__ == "__main__":
+    main()
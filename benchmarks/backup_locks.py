@@ -0,0 +1,51 @@
+# runs an online backup while another thread keeps writing, reports backup steps and writer latency
+# usage: python benchmarks/backup_locks.py [rows]
+import sys
+from os import path
+from statistics import quantiles
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import backup  # noqa: E402
+import db  # noqa: E402
+
+
+def writer(stop, latencies):
+    date = 2_000_000_000
+    while not stop.is_set():
+        date += 1
+        start = perf_counter()
+        db.add_stats("writer", date, 80, 20, 55, 40)
+        latencies.append((perf_counter() - start) * 1000)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    directory = mkdtemp()
+    db.DB = path.join(directory, "bench.sqlite")
+    db.db_init()
+    db.add_user("bench", "", "")
+    db.add_user("writer", "", "")
+    for batch in range(0, n, 10_000):
+        db.add_stats_many("bench", [(1_000_000_000 + 600 * i, 80.1, 20.2, 55.3, 40.4)
+                                    for i in range(batch, min(batch + 10_000, n))])
+    print(f"db size {path.getsize(db.DB) / 1e6:.1f} MB")
+
+    stop, latencies = Event(), []
+    thread = Thread(target=writer, args=(stop, latencies))
+    thread.start()
+    backup_file = backup.backup_once(path.join(directory, "backups"))
+    stop.set()
+    thread.join()
+
+    info = backup.last_backup
+    print(f"backup {info['seconds']:.2f}s, {info['steps']} steps, longest step {info['longest_step'] * 1000:.2f}ms, "
+          f"verified {backup.verify(backup_file)}")
+    p50, p99 = (quantiles(latencies, n=100)[i] for i in (49, 98))
+    print(f"concurrent writes n={len(latencies)} p50={p50:.2f}ms p99={p99:.2f}ms max={max(latencies):.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# imports generated csv files of stats and activities, reports rows/sec and peak memory
+# usage: python benchmarks/bulk_import.py [rows]
+import sys
+from os import path
+from random import random
+from tempfile import mkdtemp
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import db  # noqa: E402
+from importer import import_file  # noqa: E402
+
+
+def write_csv(filename, header, rows):
+    with open(filename, "w") as f:
+        f.write(header + "\n")
+        for row in rows:
+            f.write(",".join(map(str, row)) + "\n")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    directory = mkdtemp()
+    db.DB = path.join(directory, "bench.sqlite")
+    db.db_init()
+    db.db_register("bench", "pw")
+
+    stats_file = path.join(directory, "stats.csv")
+    write_csv(stats_file, "date,weight,body_fat,water,muscles",
+              ((1_000_000_000 + 3600 * i, round(80 + random(), 1), 20.5, 55.1, 40.2) for i in range(n)))
+    activities_file = path.join(directory, "activities.csv")
+    write_csv(activities_file, "date,route_name,time_min,time_sec,heart_rate,distance,height",
+              ((1_000_000_000 + 3600 * i, f"route{i % 20}", 25 + i % 10, i % 60, 140 + i % 30, 5000 + 100 * (i % 20), 40)
+               for i in range(n)))
+
+    for kind, filename in (("stats", stats_file), ("activities", activities_file)):
+        with open(filename, "rb") as f:
+            print(f"{kind:10}", import_file("bench", kind, filename, f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# bytes on the wire and time until a page is received for a user with a long history, with and without gzip
+# usage: python benchmarks/compression.py [days] [mbit_per_second]
+import sys
+from os import chdir, path
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, path.join(root, "benchmarks"))
+
+import synthetic  # noqa: E402
+
+pages = ["/stats", "/stats/weight", "/stats/all", "/activities", "/routes", "/stats/weight.svg", "/api/v1/stats"]
+REPEAT = 20
+
+
+def fetch(client, url, encoding):
+    # median server time in ms and the response of a page
+    times = []
+    for _ in range(REPEAT):
+        start = perf_counter()
+        response = client.get(url, headers={"Accept-Encoding": encoding})
+        times.append((perf_counter() - start) * 1000)
+    assert response.status_code == 200, (url, response.status_code)
+    return median(times), response
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 3650
+    mbit = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    chdir(mkdtemp())
+    username = synthetic.seed("db.sqlite", users=1, days=days)[0]
+    from app import app
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": synthetic.PASSWORD})
+
+    def received(ms, size):  # server time plus transfer at the given bandwidth
+        return ms + size * 8 / (mbit * 1000)
+
+    print(f"{days} days of history, transfer at {mbit:g} Mbit/s")
+    print(f"{'page':20} {'identity':>10} {'gzip':>10} {'server ms':>16} {'received ms':>16}")
+    for url in pages:
+        plain_ms, plain = fetch(client, url, "identity")
+        gzip_ms, gzipped = fetch(client, url, "gzip, br")
+        print(f"{url:20} {len(plain.data):10} {len(gzipped.data):10} {plain_ms:7.2f} -> {gzip_ms:6.2f} "
+              f"{received(plain_ms, len(plain.data)):7.1f} -> {received(gzip_ms, len(gzipped.data)):6.1f}")
+
+    html = client.get("/stats/weight").get_data(as_text=True)
+    from assets import manifest
+    for name, (hashed_name, _, encodings) in sorted(manifest.items()):
+        state = "linked" if hashed_name in html else "not on /stats/weight"
+        print(f"static {name:14} {', '.join(f'{e} {len(body)}' for e, body in encodings.items())} ({state})")
+
+
+if __name__ == "__main__":
+    main()
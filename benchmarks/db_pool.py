@@ -0,0 +1,55 @@
+# compares a fresh sqlite3.connect() per query against the pooled connections in db.py
+# usage: python benchmarks/db_pool.py [n_queries]
+import sys
+from os import path, remove
+from sqlite3 import connect
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import db  # noqa: E402
+
+USERNAME = "bench"
+
+
+def seed(rows):
+    db.add_user(USERNAME, "", "")
+    with db.db_connection(USERNAME, name="seed") as con:
+        con.executemany("INSERT OR IGNORE INTO stats VALUES (?, ?, ?, ?, ?, ?)",
+                        [(USERNAME, 86400 * i, 80, 20, 55, 40) for i in range(rows)])
+
+
+def fresh_connection_query():
+    with connect(db.DB) as con:
+        return con.execute("SELECT date, weight FROM stats WHERE username = (?) ORDER BY date LIMIT 30",
+                           (USERNAME,)).fetchall()
+
+
+def pooled_query():
+    with db.db_connection(USERNAME, name="pooled_query") as con:
+        return con.execute("SELECT date, weight FROM stats WHERE username = (?) ORDER BY date LIMIT 30",
+                           (USERNAME,)).fetchall()
+
+
+def run(f, n):
+    start = perf_counter()
+    for _ in range(n):
+        f()
+    return (perf_counter() - start) / n * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    db.DB = path.join(mkdtemp(), "bench.sqlite")
+    db.db_init()
+    seed(1000)
+    fresh = run(fresh_connection_query, n)
+    pooled = run(pooled_query, n)
+    print(f"fresh connect: {fresh:8.1f} us/query")
+    print(f"pooled:        {pooled:8.1f} us/query ({fresh / pooled:.1f}x)")
+    db.db_close()
+    remove(db.DB)
+
+
+if __name__ == "__main__":
+    main()
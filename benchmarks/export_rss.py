@@ -0,0 +1,62 @@
+# peak memory of exporting a large history: naive (get_stats + serialize a list) vs streaming from the cursor
+# usage: python benchmarks/export_rss.py [rows]
+import csv
+import json
+import sys
+from os import devnull, path
+from resource import RUSAGE_SELF, getrusage
+from subprocess import run
+from tempfile import mkdtemp
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+import db  # noqa: E402
+
+
+def seed(n):
+    db.db_init()
+    db.add_user("bench", "", "")
+    for batch in range(0, n, 10_000):
+        db.add_stats_many("bench", [(1_000_000_000 + 600 * i, 80.1 + i % 10, 20.2, 55.3, 40.4)
+                                    for i in range(batch, min(batch + 10_000, n))])
+
+
+def export(mode, export_format):
+    from export import export_rows, serializers
+    start = perf_counter()
+    with open(devnull, "w") as out:
+        if mode == "naive":
+            if export_format == "ndjson":
+                columns = ["date", "weight", "body_fat", "water", "muscles"]
+                out.write("\n".join([json.dumps(dict(zip(columns, r))) for r in db.get_stats("bench")]))
+            else:
+                csv.writer(out).writerows(db.get_stats("bench"))
+        else:
+            for chunk in serializers[export_format]("stats", export_rows("bench", "stats")):
+                out.write(chunk)
+    peak_mb = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:9} {export_format:7} {perf_counter() - start:6.2f}s peak rss {peak_mb:7.1f} MB")
+
+
+def main():
+    # every step runs in its own process, linux keeps the peak rss of the parent across fork and exec
+    if len(sys.argv) > 2 and sys.argv[1] == "--seed":
+        db.DB = sys.argv[2]
+        seed(int(sys.argv[3]))
+        return
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        db.DB = sys.argv[2]
+        export(sys.argv[3], sys.argv[4])
+        return
+    n = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    db_file = path.join(mkdtemp(), "bench.sqlite")
+    run([sys.executable, __file__, "--seed", db_file, n], check=True)
+    print(f"{n} stats rows")
+    for export_format in ("csv", "ndjson"):
+        for mode in ("naive", "streaming"):
+            run([sys.executable, __file__, "--run", db_file, mode, export_format], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# formatting of 10k and 100k row tables and chart series, checked against the former per-row loops
+# usage: python benchmarks/formatting.py [rows...]
+import sys
+from datetime import datetime
+from os import path
+from random import Random
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import utils  # noqa: E402
+
+
+def legacy_date(epoch_time):
+    return datetime.fromtimestamp(epoch_time).strftime('%d-%m-%Y')
+
+
+def legacy_stats(stats):
+    return [(legacy_date(d), "%.1f" % round(w, 1) + " kg", "%.1f" % round(f, 1) + " %", "%.1f" % round(h, 1) + " %",
+             "%.1f" % round(m, 1) + " %") for d, w, f, h, m in stats]
+
+
+def legacy_activities(activities):
+    return [(r, legacy_date(d), utils.format_seconds(t), f"{p} min/km", "%.1f" % round(s, 1) + " km/h", f"{hr} bpm")
+            for r, d, t, p, s, hr in activities]
+
+
+def legacy_series(stats, round_to):
+    return [round(v, round_to) for _, v in stats], [legacy_date(d) for d, _ in stats]
+
+
+def timed(f, *args):
+    start = perf_counter()
+    result = f(*args)
+    return result, (perf_counter() - start) * 1000
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10_000, 100_000]
+    rnd = Random(0)
+    for n in sizes:
+        dates = [1_500_000_000 + 3600 * i + rnd.randrange(3600) for i in range(n)]
+        stats = [(d, rnd.uniform(60, 100), rnd.uniform(10, 30), rnd.uniform(50, 60), rnd.uniform(35, 45))
+                 for d in dates]
+        activities = [(f"route-{i % 7}", d, rnd.randrange(900, 4000), round(rnd.uniform(4, 7), 3),
+                       round(rnd.uniform(8, 15), 3), rnd.randrange(130, 175)) for i, d in enumerate(dates)]
+        series = [(d, w) for d, w, *_ in stats]
+        cases = [("beautify_stats", legacy_stats, utils.beautify_stats, (stats,)),
+                 ("beautify_activities", legacy_activities, utils.beautify_activities, (activities,)),
+                 ("parse_stats_for_category", legacy_series, utils.parse_stats_for_category, (series, 1))]
+        for name, legacy, current, args in cases:
+            utils._date_labels.clear()
+            expected, legacy_ms = timed(legacy, *args)
+            result, cold_ms = timed(current, *args)
+            _, warm_ms = timed(current, *args)
+            assert result == expected, f"{name} output differs"
+            print(f"{n:7} rows {name:26} loop {legacy_ms:8.1f}ms  columnar {cold_ms:8.1f}ms  "
+                  f"cached dates {warm_ms:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# a new stat shown on an open stats page: reloading the page vs the live update event, for short and long histories,
+# and the time until a write reaches many open pages of one user
+# usage: python benchmarks/live_updates.py [pages]
+import sys
+from os import chdir, path
+from statistics import median
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter, sleep
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, path.join(root, "benchmarks"))
+
+import db  # noqa: E402
+import synthetic  # noqa: E402
+from cache import view_cache  # noqa: E402
+from events import EVENTS_POLL, sse  # noqa: E402
+
+REPEAT = 20
+
+
+def page_vs_event(app_module, username, history_days):
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": username, "password": synthetic.PASSWORD})
+    reload_ms, reload_bytes, event_ms, event_bytes = [], 0, [], 0
+    for i in range(REPEAT):
+        date = synthetic.START + (history_days + i) * synthetic.DAY
+        db.add_stats(username, date, 80, 20, 55, 40)
+        start = perf_counter()
+        reload_bytes = len(client.get("/stats").data)
+        reload_ms.append((perf_counter() - start) * 1000)
+        version = db.get_data_version(username, "stats")
+        start = perf_counter()
+        update = app_module.live_update(username, "stats", version, [[date, 80, 20, 55, 40]])
+        event_bytes = len(sse("stats", update))
+        event_ms.append((perf_counter() - start) * 1000)
+    return {"reload_ms": round(median(reload_ms), 2), "reload_bytes": reload_bytes,
+            "event_ms": round(median(event_ms), 3), "event_bytes": event_bytes}
+
+
+def fan_out(username, pages):
+    # pages open subscriptions of one user, then one write, the time until each of them has the event
+    received, ready = [], []
+
+    def page():
+        with db.channels.subscribe(username) as subscription:
+            ready.append(True)
+            if subscription.get(10) is not None:
+                received.append(perf_counter())
+
+    threads = [Thread(target=page) for _ in range(pages)]
+    for thread in threads:
+        thread.start()
+    while len(ready) < pages:
+        sleep(0.01)
+    start = perf_counter()
+    db.add_stats(username, 2_000_000_000, 80, 20, 55, 40)
+    for thread in threads:
+        thread.join()
+    latencies = sorted((t - start) * 1000 for t in received)
+    return {"pages": pages, "received": len(received), "p50_ms": round(latencies[len(latencies) // 2], 1),
+            "max_ms": round(latencies[-1], 1)}
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    chdir(mkdtemp())
+    import app as app_module  # creates db.sqlite in the working directory
+    print(f"{'history':>8} {'reload ms':>10} {'reload bytes':>13} {'event ms':>9} {'event bytes':>12}")
+    for days in (365, 3650):
+        synthetic.seed(f"{days}.sqlite", 1, days)
+        view_cache.invalidate("user0", "stats")
+        result = page_vs_event(app_module, "user0", days)
+        print(f"{days:>7}d {result['reload_ms']:10} {result['reload_bytes']:13} {result['event_ms']:9} "
+              f"{result['event_bytes']:12}")
+    result = fan_out("user0", pages)
+    print(f"one write to {result['pages']} open pages: {result['received']} received, p50 {result['p50_ms']} ms, "
+          f"max {result['max_ms']} ms (polled every {EVENTS_POLL * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# measures dashboard latency while other clients hammer /login
+# usage: python benchmarks/login_storm.py [storm_threads] [seconds]
+import sys
+from os import chdir, path
+from statistics import quantiles
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+chdir(mkdtemp())  # app.py creates db.sqlite in the working directory
+from app import app  # noqa: E402
+
+
+def dashboard_latencies(seconds):
+    client = app.test_client()
+    client.post("/login", data={"username": "viewer", "password": "pw"})
+    latencies = []
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        start = perf_counter()
+        client.get("/stats")
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+
+def storm(stop, i):
+    client = app.test_client()
+    while not stop.is_set():
+        # unknown users still pass admission, wrong passwords for "viewer" go through pbkdf2
+        client.post("/login", data={"username": "viewer", "password": f"wrong{i}"},
+                    environ_base={"REMOTE_ADDR": f"10.0.0.{i}"})
+
+
+def report(name, latencies):
+    p50, p95, p99 = (quantiles(latencies, n=100)[i] for i in (49, 94, 98))
+    print(f"{name:12} n={len(latencies):6} p50={p50:7.2f}ms p95={p95:7.2f}ms p99={p99:7.2f}ms")
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    import db
+    db.LOGIN_ATTEMPTS = db.LOGIN_ATTEMPTS_PER_IP = 10**9  # measure the hash pool, not the rate limit
+    app.test_client().post("/register", data={"username": "viewer", "password": "pw"})
+    report("idle", dashboard_latencies(seconds))
+
+    stop = Event()
+    storm_threads = [Thread(target=storm, args=(stop, i), daemon=True) for i in range(threads)]
+    for t in storm_threads:
+        t.start()
+    report("login storm", dashboard_latencies(seconds))
+    stop.set()
+    for t in storm_threads:
+        t.join()
+
+
+if __name__ == "__main__":
+    main()
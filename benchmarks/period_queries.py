@@ -0,0 +1,88 @@
+# weekly and monthly totals of a multi-year history: range queries per calendar period vs reading everything and
+# grouping in python, both results are compared
+# usage: python benchmarks/period_queries.py [years] [timezone]
+import sys
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+from os import chdir, path
+from tempfile import mkdtemp
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, path.join(root, "benchmarks"))
+
+import db  # noqa: E402
+import synthetic  # noqa: E402
+from periods import period_bounds, timezone  # noqa: E402
+
+REPEAT = 20
+
+
+def full_scan_stats(username, period, tz, start, end):
+    # what a view had to do before: the whole history, grouped by local calendar period in python
+    bounds = period_bounds(period, tz, start, end)
+    first_days = [day for day, _, _ in bounds]
+    groups = defaultdict(list)
+    for date, *values in db.get_stats(username):
+        if start <= date < end:
+            local_day = datetime.fromtimestamp(date, tz).date()
+            groups[first_days[bisect_right(first_days, local_day) - 1]].append(values)
+    return [(day, lower, len(groups[day]), *(sum(v) / len(v) if v else None for v in zip(*groups[day])))
+            if groups[day] else (day, lower, 0, None, None, None, None) for day, lower, _ in bounds]
+
+
+def full_scan_activities(username, period, tz, start, end):
+    routes = {name: (distance, height) for name, distance, height in db.get_routes(username)}
+    bounds = period_bounds(period, tz, start, end)
+    first_days = [day for day, _, _ in bounds]
+    totals = {day: [0, 0, 0, 0, []] for day in first_days}
+    for route_name, date, time, _, _, heart_rate in db.get_activities(username, ""):
+        if start <= date < end:
+            local_day = datetime.fromtimestamp(date, tz).date()
+            t = totals[first_days[bisect_right(first_days, local_day) - 1]]
+            distance, height = routes[route_name]
+            t[0], t[1], t[2], t[3] = t[0] + 1, t[1] + distance, t[2] + time, t[3] + height
+            if heart_rate:
+                t[4].append(heart_rate)
+    return [(day, lower, *totals[day][:4], sum(totals[day][4]) / len(totals[day][4]) if totals[day][4] else None)
+            for day, lower, _ in bounds]
+
+
+def timed(f, *args):
+    start = perf_counter()
+    for _ in range(REPEAT):
+        result = f(*args)
+    return (perf_counter() - start) / REPEAT * 1000, result
+
+
+def same(a, b):
+    return len(a) == len(b) and all(
+        x == y or (isinstance(x, float) and isinstance(y, float) and abs(x - y) < 1e-6)
+        for row_a, row_b in zip(a, b) for x, y in zip(row_a, row_b))
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    tz = timezone(sys.argv[2] if len(sys.argv) > 2 else "Europe/Berlin")
+    chdir(mkdtemp())
+    username = synthetic.seed("db.sqlite", users=3, days=365 * years)[1]
+    end = synthetic.START + 365 * years * synthetic.DAY
+    last_year = end - 365 * synthetic.DAY
+    print(f"{years} years of history, {len(db.get_stats(username))} stats and "
+          f"{len(db.get_activities(username, ''))} activities, {tz}")
+    cases = [("stats", db.get_stats_by_period, full_scan_stats), ("activities", db.get_activities_by_period,
+                                                                  full_scan_activities)]
+    for name, query, scan in cases:
+        for period, start in (("week", synthetic.START), ("month", synthetic.START), ("day", last_year)):
+            query_ms, result = timed(query, username, period, tz, start, end)
+            scan_ms, expected = timed(scan, username, period, tz, start, end)
+            assert same(result, expected), f"{name} by {period} differs from the full scan"
+            span = "all years" if start == synthetic.START else "last year"
+            print(f"{name:10} by {period:5} {span:9} {len(result):5} periods: {query_ms:7.2f} ms sql, "
+                  f"{scan_ms:7.2f} ms full scan ({scan_ms / query_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
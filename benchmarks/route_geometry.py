@@ -0,0 +1,84 @@
+# stored route geometries: bytes per route, routes near a position and matching a gpx track against thousands of routes
+# usage: python benchmarks/route_geometry.py [routes] [points_per_route]
+import json
+import random
+import sys
+from math import cos, sin
+from os import path
+from statistics import quantiles
+from tempfile import mkdtemp
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import db  # noqa: E402
+from geo import encode_points, simplify  # noqa: E402
+
+CENTER = 52.52, 13.40
+AREA = 0.2  # degrees around CENTER the routes start in, about 20 km
+
+
+def track(rng, points):
+    # gps like random walk, about 3 m between points with some jitter and rolling elevation
+    lat, lon = CENTER[0] + rng.uniform(-AREA, AREA), CENTER[1] + rng.uniform(-AREA, AREA)
+    heading, ele, result = rng.uniform(0, 6.28), rng.uniform(30, 80), []
+    for _ in range(points):
+        heading += rng.gauss(0, 0.15)
+        lat += 0.000027 * cos(heading)
+        lon += 0.000044 * sin(heading)
+        ele += rng.gauss(0, 0.5)
+        result.append((lat + rng.gauss(0, 0.000005), lon + rng.gauss(0, 0.000005), round(ele, 1)))
+    return result
+
+
+def percentiles(samples):
+    p50, p95, p99 = (quantiles(samples, n=100)[i] for i in (49, 94, 98))
+    return f"p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms"
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(1)
+    db.DB = path.join(mkdtemp(), "bench.sqlite")
+    db.db_init()
+    db.add_user("runner", "", "")
+
+    tracks = [track(rng, points) for _ in range(n)]
+    start = perf_counter()
+    for i, t in enumerate(tracks):
+        db.add_route("runner", f"route{i}", 5000, 50)
+        db.set_route_geometry("runner", f"route{i}", t)
+    stored = perf_counter() - start
+    with db.db_connection("runner", name="main") as con:
+        blob_bytes, kept = con.execute("SELECT SUM(LENGTH(points)), SUM(n) FROM route_geometry").fetchone()
+    json_bytes = sum(len(json.dumps(t)) for t in tracks[:100]) / min(n, 100)
+    print(f"{n} routes of {points} points stored in {stored:.1f}s ({n / stored:.0f} routes/s)")
+    print(f"{blob_bytes / n:.0f} bytes per route ({kept / n:.0f} points after simplification), "
+          f"{json_bytes:.0f} bytes as json of all points, {len(encode_points(tracks[0])):.0f} bytes unsimplified")
+
+    near = []
+    for _ in range(200):
+        lat, lon = CENTER[0] + rng.uniform(-AREA, AREA), CENTER[1] + rng.uniform(-AREA, AREA)
+        start = perf_counter()
+        db.get_routes_near("runner", lat, lon, 500)
+        near.append((perf_counter() - start) * 1000)
+    print(f"routes within 500 m   {percentiles(near)}")
+
+    match, found = [], 0
+    for i in rng.sample(range(n), 100):
+        noisy = [(lat + rng.gauss(0, 0.00005), lon + rng.gauss(0, 0.00005), ele) for lat, lon, ele in tracks[i]]
+        start = perf_counter()
+        found += db.match_route("runner", noisy) == f"route{i}"
+        match.append((perf_counter() - start) * 1000)
+    print(f"match gpx track       {percentiles(match)}, {found} of 100 matched to their route")
+
+    start = perf_counter()
+    for t in tracks[:100]:
+        simplify(t)
+    print(f"simplify              {(perf_counter() - start) * 10:.2f}ms per track")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# throughput of the gunicorn profile (gunicorn.conf.py) with 1, 2, 4 ... workers up to the core count
+# usage: python benchmarks/scaling.py [--max-workers n] [--worker-class gthread|sync|gevent] [--seconds s]
+import json
+import sys
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+from os import chdir, path
+from tempfile import mkdtemp
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import suite  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def worker_counts(max_workers):
+    counts, n = [], 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    return counts + [max_workers]
+
+
+def main():
+    parser = ArgumentParser(description="gunicorn throughput by worker count")
+    parser.add_argument("--max-workers", type=int, default=cpu_count())
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--worker-threads", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=0, help="concurrent clients, default 4 per worker")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--mix", default="view=90,add=9,login=1")
+    args = parser.parse_args()
+
+    directory = mkdtemp()
+    chdir(directory)
+    names = synthetic.seed(path.join(directory, "db.sqlite"), args.users, 365)
+    mix = suite.parse_mix(args.mix)
+    results, baseline = [], None
+    for workers in worker_counts(args.max_workers):
+        process, port = suite.start_gunicorn(directory, workers, args.worker_threads, args.worker_class)
+        try:
+            report = suite.load(lambda: suite.http_requester(port), names, mix, args.clients or 4 * workers,
+                                args.seconds, 0)
+        finally:
+            process.terminate()
+            process.wait()
+        baseline = baseline or report["throughput"]
+        results.append({"workers": workers, "throughput": report["throughput"],
+                        "speedup": round(report["throughput"] / baseline, 2), "p99_ms": report["all"]["p99_ms"]})
+        print(f"{workers:3} workers {report['throughput']:9.1f} req/s  x{results[-1]['speedup']:<5} "
+              f"p99 {report['all']['p99_ms']} ms", file=sys.stderr)
+    print(json.dumps({"cores": cpu_count(), "worker_class": args.worker_class, "results": results}, indent=1))
+
+
+if __name__ == "__main__":
+    main()
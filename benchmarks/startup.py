@@ -0,0 +1,96 @@
+# cold start of the app: fresh processes importing app.py against a new db, an up to date db and a db from before
+# the strict tables (migrated on the first start), compared with STARTUP_BUDGET_MS
+# usage: python benchmarks/startup.py [users] [days] [--check]
+import json
+import sqlite3
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os import environ, path, remove
+from shutil import copyfile
+from statistics import median
+from tempfile import mkdtemp
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, path.join(root, "benchmarks"))
+
+import db  # noqa: E402
+import synthetic  # noqa: E402
+
+REPEAT = 5
+BUDGET_MS = float(environ.get("STARTUP_BUDGET_MS", 1000))
+PROBE = ("import json, time; start = time.perf_counter(); import app; "
+         "print(json.dumps({'wall_ms': (time.perf_counter() - start) * 1000, **app.startup}))")
+
+
+def downgrade(db_file):
+    # the tables as they were before versioning: NUM instead of REAL, no STRICT, rowid tables, user_version 0
+    con = sqlite3.connect(db_file, isolation_level=None)
+    con.execute("PRAGMA foreign_keys = OFF")
+    con.execute("BEGIN")
+    for table, (columns, _, _) in db._tables.items():
+        con.execute(f"ALTER TABLE {table} RENAME TO {table}_typed")
+        con.execute(f"CREATE TABLE {table} ({', '.join(c.replace(' REAL', ' NUM') for c in columns)})")
+        con.execute(f"INSERT INTO {table} SELECT * FROM {table}_typed")
+        con.execute(f"DROP TABLE {table}_typed")
+    con.execute("PRAGMA user_version = 0")
+    con.execute("COMMIT")
+    con.execute("VACUUM")
+    con.close()
+
+
+def start(directory):
+    # one fresh interpreter, as a gunicorn worker or a restarted server would be
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=directory, capture_output=True, text=True, check=True,
+                         env={**environ, "PYTHONPATH": root, "DB_SHARDS": "", "WRITE_BEHIND": "0"})
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = ArgumentParser(description="cold start time of the app")
+    parser.add_argument("users", type=int, nargs="?", default=20)
+    parser.add_argument("days", type=int, nargs="?", default=3650)
+    parser.add_argument("--check", action="store_true", help=f"exit 1 if a start is over {BUDGET_MS:.0f} ms of cpu")
+    args = parser.parse_args()
+
+    directory = mkdtemp()
+    db_file = path.join(directory, db.DB)  # before seed() points db.DB elsewhere
+    seeded = path.join(directory, "seeded.sqlite")
+    synthetic.seed(seeded, args.users, args.days)
+    downgrade(seeded)
+    results = {}
+
+    runs = []
+    for _ in range(REPEAT):
+        if path.exists(db_file):
+            remove(db_file)
+        runs.append(start(directory))
+    results["new db"] = runs
+
+    copyfile(seeded, db_file)
+    for suffix in ("-wal", "-shm"):
+        if path.exists(db_file + suffix):
+            remove(db_file + suffix)
+    results["legacy db"] = [start(directory)]
+    results["migrated db"] = [start(directory) for _ in range(REPEAT)]
+
+    over = []
+    report = {"budget_ms": BUDGET_MS, "users": args.users, "days": args.days}
+    for name, runs in results.items():
+        report[name] = {"wall_ms": round(median(r["wall_ms"] for r in runs), 1),
+                        "cpu_ms": round(median(r["cpu_seconds"] for r in runs) * 1000, 1),
+                        "migration_ms": round(median(r["migration_seconds"] for r in runs) * 1000, 1),
+                        "migrations": max(r["migrations"] for r in runs)}
+        print(f"{name:12} wall {report[name]['wall_ms']:8.1f} ms  cpu {report[name]['cpu_ms']:8.1f} ms  "
+              f"migration {report[name]['migration_ms']:8.1f} ms", file=sys.stderr)
+        if report[name]["cpu_ms"] > BUDGET_MS:
+            over.append(name)
+    print(json.dumps(report, indent=1))
+    if args.check and over:
+        print(f"over the startup budget of {BUDGET_MS:.0f} ms: {', '.join(over)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
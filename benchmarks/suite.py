@@ -0,0 +1,277 @@
+# reproducible benchmark suite: seeds a synthetic db, micro-benchmarks the formatting and db functions and drives the
+# app through the flask test client and a local gunicorn with a mix of page views, adds and logins.
+# results are written as json (throughput and p50/p95/p99 in ms) so runs of different commits can be compared.
+# usage: python benchmarks/suite.py [--users 20] [--days 730] [--target client,gunicorn] [--out results.json]
+#        python benchmarks/suite.py --compare before.json after.json
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from os import chdir, environ, path
+from platform import python_version
+from random import Random
+from socket import socket
+from statistics import quantiles
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import perf_counter, sleep, time
+from urllib.parse import urlencode
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+import synthetic  # noqa: E402
+
+stats_categories = ["weight", "body_fat", "water", "muscles"]
+
+
+def summarize(latencies, seconds):
+    # latencies in seconds -> count, ops/s and percentiles in ms
+    ms = sorted(x * 1000 for x in latencies)
+    p = quantiles(ms, n=100, method="inclusive") if len(ms) > 1 else ms * 99
+    return {"n": len(ms), "ops_per_sec": round(len(ms) / seconds, 2) if seconds else None,
+            "p50_ms": round(p[49], 3), "p95_ms": round(p[94], 3), "p99_ms": round(p[98], 3)}
+
+
+def micro(username, seconds):
+    import db
+    from utils import beautify_activities, beautify_stats, parse_stats_for_category
+
+    stats = db.get_stats(username)
+    weights = db.get_stats(username, "weight")
+    activities = db.get_activities(username, "")
+    route_name = db.get_route_names(username)[0]
+    cases = {
+        "beautify_stats": lambda: beautify_stats(stats),
+        "beautify_activities": lambda: beautify_activities(activities),
+        "parse_stats_for_category": lambda: parse_stats_for_category(weights, 1),
+        "db.get_stats": lambda: db.get_stats(username),
+        "db.get_stats[weight]": lambda: db.get_stats(username, "weight"),
+        "db.get_stats_page": lambda: db.get_stats_page(username),
+        "db.get_stats_summary": lambda: db.get_stats_summary(username, "weight"),
+        "db.get_routes": lambda: db.get_routes(username),
+        "db.get_route_names": lambda: db.get_route_names(username),
+        "db.get_activities": lambda: db.get_activities(username, ""),
+        "db.get_activities_page": lambda: db.get_activities_page(username, ""),
+        "db.get_route_summary": lambda: db.get_route_summary(username, route_name),
+    }
+    results = {"rows": {"stats": len(stats), "activities": len(activities)}}
+    for name, case in cases.items():
+        case()  # warm the connection pool and statement cache
+        latencies = []
+        end = perf_counter() + seconds
+        while perf_counter() < end or len(latencies) < 5:
+            start = perf_counter()
+            case()
+            latencies.append(perf_counter() - start)
+        results[name] = summarize(latencies, sum(latencies))
+        print(f"{name:26} {results[name]}", file=sys.stderr)
+    return results
+
+
+def test_client_requester():
+    from app import app
+    client = app.test_client()
+    return lambda method, url, form=None: client.open(url, method=method, data=form).status_code
+
+
+def http_requester(port):
+    cookie = {}
+
+    def request(method, url, form=None):
+        # gunicorn's sync workers close every connection, so there is no keep-alive to reuse
+        con = HTTPConnection("127.0.0.1", port, timeout=60)
+        headers = {"Cookie": cookie["session"]} if cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        con.request(method, url, body, headers)
+        response = con.getresponse()
+        response.read()
+        if set_cookie := response.getheader("Set-Cookie"):
+            cookie["session"] = set_cookie.split(";", 1)[0]
+        con.close()
+        return response.status
+
+    return request
+
+
+def pick_request(rnd, op, route_names):
+    # -> (method, url, form) of one operation of the mix
+    if op == "view":
+        route_name = rnd.choice(route_names)
+        return "GET", rnd.choice(["/stats", f"/stats/{rnd.choice(stats_categories)}", "/stats/all", "/routes",
+                                  "/activities", f"/activities/{route_name}", f"/routes/{route_name}"]), None
+    if op == "add":
+        if rnd.random() < 0.5:
+            return "POST", "/stats/add", {"weight": round(rnd.uniform(60, 100), 1), "body_fat": 20, "water": 55,
+                                          "muscles": 40}
+        return "POST", "/activities/add", {"route_name": rnd.choice(route_names), "time_min": rnd.randrange(20, 60),
+                                           "time_sec": rnd.randrange(60), "heart_rate": rnd.randrange(130, 175)}
+    return "POST", "/login", {"username": "", "password": synthetic.PASSWORD}  # username is filled in by drive
+
+
+def drive(request, username, route_names, mix, stop, results, errors, random_seed):
+    rnd = Random(random_seed)
+    ops, weights = zip(*mix.items())
+    request("POST", "/login", {"username": username, "password": synthetic.PASSWORD})
+    while not stop.is_set():
+        op = rnd.choices(ops, weights)[0]
+        method, url, form = pick_request(rnd, op, route_names)
+        if op == "login":
+            form["username"] = username
+        start = perf_counter()
+        status = request(method, url, form)
+        results[op].append(perf_counter() - start)
+        if status >= 400:
+            errors[op] += 1
+
+
+def load(requester_factory, names, mix, threads, seconds, random_seed):
+    import db
+    route_names = {name: db.get_route_names(name) for name in names}
+    stop = Event()
+    results = {op: [] for op in mix}
+    errors = {op: 0 for op in mix}
+    workers = []
+    for i in range(threads):
+        username = names[i % len(names)]
+        workers.append(Thread(target=drive, args=(requester_factory(), username, route_names[username], mix, stop,
+                                                  results, errors, random_seed + i)))
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - start
+    report = {"threads": threads, "seconds": round(elapsed, 2),
+              "throughput": round(sum(map(len, results.values())) / elapsed, 2),
+              "all": summarize([x for latencies in results.values() for x in latencies], elapsed)}
+    for op, latencies in results.items():
+        if latencies:
+            report[op] = summarize(latencies, elapsed) | {"errors": errors[op]}
+    print(json.dumps(report), file=sys.stderr)
+    return report
+
+
+def free_port():
+    with socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(directory, workers, threads, worker_class="gthread"):
+    # the production profile of gunicorn.conf.py, sized by its environment variables
+    port = free_port()
+    env = environ | {"PYTHONPATH": root, "LOGIN_ATTEMPTS_PER_MINUTE": str(10**9), "LOGIN_ATTEMPTS_PER_IP": str(10**9),
+                     "VIEW_CACHE_SHARED": "1", "BIND": f"127.0.0.1:{port}", "WEB_CONCURRENCY": str(workers),
+                     "WORKER_THREADS": str(threads), "WORKER_CLASS": worker_class}
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", path.join(root, "gunicorn.conf.py"),
+                                "--log-level", "warning", "app:app"], cwd=directory, env=env)
+    request = http_requester(port)
+    for _ in range(100):
+        try:
+            request("GET", "/")
+            return process, port
+        except OSError:
+            sleep(0.1)
+    process.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, weight = part.split("=")
+        if op not in ("view", "add", "login"):
+            raise ValueError(f"unknown operation {op}")
+        mix[op] = float(weight)
+    return mix
+
+
+def compare(before_file, after_file):
+    # prints p50 and throughput changes of every result both runs have
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print(f"{before['commit']} -> {after['commit']}")
+    for section in ("micro", "load"):
+        for name, result in after.get(section, {}).items():
+            old = before.get(section, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(old, dict):
+                continue
+            rows = result.items() if section == "load" else [("", result)]
+            for op, values in rows:
+                previous = old.get(op) if section == "load" else old
+                if not isinstance(values, dict) or not isinstance(previous, dict) or not previous.get("p50_ms"):
+                    continue
+                change = values["p50_ms"] / previous["p50_ms"] - 1
+                print(f"{section:6} {name:26} {op:6} p50 {previous['p50_ms']:9.3f} -> {values['p50_ms']:9.3f} ms "
+                      f"({change:+.1%})")
+
+
+def main():
+    parser = ArgumentParser(description="tracker benchmark suite")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--days", type=int, default=730, help="days of history per user")
+    parser.add_argument("--routes", type=int, default=6, help="max routes per user")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data and the request mix")
+    parser.add_argument("--micro-seconds", type=float, default=1, help="time spent on each micro-benchmark")
+    parser.add_argument("--target", default="client,gunicorn", help="comma separated: client, gunicorn, none")
+    parser.add_argument("--mix", default="view=90,add=9,login=1", help="weights of page views, adds and logins")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each load run")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--worker-threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--out", help="write the json results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    mix = parse_mix(args.mix)
+    out = path.abspath(args.out) if args.out else None
+    directory = mkdtemp()
+    chdir(directory)  # app.py and gunicorn use db.sqlite in the working directory
+    start = perf_counter()
+    names = synthetic.seed(path.join(directory, "db.sqlite"), args.users, args.days, args.routes, args.seed)
+    print(f"seeded {len(names)} users in {perf_counter() - start:.1f}s", file=sys.stderr)
+
+    results = {"commit": git_commit(), "time": int(time()), "python": python_version(),
+               "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+               "micro": micro(names[0], args.micro_seconds), "load": {}}
+    targets = [t for t in args.target.split(",") if t and t != "none"]
+    if "client" in targets:
+        import db
+        db.LOGIN_ATTEMPTS = db.LOGIN_ATTEMPTS_PER_IP = 10**9  # measure logins, not the rate limit
+        results["load"]["client"] = load(test_client_requester, names, mix, args.threads, args.seconds, args.seed)
+    if "gunicorn" in targets:
+        process, port = start_gunicorn(directory, args.workers, args.worker_threads)
+        try:
+            results["load"]["gunicorn"] = load(lambda: http_requester(port), names, mix, args.threads, args.seconds,
+                                               args.seed)
+        finally:
+            process.terminate()
+            process.wait()
+
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# seeds a db with users that have realistic stats, routes and activities, used by the benchmark suite
+# usage: python benchmarks/synthetic.py db.sqlite [users] [days] [seed]
+import sys
+from os import path
+from random import Random
+from secrets import token_bytes
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import db  # noqa: E402
+from hashing import hash_password  # noqa: E402
+from utils import activity_metrics  # noqa: E402
+
+PASSWORD = "pw"  # password of every synthetic user
+START = 1_500_000_000
+DAY = 86400
+
+
+def usernames(users):
+    return [f"user{i}" for i in range(users)]
+
+
+def stats_history(rnd, days):
+    # one weigh-in on most days at a varying time, values drift like a real body would
+    weight, body_fat = rnd.uniform(60, 100), rnd.uniform(12, 30)
+    water, muscles = rnd.uniform(50, 60), rnd.uniform(35, 45)
+    rows = []
+    for day in range(days):
+        if rnd.random() < 0.15:
+            continue
+        weight += rnd.gauss(-0.01, 0.3)
+        body_fat = min(max(body_fat + rnd.gauss(0, 0.15), 5), 45)
+        water = min(max(water + rnd.gauss(0, 0.2), 40), 70)
+        muscles = min(max(muscles + rnd.gauss(0, 0.1), 25), 55)
+        rows.append((START + day * DAY + rnd.randrange(6 * 3600, 10 * 3600),
+                     round(weight, 1), round(body_fat, 1), round(water, 1), round(muscles, 1)))
+    return rows
+
+
+def route_list(rnd, routes):
+    return [(f"route-{i}", rnd.randrange(3000, 21000, 100), rnd.randrange(0, 400, 10)) for i in range(routes)]
+
+
+def activity_history(rnd, days, routes):
+    # about three runs a week, pace improves slowly
+    rows = []
+    for day in range(days):
+        if rnd.random() > 3 / 7:
+            continue
+        route_name, distance, height = rnd.choice(routes)
+        pace = rnd.gauss(6.0 - day / days, 0.3)  # min/km
+        seconds = int(pace * (distance + 10 * height) / 1000 * 60)
+        total, pace, speed = activity_metrics(seconds // 60, seconds % 60, distance, height)
+        rows.append((route_name, START + day * DAY + rnd.randrange(16 * 3600, 20 * 3600), total, pace, speed,
+                     rnd.randrange(130, 175)))
+    return rows
+
+
+def seed(db_file, users=20, days=730, routes=6, random_seed=0):
+    # creates db_file with users user0..user<n>, all with the password PASSWORD, returns their names
+    rnd = Random(random_seed)
+    db.DB = db_file
+    db.db_init()
+    salt = token_bytes(16).hex()
+    hashed_pw = hash_password(PASSWORD, salt)  # hashed once, pbkdf2 per user would dominate seeding
+    names = usernames(users)
+    for name in names:
+        db.add_user(name, hashed_pw, salt)
+        user_routes = route_list(rnd, rnd.randint(max(routes // 2, 1), routes))
+        db.add_stats_many(name, stats_history(rnd, days))
+        db.add_routes_many(name, user_routes)
+        db.add_activities_many(name, activity_history(rnd, days, user_routes))
+    return names
+
+
+def main():
+    db_file = sys.argv[1] if len(sys.argv) > 1 else "db.sqlite"
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 730
+    random_seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    seed(db_file, users, days, random_seed=random_seed)
+    print(f"seeded {users} users with {days} days of history into {db_file}")
+
+
+if __name__ == "__main__":
+    main()
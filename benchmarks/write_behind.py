@@ -0,0 +1,59 @@
+# many threads adding single stats rows, committed one by one vs group commits of the write-behind queue
+# usage: python benchmarks/write_behind.py [threads] [rows_per_thread]
+import subprocess
+import sys
+from os import environ, path
+from statistics import quantiles
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+def writer(db, username, rows, wait, latencies):
+    db.add_user(username, "", "")
+    for i in range(rows):
+        start = perf_counter()
+        db.add_stats(username, 1_000_000_000 + i, 80, 20, 55, 40, wait=wait)
+        latencies.append((perf_counter() - start) * 1000)
+
+
+def run(threads, rows, wait):
+    import db
+    db.DB = path.join(mkdtemp(), "bench.sqlite")
+    db.db_init()
+    latencies = []
+    workers = [Thread(target=writer, args=(db, f"user{i}", rows, wait, latencies)) for i in range(threads)]
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    returned = perf_counter() - start
+    if db._write_behind is not None:
+        db._write_behind.close()  # what a graceful shutdown does
+    committed = perf_counter() - start
+    with db.db_connection(name="run") as con:
+        stored = con.execute("SELECT COUNT(*) FROM stats").fetchone()[0]
+    assert stored == threads * rows, f"{stored} of {threads * rows} rows stored"
+    p50, p99 = (quantiles(latencies, n=100)[i] for i in (49, 98))
+    print(f"{threads * rows / committed:8.0f} rows/s committed, add p50={p50:.3f}ms p99={p99:.3f}ms, "
+          f"all returned after {returned:.2f}s, committed after {committed:.2f}s")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":  # one mode per process, WRITE_BEHIND is read on import
+        return run(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] == "wait")
+    threads = sys.argv[1] if len(sys.argv) > 1 else "16"
+    rows = sys.argv[2] if len(sys.argv) > 2 else "500"
+    for name, write_behind, wait in (("direct", "0", "wait"), ("group commit, waiting", "1", "wait"),
+                                     ("write-behind", "1", "nowait")):
+        print(f"{name:22}", end=" ", flush=True)
+        subprocess.run([sys.executable, __file__, "--run", threads, rows, wait], check=True,
+                       env=environ | {"WRITE_BEHIND": write_behind})
+
+
+if __name__ == "__main__":
+    main()
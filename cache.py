@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+
+VIEW_CACHE_SIZE = int(environ.get("VIEW_CACHE_SIZE", 1024))  # cached views per worker process
+# with several gunicorn workers, entries are checked against the data versions stored in sqlite,
+# otherwise a write in one worker would not invalidate the cache of the others
+VIEW_CACHE_SHARED = environ.get("VIEW_CACHE_SHARED", "0") == "1"
+
+
+class ViewCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (username, collection, view) -> (version, value)
+        self.keys = {}                # (username, collection) -> {(username, collection, view), ...}
+        self.generations = {}         # (username, collection) -> local write counter
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, username, collection, view, version, compute):
+        # version None uses the local write counter, which only sees writes of this process
+        key = (username, collection, view)
+        with self.lock:
+            generation = self.generations.get(key[:2], 0)
+            if version is None:
+                version = generation
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            if generation == self.generations.get(key[:2], 0):  # skip if invalidated while computing
+                self.entries[key] = (version, value)
+                self.entries.move_to_end(key)
+                self.keys.setdefault(key[:2], set()).add(key)
+                while len(self.entries) > self.max_entries:
+                    old_key, _ = self.entries.popitem(last=False)
+                    self.keys[old_key[:2]].discard(old_key)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, username, collection):
+        with self.lock:
+            self.generations[(username, collection)] = self.generations.get((username, collection), 0) + 1
+            for key in self.keys.pop((username, collection), ()):
+                del self.entries[key]
+
+    def info(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+view_cache = ViewCache(VIEW_CACHE_SIZE)
@@ -0,0 +1,98 @@
+from importlib.util import find_spec
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from downsample import lttb
+
+# png charts are disabled without matplotlib. it is imported on the first png, importing it takes longer than
+# starting the rest of the app
+HAS_MATPLOTLIB = find_spec("matplotlib") is not None
+
+chart_formats = {"svg": "image/svg+xml", "png": "image/png"}
+CHART_WIDTH, CHART_HEIGHT = 800, 400  # pixels
+MARGIN_LEFT, MARGIN_RIGHT, MARGIN_TOP, MARGIN_BOTTOM = 50, 15, 30, 40
+Y_TICKS = 5
+X_LABELS = 6
+MAX_MARKERS = 100  # the data line gets point markers like chart.js up to this many points
+# series name -> (rgb, dashed), same as the chart.js chart of stats.html, "data" is the category itself
+series_styles = {"data": ((168, 35, 35), False), "Moving Average": ((35, 101, 168), False),
+                 "Trend": ((120, 120, 120), True)}
+
+
+def format_available(chart_format):
+    return chart_format == "svg" or (chart_format == "png" and HAS_MATPLOTLIB)
+
+
+def _thin(date_labels, series, max_points):
+    # long histories are drawn with at most max_points points per line, picked by LTTB on the data line
+    datapoints = series[0][1]
+    if len(datapoints) <= max_points:
+        return date_labels, series
+    keep = lttb(list(range(len(datapoints))), datapoints, max_points)
+    return [date_labels[i] for i in keep], [(name, [values[i] for i in keep] if values else values)
+                                            for name, values in series]
+
+
+def render_svg(label, date_labels, series, start_y, end_y, width=CHART_WIDTH, height=CHART_HEIGHT):
+    # series: [(name, values)], the first one is the data, values are aligned with date_labels
+    plot_width, plot_height = width - MARGIN_LEFT - MARGIN_RIGHT, height - MARGIN_TOP - MARGIN_BOTTOM
+    date_labels, series = _thin(date_labels, series, plot_width)
+    n = len(date_labels)
+
+    def x(i):
+        return MARGIN_LEFT + (plot_width * i / (n - 1) if n > 1 else plot_width / 2)
+
+    def y(value):
+        return MARGIN_TOP + plot_height * (end_y - value) / ((end_y - start_y) or 1)
+
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+             f'viewBox="0 0 {width} {height}" font-family="sans-serif" font-size="11">',
+             f'<rect width="{width}" height="{height}" fill="white"/>']
+    for t in range(Y_TICKS + 1):
+        value = start_y + (end_y - start_y) * t / Y_TICKS
+        parts.append(f'<line x1="{MARGIN_LEFT}" x2="{width - MARGIN_RIGHT}" y1="{y(value):.1f}" y2="{y(value):.1f}" '
+                     f'stroke="#e5e5e5"/><text x="{MARGIN_LEFT - 5}" y="{y(value) + 4:.1f}" text-anchor="end">'
+                     f'{value:g}</text>')
+    for i in sorted({round(k * (n - 1) / (X_LABELS - 1)) for k in range(X_LABELS)}) if n else []:
+        parts.append(f'<text x="{x(i):.1f}" y="{height - MARGIN_BOTTOM + 16}" text-anchor="middle">'
+                     f'{escape(date_labels[i])}</text>')
+    legend_x = MARGIN_LEFT
+    for k, (name, values) in enumerate(series):
+        (r, g, b), dashed = series_styles["data" if k == 0 else name]
+        name = label if k == 0 else name
+        dash = ' stroke-dasharray="5,5"' if dashed else ""
+        if values:
+            points = " ".join(f"{x(i):.1f},{y(v):.1f}" for i, v in enumerate(values))
+            parts.append(f'<polyline points="{points}" fill="none" stroke="rgb({r},{g},{b})" stroke-width="2"{dash}/>')
+            if k == 0 and len(values) <= MAX_MARKERS:
+                parts.extend(f'<circle cx="{x(i):.1f}" cy="{y(v):.1f}" r="3" fill="rgb({r},{g},{b})"/>'
+                             for i, v in enumerate(values))
+        parts.append(f'<rect x="{legend_x}" y="8" width="20" height="10" fill="rgb({r},{g},{b})"/>'
+                     f'<text x="{legend_x + 25}" y="17">{escape(name)}</text>')
+        legend_x += 40 + 7 * len(name)
+    parts.append("</svg>")
+    return "".join(parts).encode()
+
+
+def render_png(label, date_labels, series, start_y, end_y, width=CHART_WIDTH, height=CHART_HEIGHT):
+    from matplotlib.figure import Figure  # without pyplot, figures are independent and thread safe
+    date_labels, series = _thin(date_labels, series, width)
+    figure = Figure(figsize=(width / 100, height / 100), dpi=100)
+    axes = figure.add_subplot()
+    for k, (name, values) in enumerate(series):
+        if values:
+            (r, g, b), dashed = series_styles["data" if k == 0 else name]
+            axes.plot(range(len(values)), values, color=(r / 255, g / 255, b / 255), linestyle="--" if dashed else "-",
+                      marker="o" if k == 0 and len(values) <= MAX_MARKERS else None, label=label if k == 0 else name)
+    axes.set_ylim(start_y, end_y)
+    if date_labels:
+        ticks = sorted({round(k * (len(date_labels) - 1) / (X_LABELS - 1)) for k in range(X_LABELS)})
+        axes.set_xticks(ticks, [date_labels[i] for i in ticks])
+    axes.legend(loc="upper left")
+    figure.tight_layout()
+    out = BytesIO()
+    figure.savefig(out, format="png")
+    return out.getvalue()
+
+
+renderers = {"svg": render_svg, "png": render_png}
@@ -1,9 +1,43 @@
-from hashlib import pbkdf2_hmac
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import blake2b
+from itertools import islice
+import json
+from os import environ, getpid, listdir, makedirs, path, remove, stat
+from queue import Empty, LifoQueue
 from secrets import token_bytes
 from sqlite3 import connect
 from string import ascii_letters, digits
+from threading import Lock
+from time import perf_counter, time
+
+from aggregates import summarize, summary_fields, update_summary
+from analytics import decode_route_summary, encode_route_summary, route_summary_fields, summarize_route, \
+    update_route_summary
+from cache import view_cache
+from events import Channels
+from geo import bounding_box, decode_points, distance_to_path, encode_points, meters_to_degrees, MATCH_SHARE, \
+    MATCH_TOLERANCE, similarity, simplify
+from hashing import HashingBusy, hash_password, verify_password
+from metrics import record_query
+from migrations import is_strict, migrate, MIGRATION_LOCK, rewrite_table, user_version
+from periods import bounds_json, period_bounds
+from writebehind import WriteBehind
 
 DB = "db.sqlite"
+SHARDS = environ.get("DB_SHARDS", "")  # "" keeps all users in DB, "user" gives every user a file, a number hash buckets
+SHARD_DIR = environ.get("DB_SHARD_DIR", "")  # defaults to shards/ next to DB
+OPEN_DB_FILES = int(environ.get("DB_OPEN_FILES", 64))  # db files with pooled connections per worker process
+POOL_SIZE = int(environ.get("DB_POOL_SIZE", 8))  # idle connections kept per db file and worker process
+WRITE_BEHIND = environ.get("WRITE_BEHIND", "0") == "1"  # form adds return before they are committed
+WRITE_BEHIND_QUEUE = int(environ.get("WRITE_BEHIND_QUEUE", 10000))  # queued writes before submitters block
+WRITE_BEHIND_LATENCY = float(environ.get("WRITE_BEHIND_LATENCY_MS", 20)) / 1000  # max wait for more writes
+WRITE_BEHIND_BATCH = 1000  # writes per group commit
+STATEMENT_CACHE_SIZE = 128  # prepared statements cached per connection
+EVENTS_KEEP = 1000  # events kept per db file, a page that missed older ones reloads
+EVENTS_MAX_ROWS = 100  # larger writes, like imports, make pages reload instead of adding the rows
+LOGIN_ATTEMPTS = int(environ.get("LOGIN_ATTEMPTS_PER_MINUTE", 10))  # per username and ip
+LOGIN_ATTEMPTS_PER_IP = int(environ.get("LOGIN_ATTEMPTS_PER_IP", 60))  # of all usernames, a NAT shares it
 
 category_to_beautified = {"weight": "Weight", "body_fat": "% Fat", "water": "% H2O", "muscles": "% Msl"}
 beautified_to_category = {v: k for k, v in category_to_beautified.items()}
@@ -11,6 +45,11 @@ categories = category_to_beautified.keys()
 beautified_categories = beautified_to_category.keys()
 category_info = [(c, b) for c, b in zip(categories, beautified_categories)]
 default_category = "weight"
+collections = ["stats", "routes", "activities"]
+PAGE_SIZE = 100  # rows per page of the stats and activities tables
+EXPORT_CHUNK = 1000  # rows read per query while streaming, see _iter_rows
+ROLLUP_WIDTHS = [7 * 86400, 30 * 86400, 91 * 86400, 365 * 86400]  # bucket widths in seconds, finest first
+ROLLUP_OVERSAMPLING = 10  # max rows read per requested chart point
 
 
 def check_save_query_input(q):
@@ -19,75 +58,457 @@ def check_save_query_input(q):
     return True
 
 
+def shard_dir():
+    return SHARD_DIR or path.join(path.dirname(DB), "shards")
+
+
+def shard_file(username):
+    # db file holding the data of username, credentials always stay in DB
+    if not SHARDS:
+        return DB
+    digest = blake2b(username.encode(), digest_size=16).digest()
+    if SHARDS == "user":
+        name = digest.hex()  # usernames are not restricted to characters that are safe in file names
+    else:
+        name = "bucket-%03d" % (int.from_bytes(digest, "big") % int(SHARDS))
+    return path.join(shard_dir(), name + ".sqlite")
+
+
+def shard_files():
+    # all existing shard files, without DB
+    directory = shard_dir()
+    if not SHARDS or not path.isdir(directory):
+        return []
+    return sorted(path.join(directory, f) for f in listdir(directory) if f.endswith(".sqlite"))
+
+
+def _connect(db_file):
+    # check_same_thread=False: a pooled connection is handed to one thread at a time, but not always the same one
+    if db_file != DB:
+        makedirs(path.dirname(db_file), exist_ok=True)
+    con = connect(db_file, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    con.execute("PRAGMA journal_mode = WAL")    # readers do not block the writer and vice versa
+    con.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, saves an fsync per commit
+    con.execute("PRAGMA foreign_keys = ON")     # deleting a user cascades to its rows
+    # shards are created on first use and may have been dropped by another worker
+    if db_file != DB and user_version(con) != SCHEMA_VERSION:
+        migrate_file(db_file)
+    return con
+
+
+def _inode(db_file):
+    try:
+        return stat(db_file).st_ino
+    except FileNotFoundError:
+        return None
+
+
+_pools = OrderedDict()  # db file -> idle connections, least recently used file first
+_pools_lock = Lock()
+_pools_pid = getpid()
+_inherited = []  # pools of the parent process, never closed: closing drops the posix locks of the whole process
+
+
+def _pool(db_file):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != getpid():  # forked gunicorn worker, never reuse the parent's handles
+            _inherited.append(_pools)
+            _pools, _pools_pid = OrderedDict(), getpid()
+        pool = _pools.get(db_file)
+        if pool is None:
+            pool = _pools[db_file] = LifoQueue()
+            while len(_pools) > OPEN_DB_FILES:  # lazily reopened on the next request of that user
+                _close_pool(_pools.popitem(last=False)[1])
+        else:
+            _pools.move_to_end(db_file)
+        return pool
+
+
+def _close_pool(pool):
+    while True:
+        try:
+            pool.get_nowait()[0].close()
+        except Empty:
+            return
+
+
+@contextmanager
+def db_connection(username=None, *, name):
+    # connection to the shard of username, or to DB for the user table. name labels its time in the query metrics
+    db_file = DB if username is None else shard_file(username)
+    if _write_behind is not None and username is not None:
+        _write_behind.wait(username)  # the user's queued writes come first
+    pool = _pool(db_file)
+    start = perf_counter()
+    # per user files can be dropped by another worker, a handle to a deleted file must not be reused
+    check_inode = SHARDS == "user" and db_file != DB
+    inode = _inode(db_file) if check_inode else None
+    try:
+        con, con_inode = pool.get_nowait()
+    except Empty:
+        con, con_inode = None, None
+    if con is not None and con_inode != inode:
+        con.close()
+        con = None
+    if con is None:
+        con = _connect(db_file)
+        inode = _inode(db_file) if check_inode else None
+    try:
+        with con:  # commits on success, rolls back on error
+            yield con
+    finally:
+        if pool.qsize() < POOL_SIZE and _pools.get(db_file) is pool:
+            pool.put((con, inode))
+        else:
+            con.close()
+        record_query(name, perf_counter() - start)
+
+
+def db_close():
+    with _pools_lock:
+        if _pools_pid != getpid():  # the parent's handles, see _inherited
+            return
+        for pool in _pools.values():
+            _close_pool(pool)
+        _pools.clear()
+
+
+# latest schema: every table is STRICT, tables keyed by username are WITHOUT ROWID, so the rows of a user are stored
+# together in key order. table -> (columns, primary key, without rowid), older files are brought here by _migrations
+_user_fk = "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
+_tables = {
+    "user": ([
+        "username TEXT PRIMARY KEY",
+        "hashed_pw TEXT",
+        "salt TEXT",
+    ], ["username"], True),
+    "data_version": ([
+        "username TEXT",
+        "collection TEXT",   # stats, routes or activities
+        "version INTEGER",   # incremented on every write
+        "PRIMARY KEY (username, collection)",
+    ], ["username", "collection"], True),
+    "stats": ([
+        "username TEXT",
+        "date INTEGER",      # epoch timestamp
+        "weight REAL",       # kilos
+        "body_fat REAL",     # percents
+        "water REAL",        # percents
+        "muscles REAL",      # percents
+        "PRIMARY KEY (username, date)",
+        _user_fk,
+    ], ["username", "date"], True),
+    "stats_summary": ([      # running aggregates, see aggregates.py
+        "username TEXT",
+        "category TEXT",
+        "n INTEGER",
+        "last_date INTEGER",  # epoch timestamp
+        "sum_x REAL",         # x in days since epoch
+        "sum_y REAL",
+        "sum_xx REAL",
+        "sum_xy REAL",
+        "min_y REAL",
+        "max_y REAL",
+        "ewma REAL",
+        "PRIMARY KEY (username, category)",
+        _user_fk,
+    ], ["username", "category"], True),
+    "stats_rollup": ([       # per bucket aggregates for downsampled charts
+        "username TEXT",
+        "width INTEGER",     # bucket width in seconds, see ROLLUP_WIDTHS
+        "bucket INTEGER",    # epoch timestamp of the bucket start
+        "n INTEGER",
+        "date_sum INTEGER",
+        *(f"{c}_{aggregate} REAL" for c in categories for aggregate in ("sum", "min", "max")),
+        "PRIMARY KEY (username, width, bucket)",
+        _user_fk,
+    ], ["username", "width", "bucket"], True),
+    "routes": ([
+        "username TEXT",
+        "route_name TEXT",
+        "distance INTEGER",  # meters
+        "height INTEGER",    # meters
+        "PRIMARY KEY (username, route_name)",
+        _user_fk,
+    ], ["username", "route_name"], True),
+    "activities": ([
+        "username TEXT",
+        "route_name TEXT",
+        "date INTEGER",        # epoch timestamp
+        "time INTEGER",        # seconds
+        "pace REAL",           # min/km
+        "speed REAL",          # km/h
+        "heart_rate INTEGER",  # bpm
+        "PRIMARY KEY (username, route_name, date)",
+        _user_fk,
+    ], ["username", "route_name", "date"], True),
+    "route_summary": ([      # per route analytics, see analytics.py
+        "username TEXT",
+        "route_name TEXT",
+        "n INTEGER",
+        "best_time INTEGER",       # seconds
+        "best_time_date INTEGER",  # epoch timestamp
+        "best_pace REAL",          # min/km
+        "best_speed REAL",         # km/h
+        "sum_time INTEGER",
+        "sum_speed REAL",
+        "efficiency_n INTEGER",    # activities with a heart rate
+        "sum_efficiency REAL",     # km/h per bpm
+        "best_efficiency REAL",
+        "sum_x REAL",              # x in days since epoch, y is pace
+        "sum_y REAL",
+        "sum_xx REAL",
+        "sum_xy REAL",
+        "pace_histogram TEXT",     # json, pace bucket -> count
+        "PRIMARY KEY (username, route_name)",
+        _user_fk,
+    ], ["username", "route_name"], True),
+    "route_geometry": ([     # a rowid table, its ids are those of route_bbox
+        "id INTEGER PRIMARY KEY",
+        "username TEXT",
+        "route_name TEXT",
+        "points BLOB",        # simplified polyline, see geo.encode_points
+        "n INTEGER",          # points in the blob
+        "UNIQUE (username, route_name)",
+        _user_fk,
+    ], ["id"], False),
+    "events": ([             # the latest writes, every worker reads them for the live updates of its open pages
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT",  # never reused, the workers read the events after the last seen
+        "username TEXT",     # no foreign key, deleting a user is an event too
+        "collection TEXT",
+        "version INTEGER",   # data_version of the collection after the write
+        "rows TEXT",         # json of the new rows, null if the write changed or removed rows
+    ], ["seq"], False),
+    "login_attempts": ([     # login and register attempts of the last minute, in DB only, see admit
+        "key TEXT",          # ip, or ip and username
+        "at REAL",           # epoch timestamp
+        "PRIMARY KEY (key, at)",
+    ], ["key", "at"], True),
+}
+_indexes = [
+    # all routes of a user ordered by date, covering for the period queries. the primary key only serves one route
+    "CREATE INDEX IF NOT EXISTS activities_by_date ON activities (username, date, route_name, time, heart_rate)",
+    # bounding boxes of all route_geometry rows, for routes near a position and candidates of track matching
+    "CREATE VIRTUAL TABLE IF NOT EXISTS route_bbox USING rtree (id, min_lat, max_lat, min_lon, max_lon)",
+    "CREATE TRIGGER IF NOT EXISTS route_geometry_deleted AFTER DELETE ON route_geometry "
+    "BEGIN DELETE FROM route_bbox WHERE id = old.id; END",
+    # the events a page missed while it was disconnected
+    "CREATE INDEX IF NOT EXISTS events_by_version ON events (username, collection, version)",
+]
+
+
+def _create_table(cur, table, name=None):
+    columns, _, without_rowid = _tables[table]
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {name or table} ({', '.join(columns)}) STRICT"
+                + (", WITHOUT ROWID" if without_rowid else ""))
+
+
+def _create_schema(cur):
+    for table in _tables:
+        _create_table(cur, table)
+    for statement in _indexes:
+        cur.execute(statement)
+
+
+def _typed_tables(con):
+    # NUM columns of the tables created before versioning become REAL, every table STRICT, see rewrite_table
+    for table, (columns, key, _) in _tables.items():
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = (?)", (table,)).fetchone():
+            continue  # created below
+        if not is_strict(con, table):
+            types = dict(c.split()[:2] for c in columns if not c.startswith(("PRIMARY", "FOREIGN", "UNIQUE")))
+            rewrite_table(con, table, lambda con, name: _create_table(con, table, name), types, key)
+    con.execute("DROP INDEX IF EXISTS activities_by_date")  # now covering, created with the rest
+    _create_schema(con)
+
+
+_migrations = [  # (version, name, apply), append new ones, never change applied ones
+    (1, "strict typed tables", _typed_tables),
+    (2, "live update events", _create_schema),
+    (3, "login attempts", _create_schema),
+]
+SCHEMA_VERSION = _migrations[-1][0]
+
+
+def _migrate(con, db_file):
+    # con is in autocommit mode
+    return migrate(con, db_file, _create_schema, _migrations, SCHEMA_VERSION)
+
+
+def migrate_file(db_file):
+    con = connect(db_file, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode = WAL")
+        return _migrate(con, db_file)
+    finally:
+        con.close()
+
+
+def schema_version(db_file):
+    con = connect(db_file)
+    try:
+        return user_version(con)
+    finally:
+        con.close()
+
+
 def db_init():
-    with connect(DB) as con:
-        cur = con.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS user ("
-                    "username TEXT PRIMARY KEY,"
-                    "hashed_pw TEXT,"
-                    "salt TEXT"
-                    ")")
-        cur.execute("CREATE TABLE IF NOT EXISTS stats ("
-                    "username TEXT,"
-                    "date INT,"      # epoch timestamp
-                    "weight NUM,"    # kilos
-                    "body_fat NUM,"  # percents
-                    "water NUM,"     # percents
-                    "muscles NUM,"   # percents
-                    "PRIMARY KEY (username, date),"
-                    "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
-                    ")")
-        cur.execute("CREATE TABLE IF NOT EXISTS routes ("
-                    "username TEXT,"
-                    "route_name TEXT,"
-                    "distance INT,"  # meters
-                    "height INT,"    # meters
-                    "PRIMARY KEY (username, route_name),"
-                    "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
-                    ")")
-        cur.execute("CREATE TABLE IF NOT EXISTS activities ("
-                    "username TEXT,"
-                    "route_name TEXT,"
-                    "date INT,"        # epoch timestamp
-                    "time INT,"        # seconds
-                    "pace NUM,"        # min/km
-                    "speed NUM,"       # km/h
-                    "heart_rate INT,"  # bpm
-                    "PRIMARY KEY (username, route_name, date),"
-                    "FOREIGN KEY (username) REFERENCES user (username) ON DELETE CASCADE"
-                    ")")
-        con.commit()
+    # not pooled, with a preloaded app this runs in the gunicorn master before the workers are forked
+    return migrate_file(DB)
+
 
+def check_health():
+    # raises if DB cannot be read, returns the write-behind backlog
+    with db_connection(name="check_health") as con:
+        con.execute("SELECT 1 FROM user LIMIT 1").fetchall()
+    return {"queued_writes": sum(_write_behind.pending.values()) if _write_behind is not None else 0}
 
-def h(password: str, salt: str) -> str:
-    return pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), 2**18).hex()
+
+_attempts_purged = 0.0
+
+
+def admit(ip, username=None):
+    # counts an attempt against the limits of the ip and of the username from that ip, raises HashingBusy past them.
+    # kept in DB so every worker sees them, and per ip so nobody can lock the owner of a username out
+    global _attempts_purged
+    now = time()
+    limits = {f"ip {ip}": LOGIN_ATTEMPTS_PER_IP}
+    if username:
+        limits[f"user {ip} {username}"] = LOGIN_ATTEMPTS
+    with db_connection(name="admit") as con:
+        cur = con.cursor()
+        if now - _attempts_purged > 60:  # keys that are no longer used, once a minute per process
+            _attempts_purged = now
+            cur.execute("DELETE FROM login_attempts WHERE at <= (?)", (now - 60,))
+        for key, limit in limits.items():
+            # the insert takes the write lock first, so workers count one after another
+            cur.execute("INSERT OR IGNORE INTO login_attempts VALUES (?, ?)", (key, now))
+            cur.execute("DELETE FROM login_attempts WHERE key = (?) AND at <= (?)", (key, now - 60))
+            if cur.execute("SELECT COUNT(*) FROM login_attempts WHERE key = (?)", (key,)).fetchone()[0] > limit:
+                con.rollback()  # refused attempts do not count
+                raise HashingBusy("Too many attempts, try again in a minute")
+        con.commit()
+    return True
 
 
 def db_register(username, password):
-    salt = token_bytes(16).hex()
-    hashed_pw = h(password, salt)
-    with connect(DB) as con:
+    with db_connection(name="db_register") as con:
         cur = con.cursor()
         if cur.execute("SELECT * FROM user WHERE username = (?)", (username,)).fetchall():
-            return False
-        cur.execute("INSERT INTO user (username, hashed_pw, salt) "
+            return False  # checked before hashing, taken names should not cost a pbkdf2 run
+    salt = token_bytes(16).hex()
+    return add_user(username, hash_password(password, salt), salt)
+
+
+def add_user(username, hashed_pw, salt):
+    # returns False if the name is taken
+    if shard_file(username) != DB:  # first, so a user in DB always has its shard
+        with db_connection(username, name="add_user") as con:
+            cur = con.cursor()
+            # the shard only knows the name, for its foreign keys
+            cur.execute("INSERT OR IGNORE INTO user (username) VALUES (?)", (username,))
+            # a dropped per user file restarts its versions, start above anything a worker may still have cached
+            cur.executemany("INSERT OR IGNORE INTO data_version (username, collection, version) VALUES (?, ?, ?)",
+                            [(username, collection, int(time() * 1000)) for collection in collections])
+    with db_connection(name="add_user") as con:
+        cur = con.cursor()
+        cur.execute("INSERT OR IGNORE INTO user (username, hashed_pw, salt) "
                     "VALUES (?, ?, ?)", (username, hashed_pw, salt))
         con.commit()
-        return True
+        return cur.rowcount == 1
+
+
+def _drop_file(db_file):
+    with _pools_lock:
+        pool = _pools.pop(db_file, None)
+    if pool is not None:
+        _close_pool(pool)
+    for suffix in ("", "-wal", "-shm", MIGRATION_LOCK):  # the lock stays behind when a migration failed
+        try:
+            remove(db_file + suffix)
+        except FileNotFoundError:
+            pass
 
 
 def delete_user(username):
-    with connect(DB) as con:
+    with db_connection(name="delete_user") as con:
+        con.execute("DELETE FROM user WHERE username = (?)", (username,))  # cascades to the rows in DB
+    if SHARDS == "user":
+        if _write_behind is not None:
+            _write_behind.wait(username)
+        _drop_file(shard_file(username))  # no matter how much history, nothing is deleted row by row
+    else:
+        with db_connection(username, name="delete_user") as con:
+            cur = con.cursor()
+            cur.execute("DELETE FROM user WHERE username = (?)", (username,))
+            for collection in collections:
+                _changed(cur, username, collection)
+    for collection in collections:
+        view_cache.invalidate(username, collection)
+
+
+def _changed(cur, username, collection, rows=None):
+    # every write bumps the version of the collection it touched, see cache.py, and is logged for the live updates,
+    # see events.py. rows are the new rows if that is all the write did, else pages reload
+    version = cur.execute("INSERT INTO data_version (username, collection, version) VALUES (?, ?, 1) "
+                          "ON CONFLICT (username, collection) DO UPDATE SET version = version + 1 RETURNING version",
+                          (username, collection)).fetchone()[0]
+    if rows is not None and len(rows) > EVENTS_MAX_ROWS:
+        rows = None
+    cur.execute("INSERT INTO events (username, collection, version, rows) VALUES (?, ?, ?, ?)",
+                (username, collection, version, None if rows is None else json.dumps(rows)))
+    cur.execute("DELETE FROM events WHERE seq <= (?)", (cur.lastrowid - EVENTS_KEEP,))
+
+
+def get_events(username, collection, after_version):
+    # [(version, rows)] of the collection since after_version, as far as they are kept
+    with db_connection(username, name="get_events") as con:
+        cur = con.cursor()
+        return [(version, None if rows is None else json.loads(rows)) for version, rows in cur.execute(
+            "SELECT version, rows FROM events WHERE username = (?) AND collection = (?) AND version > (?) "
+            "ORDER BY version", (username, collection, after_version))]
+
+
+def _read_events(username, after_seq):
+    # events of all users in the db file of username after after_seq, for the poller of events.py.
+    # after_seq None returns no events but the last seq
+    with db_connection(username, name="_read_events") as con:
         cur = con.cursor()
-        cur.execute("DELETE FROM user WHERE username = (?)", (username,))
+        if after_seq is None:
+            return cur.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0], []
+        events = [(seq, name, collection, version, None if rows is None else json.loads(rows))
+                  for seq, name, collection, version, rows in cur.execute(
+                      "SELECT seq, username, collection, version, rows FROM events WHERE seq > (?) ORDER BY seq",
+                      (after_seq,))]
+        return (events[-1][0] if events else after_seq), events
+
+
+channels = Channels(_read_events, shard_file)
+
+
+def get_data_version(username, collection):
+    with db_connection(username, name="get_data_version") as con:
+        cur = con.cursor()
+        row = cur.execute("SELECT version FROM data_version WHERE username = (?) AND collection = (?)",
+                          (username, collection)).fetchone()
+        return row[0] if row else 0
 
 
 def db_login(username, given_password):
-    with connect(DB) as con:
+    with db_connection(name="db_login") as con:
         cur = con.cursor()
-        if ret := cur.execute("SELECT * FROM user WHERE username = (?)", (username,)).fetchone():
-            username, hashed_pw, salt = ret
-            return h(given_password, salt) == hashed_pw
+        ret = cur.execute("SELECT * FROM user WHERE username = (?)", (username,)).fetchone()
+    if not ret:
+        return False
+    username, hashed_pw, salt = ret
+    ok, outdated = verify_password(given_password, salt, hashed_pw)
+    if outdated:  # iteration count was changed, upgrade the stored hash while we know the password
+        with db_connection(name="db_login") as con:
+            cur = con.cursor()
+            cur.execute("UPDATE user SET hashed_pw = (?) WHERE username = (?)",
+                        (hash_password(given_password, salt), username))
+    return ok
 
 
 def get_stats(username, category=""):
@@ -97,37 +518,238 @@ def get_stats(username, category=""):
         return []
     else:
         select = "SELECT date, " + category
-    with connect(DB) as con:
+    with db_connection(username, name="get_stats") as con:
         cur = con.cursor()
         return cur.execute(select + " FROM stats WHERE username = (?) ORDER BY date", (username,)).fetchall()
 
 
-def add_stats(username, date, weight, body_fat, water, muscles):
-    with connect(DB) as con:
+def get_stats_page(username, after=None, limit=PAGE_SIZE):
+    # keyset pagination, returns up to limit rows with date > after and the cursor of the next page (or None)
+    with db_connection(username, name="get_stats_page") as con:
         cur = con.cursor()
-        cur.execute("INSERT OR IGNORE INTO stats (username, date, weight, body_fat, water, muscles) "
-                    "VALUES (?, ?, ?, ?, ?, ?)", (username, date, weight, body_fat, water, muscles))
+        rows = cur.execute("SELECT date, weight, body_fat, water, muscles FROM stats "
+                           "WHERE username = (?) AND date > (?) ORDER BY date LIMIT (?)",
+                           (username, -1 if after is None else after, limit + 1))
+        page = list(islice(rows, limit))
+        has_next = rows.fetchone() is not None
+    return page, page[-1][0] if has_next else None
+
+
+def _period_range(cur, table, username, start, end):
+    # defaults to the user's whole history, None if there is nothing in it
+    if start is None or end is None:
+        first, last = cur.execute(f"SELECT MIN(date), MAX(date) FROM {table} WHERE username = (?)",
+                                  (username,)).fetchone()
+        if first is None:
+            return None
+        start, end = first if start is None else start, last + 1 if end is None else end
+    return start, end
+
+
+def _periods(cur, table, username, period, tz, start, end):
+    # (bounds, json of the bounds clipped to [start, end)) of the calendar periods to aggregate
+    if (date_range := _period_range(cur, table, username, start, end)) is None:
+        return [], "[]"
+    start, end = date_range
+    bounds = period_bounds(period, tz, start, end)
+    return bounds, bounds_json([(day, max(lower, start), min(upper, end)) for day, lower, upper in bounds])
+
+
+def get_stats_by_period(username, period, tz, start=None, end=None):
+    # per calendar period in tz: (first day, start, n, average of every category), empty periods included.
+    # every period is one range scan of the stats primary key
+    with db_connection(username, name="get_stats_by_period") as con:
+        cur = con.cursor()
+        bounds, periods = _periods(cur, "stats", username, period, tz, start, end)
+        rows = cur.execute("SELECT p.key, COUNT(s.date), "
+                           + ", ".join(f"AVG(s.{c})" for c in categories) +
+                           " FROM json_each(?) p LEFT JOIN stats s ON s.username = (?) "
+                           "AND s.date >= p.value ->> 0 AND s.date < p.value ->> 1 GROUP BY p.key ORDER BY p.key",
+                           (periods, username)).fetchall()
+    return [(bounds[i][0], bounds[i][1], *values) for i, *values in rows]
+
+
+def _save_stats_summaries(cur, username, summaries):
+    fields = ", ".join(summary_fields)
+    placeholders = ", ".join("?" for _ in summary_fields)
+    cur.executemany(f"INSERT OR REPLACE INTO stats_summary (username, category, {fields}) "
+                    f"VALUES (?, ?, {placeholders})",
+                    [(username, c, *(s[f] for f in summary_fields)) for c, s in summaries.items()])
+
+
+def _load_stats_summaries(cur, username):
+    rows = cur.execute(f"SELECT category, {', '.join(summary_fields)} FROM stats_summary WHERE username = (?)",
+                       (username,)).fetchall()
+    if len(rows) != len(categories):
+        return None
+    return {row[0]: dict(zip(summary_fields, row[1:])) for row in rows}
+
+
+def _rebuild_stats_summaries(cur, username):
+    # full scan, only needed when history is rewritten (delete, edit, backdated insert)
+    stats = cur.execute("SELECT date, weight, body_fat, water, muscles FROM stats WHERE username = (?) ORDER BY date",
+                        (username,)).fetchall()
+    summaries = summarize(stats, categories)
+    _save_stats_summaries(cur, username, summaries)
+    return summaries
+
+
+def _update_stats_summaries(cur, username, stats):
+    # stats are newly inserted rows of (date, weight, body_fat, water, muscles) ordered by date. returns False if
+    # there were no summaries yet, they are then built with the rollups from all rows, stats included
+    summaries = _load_stats_summaries(cur, username)
+    if summaries is None:
+        _ensure_stats_summaries(cur, username)
+        return False
+    first_date = stats[0][0]
+    if any(s["last_date"] is not None and s["last_date"] > first_date for s in summaries.values()):
+        _rebuild_stats_summaries(cur, username)
+        return True
+    for row in stats:
+        for category, value in zip(categories, row[1:]):
+            update_summary(summaries[category], row[0], value)
+    _save_stats_summaries(cur, username, summaries)
+    return True
+
+
+def _rewrite_stats_summaries(cur, username, date):
+    # after an edit or delete at date, only the rollup buckets of date change, unless there were no rollups yet
+    if _load_stats_summaries(cur, username) is None:
+        _ensure_stats_summaries(cur, username)
+    else:
+        _rebuild_stats_summaries(cur, username)
+        _rebuild_stats_rollups(cur, username, date)
+
+
+def _ensure_stats_summaries(cur, username):
+    if summaries := _load_stats_summaries(cur, username):
+        return summaries
+    # history from before summaries and rollups existed
+    _rebuild_stats_rollups(cur, username)
+    return _rebuild_stats_summaries(cur, username)
+
+
+def get_stats_summary(username, category):
+    with db_connection(username, name="get_stats_summary") as con:
+        return _ensure_stats_summaries(con.cursor(), username)[category]
+
+
+_rollup_columns = ", ".join(f"{c}_sum, {c}_min, {c}_max" for c in categories)
+_rollup_upsert = (f"INSERT INTO stats_rollup (username, width, bucket, n, date_sum, {_rollup_columns}) "
+                  f"VALUES (?, ?, ?, 1, ?, {', '.join('?' for _ in range(3 * len(categories)))}) "
+                  f"ON CONFLICT (username, width, bucket) DO UPDATE SET "
+                  f"n = n + 1, date_sum = date_sum + excluded.date_sum, "
+                  + ", ".join(f"{c}_sum = {c}_sum + excluded.{c}_sum, {c}_min = min({c}_min, excluded.{c}_min), "
+                              f"{c}_max = max({c}_max, excluded.{c}_max)" for c in categories))
+
+
+def _add_to_stats_rollups(cur, username, stats):
+    cur.executemany(_rollup_upsert, [(username, width, row[0] // width * width, row[0],
+                                      *(v for v in row[1:] for _ in range(3)))
+                                     for row in stats for width in ROLLUP_WIDTHS])
+
+
+def _rebuild_stats_rollups(cur, username, date=None):
+    # all buckets of a user, or only the buckets containing date
+    for width in ROLLUP_WIDTHS:
+        if date is None:
+            cur.execute("DELETE FROM stats_rollup WHERE username = (?) AND width = (?)", (username, width))
+            where, inputs = "", ()
+        else:
+            bucket = date // width * width
+            cur.execute("DELETE FROM stats_rollup WHERE username = (?) AND width = (?) AND bucket = (?)",
+                        (username, width, bucket))
+            where, inputs = "AND date >= (?) AND date < (?) ", (bucket, bucket + width)
+        aggregates = ", ".join(f"SUM({c}), MIN({c}), MAX({c})" for c in categories)
+        cur.execute(f"INSERT INTO stats_rollup (username, width, bucket, n, date_sum, {_rollup_columns}) "
+                    f"SELECT username, {width}, date / {width} * {width}, COUNT(*), SUM(date), {aggregates} "
+                    f"FROM stats WHERE username = (?) {where}GROUP BY date / {width}", (username, *inputs))
+
+
+def get_stats_series(username, category, start, end, points):
+    # the finest resolution with at most ROLLUP_OVERSAMPLING * points rows between start and end,
+    # returns the bucket width (0 for raw rows) and rows of (date, value, min, max)
+    if category not in categories:
+        return 0, []
+    budget = points * ROLLUP_OVERSAMPLING
+    with db_connection(username, name="get_stats_series") as con:
+        cur = con.cursor()
+        n = cur.execute("SELECT COUNT(*) FROM stats WHERE username = (?) AND date BETWEEN (?) AND (?)",
+                        (username, start, end)).fetchone()[0]
+        if n <= budget:
+            return 0, cur.execute(f"SELECT date, {category}, {category}, {category} FROM stats "
+                                  f"WHERE username = (?) AND date BETWEEN (?) AND (?) ORDER BY date",
+                                  (username, start, end)).fetchall()
+        _ensure_stats_summaries(cur, username)
+        for width in ROLLUP_WIDTHS:
+            rows = cur.execute(f"SELECT date_sum / n, {category}_sum / n, {category}_min, {category}_max "
+                               f"FROM stats_rollup WHERE username = (?) AND width = (?) AND bucket BETWEEN (?) AND (?) "
+                               f"ORDER BY bucket LIMIT (?)", (username, width, start // width * width, end, budget + 1)
+                               ).fetchall()
+            if len(rows) <= budget:
+                break
+        return width, rows[:budget]
+
+
+def add_stats(username, date, weight, body_fat, water, muscles, wait=True):
+    # wait=False returns before the row is committed when WRITE_BEHIND is on
+    return _add_one(username, "stats", (date, weight, body_fat, water, muscles), wait)
+
+
+def add_stats_many(username, stats):
+    # inserts rows of (date, weight, body_fat, water, muscles) in one transaction, returns the number of new rows
+    if not stats:
+        return 0
+    with db_connection(username, name="add_stats_many") as con:
+        inserted = _insert_stats(con.cursor(), username, stats)
         con.commit()
+    view_cache.invalidate(username, "stats")
+    return inserted
+
+
+def _insert_stats(cur, username, stats):
+    stats = sorted(stats)
+    cur.executemany("INSERT OR IGNORE INTO stats (username, date, weight, body_fat, water, muscles) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", [(username, *row) for row in stats])
+    inserted = cur.rowcount
+    if inserted == len(stats):
+        if _update_stats_summaries(cur, username, stats):
+            _add_to_stats_rollups(cur, username, stats)
+    elif inserted:  # some dates already existed, there is no telling which rows were added
+        _rebuild_stats_summaries(cur, username)
+        _rebuild_stats_rollups(cur, username)
+    _changed(cur, username, "stats", stats if inserted == len(stats) else None if inserted else [])
+    return inserted
 
 
 def edit_stats(username, date, weight, body_fat, water, muscles):
-    with connect(DB) as con:
+    with db_connection(username, name="edit_stats") as con:
         cur = con.cursor()
-        cur.execute("UPDATE stats WHERE username = (?) AND date = (?) "
-                    "SET weight = (?), body_fat = (?), water = (?), muscles = (?)",
-                    (username, date, weight, body_fat, water, muscles))
+        cur.execute("UPDATE stats SET weight = (?), body_fat = (?), water = (?), muscles = (?) "
+                    "WHERE username = (?) AND date = (?)",
+                    (weight, body_fat, water, muscles, username, date))
+        changed = cur.rowcount == 1
+        _rewrite_stats_summaries(cur, username, date)
+        _changed(cur, username, "stats")
         con.commit()
+    view_cache.invalidate(username, "stats")
+    return changed
 
 
 def delete_stats(username, date):
-    with connect(DB) as con:
+    with db_connection(username, name="delete_stats") as con:
         cur = con.cursor()
         cur.execute("DELETE FROM stats WHERE username = (?) and date = (?)", (username, date))
+        changed = cur.rowcount == 1
+        _rewrite_stats_summaries(cur, username, date)
+        _changed(cur, username, "stats")
         con.commit()
+    view_cache.invalidate(username, "stats")
+    return changed
 
 
 def get_route_names(username):
-    with connect(DB) as con:
+    with db_connection(username, name="get_route_names") as con:
         cur = con.cursor()
         routes = cur.execute("SELECT route_name FROM routes WHERE username = (?)", (username,)).fetchall()
         routes = [r[0] for r in routes]  # routes are [("route1",),("route2"),...]
@@ -142,39 +764,128 @@ def get_routes(username, route_name=""):
     else:
         add = ""
     query = f"SELECT route_name, distance, height FROM routes WHERE username = (?) {add}ORDER BY route_name"
-    with connect(DB) as con:
+    with db_connection(username, name="get_routes") as con:
         cur = con.cursor()
         return cur.execute(query, inputs).fetchall()
 
 
 def get_route_details(username, route_name):
-    with connect(DB) as con:
+    with db_connection(username, name="get_route_details") as con:
         cur = con.cursor()
         return cur.execute("SELECT distance, height FROM routes WHERE username = (?) AND route_name = (?)",
                            (username, route_name)).fetchone()
 
 
-def add_route(username, route_name, distance, height):
-    with connect(DB) as con:
-        cur = con.cursor()
-        cur.execute("INSERT OR IGNORE INTO routes (username, route_name, distance, height) VALUES (?, ?, ?, ?)",
-                    (username, route_name, distance, height))
+def add_route(username, route_name, distance, height, wait=True):
+    return _add_one(username, "routes", (route_name, distance, height), wait)
+
+
+def add_routes_many(username, routes):
+    # inserts rows of (route_name, distance, height) in one transaction, returns the new row count
+    with db_connection(username, name="add_routes_many") as con:
+        inserted = _insert_routes(con.cursor(), username, routes)
         con.commit()
+    view_cache.invalidate(username, "routes")
+    return inserted
+
+
+def _insert_routes(cur, username, routes):
+    cur.executemany("INSERT OR IGNORE INTO routes (username, route_name, distance, height) VALUES (?, ?, ?, ?)",
+                    [(username, *row) for row in routes])
+    inserted = cur.rowcount
+    _changed(cur, username, "routes", routes if inserted == len(routes) else None if inserted else [])
+    return inserted
 
 
 def edit_route(username, route_name, distance, height):
-    with connect(DB) as con:
+    with db_connection(username, name="edit_route") as con:
         cur = con.cursor()
-        cur.execute("UPDATE routes WHERE username = (?) AND route_name = (?) SET distance = (?), height = (?)",
-                    (username, route_name, distance, height))
+        cur.execute("UPDATE routes SET distance = (?), height = (?) WHERE username = (?) AND route_name = (?)",
+                    (distance, height, username, route_name))
+        changed = cur.rowcount == 1
+        _changed(cur, username, "routes")
         con.commit()
+    view_cache.invalidate(username, "routes")
+    return changed
 
 
 def delete_route(username, route_name):
-    with connect(DB) as con:
+    with db_connection(username, name="delete_route") as con:
         cur = con.cursor()
         cur.execute("DELETE FROM routes WHERE username = (?) and route_name = (?)", (username, route_name))
+        changed = cur.rowcount == 1
+        cur.execute("DELETE FROM route_summary WHERE username = (?) and route_name = (?)", (username, route_name))
+        cur.execute("DELETE FROM route_geometry WHERE username = (?) and route_name = (?)", (username, route_name))
+        _changed(cur, username, "routes")
         con.commit()
+    view_cache.invalidate(username, "routes")
+    return changed
+
+
+def set_route_geometry(username, route_name, points):
+    # stores the simplified (lat, lon, ele) polyline of an existing route, returns False for unknown routes
+    points = simplify(points)
+    min_lat, max_lat, min_lon, max_lon = bounding_box(points)
+    with db_connection(username, name="set_route_geometry") as con:
+        cur = con.cursor()
+        if not cur.execute("SELECT 1 FROM routes WHERE username = (?) AND route_name = (?)",
+                           (username, route_name)).fetchone():
+            return False
+        row_id = cur.execute("INSERT INTO route_geometry (username, route_name, points, n) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (username, route_name) DO UPDATE SET points = excluded.points, "
+                             "n = excluded.n RETURNING id",
+                             (username, route_name, encode_points(points), len(points))).fetchone()[0]
+        cur.execute("INSERT OR REPLACE INTO route_bbox (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+                    (row_id, min_lat, max_lat, min_lon, max_lon))
+        _changed(cur, username, "routes")
+        con.commit()
+    view_cache.invalidate(username, "routes")
+    return True
+
+
+def get_route_geometry(username, route_name):
+    with db_connection(username, name="get_route_geometry") as con:
+        cur = con.cursor()
+        row = cur.execute("SELECT points FROM route_geometry WHERE username = (?) AND route_name = (?)",
+                          (username, route_name)).fetchone()
+    return decode_points(row[0]) if row else None
+
+
+def _routes_in_box(cur, username, min_lat, max_lat, min_lon, max_lon):
+    # (route_name, points) of the routes whose bounding box intersects the box, found with the r-tree
+    rows = cur.execute("SELECT g.route_name, g.points FROM route_bbox b JOIN route_geometry g ON g.id = b.id "
+                       "WHERE b.max_lat >= (?) AND b.min_lat <= (?) AND b.max_lon >= (?) AND b.min_lon <= (?) "
+                       "AND g.username = (?)", (min_lat, max_lat, min_lon, max_lon, username))
+    return [(route_name, decode_points(points)) for route_name, points in rows]
+
+
+def get_routes_near(username, lat, lon, radius):
+    # routes passing within radius meters of a position, closest first, as (route_name, meters)
+    d_lat, d_lon = meters_to_degrees(lat, radius)
+    with db_connection(username, name="get_routes_near") as con:
+        candidates = _routes_in_box(con.cursor(), username, lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon)
+    near = ((route_name, distance_to_path(lat, lon, points)) for route_name, points in candidates)
+    return sorted((r for r in near if r[1] <= radius), key=lambda r: r[1])
+
+
+def match_route(username, points):
+    # name of the user's route that a recorded track follows, or None
+    track = simplify(points, MATCH_TOLERANCE / 4)  # a coarser line is enough to compare, gps noise is dropped
+    min_lat, max_lat, min_lon, max_lon = bounding_box(track)
+    d_lat, d_lon = meters_to_degrees(max(abs(min_lat), abs(max_lat)), MATCH_TOLERANCE)
+    with db_connection(username, name="match_route") as con:
+        # a route of the same way has a bounding box inside the track's box grown by the tolerance
+        candidates = _routes_in_box(con.cursor(), username, min_lat - d_lat, max_lat + d_lat, min_lon - d_lon,
+                                    max_lon + d_lon)
+    best, best_share = None, MATCH_SHARE
+    for route_name, route in candidates:
+        r_min_lat, r_max_lat, r_min_lon, r_max_lon = bounding_box(route)
+        if r_min_lat < min_lat - d_lat or r_max_lat > max_lat + d_lat or r_min_lon < min_lon - d_lon or \
+                r_max_lon > max_lon + d_lon:
+            continue
+        if (share := similarity(track, route, least=best_share)) >= best_share:
+            best, best_share = route_name, share
+    return best
 
 
 def get_activities(username, route_name):
@@ -186,31 +897,230 @@ def get_activities(username, route_name):
         add = ""
     query = f"SELECT route_name, date, time, pace, speed, heart_rate FROM activities WHERE username = (?) {add}" \
             f"ORDER by date"
-    with connect(DB) as con:
+    with db_connection(username, name="get_activities") as con:
         cur = con.cursor()
         return cur.execute(query, inputs).fetchall()
 
 
-def add_activity(username, route_name, date, time, pace, speed, heart_rate):
-    with connect(DB) as con:
+def get_activities_page(username, route_name, after=None, limit=PAGE_SIZE):
+    # keyset pagination on (date, route_name), after is the (date, route_name) of the last row of the previous page
+    after = after or (-1, "")
+    if route_name != "":
+        query = "SELECT route_name, date, time, pace, speed, heart_rate FROM activities " \
+                "WHERE username = (?) AND route_name = (?) AND date > (?) ORDER BY date LIMIT (?)"
+        inputs = (username, route_name, after[0], limit + 1)
+    else:
+        query = "SELECT route_name, date, time, pace, speed, heart_rate FROM activities " \
+                "WHERE username = (?) AND (date, route_name) > (?, ?) ORDER BY date, route_name LIMIT (?)"
+        inputs = (username, *after, limit + 1)
+    with db_connection(username, name="get_activities_page") as con:
+        cur = con.cursor()
+        rows = cur.execute(query, inputs)
+        page = list(islice(rows, limit))
+        has_next = rows.fetchone() is not None
+    return page, (page[-1][1], page[-1][0]) if has_next else None
+
+
+def get_activities_by_period(username, period, tz, start=None, end=None, route_name=""):
+    # per calendar period in tz: (first day, start, activities, meters, seconds, meters climbed, average heart rate),
+    # empty periods included. every period is one range scan of activities_by_date, or of the primary key for a route
+    route_filter = "AND a.route_name = (?) " if route_name != "" else ""
+    with db_connection(username, name="get_activities_by_period") as con:
         cur = con.cursor()
-        cur.execute("INSERT OR IGNORE INTO activities (username, route_name, date, time, pace, speed, heart_rate) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (username, route_name, date, time, pace, speed, heart_rate))
+        bounds, periods = _periods(cur, "activities", username, period, tz, start, end)
+        rows = cur.execute("SELECT p.key, COUNT(a.date), COALESCE(SUM(r.distance), 0), COALESCE(SUM(a.time), 0), "
+                           "COALESCE(SUM(r.height), 0), AVG(NULLIF(a.heart_rate, 0)) FROM json_each(?) p "
+                           "LEFT JOIN activities a ON a.username = (?) AND a.date >= p.value ->> 0 "
+                           f"AND a.date < p.value ->> 1 {route_filter}"
+                           "LEFT JOIN routes r ON r.username = a.username AND r.route_name = a.route_name "
+                           "GROUP BY p.key ORDER BY p.key",
+                           (periods, username, *([route_name] if route_name != "" else []))).fetchall()
+    return [(bounds[i][0], bounds[i][1], *values) for i, *values in rows]
+
+
+def _save_route_summaries(cur, username, summaries):
+    fields = ", ".join(route_summary_fields)
+    placeholders = ", ".join("?" for _ in route_summary_fields)
+    cur.executemany(f"INSERT OR REPLACE INTO route_summary (username, route_name, {fields}) "
+                    f"VALUES (?, ?, {placeholders})",
+                    [(username, name, *encode_route_summary(s)) for name, s in summaries.items()])
+
+
+def _load_route_summary(cur, username, route_name):
+    row = cur.execute(f"SELECT {', '.join(route_summary_fields)} FROM route_summary "
+                      f"WHERE username = (?) AND route_name = (?)", (username, route_name)).fetchone()
+    return decode_route_summary(row) if row else None
+
+
+def _rebuild_route_summary(cur, username, route_name):
+    activities = cur.execute("SELECT date, time, pace, speed, heart_rate FROM activities "
+                             "WHERE username = (?) AND route_name = (?)", (username, route_name))
+    summary = summarize_route(activities)
+    _save_route_summaries(cur, username, {route_name: summary})
+    return summary
+
+
+def _update_route_summaries(cur, username, activities):
+    # activities are newly inserted rows of (route_name, date, time, pace, speed, heart_rate)
+    summaries, rebuilt = {}, set()
+    for route_name, *row in activities:
+        if route_name not in summaries:
+            summaries[route_name] = _load_route_summary(cur, username, route_name)
+            if summaries[route_name] is None:  # first activity, or history from before summaries existed
+                summaries[route_name] = _rebuild_route_summary(cur, username, route_name)  # includes the new rows
+                rebuilt.add(route_name)
+        if route_name not in rebuilt:
+            update_route_summary(summaries[route_name], *row)
+    _save_route_summaries(cur, username, {name: s for name, s in summaries.items() if name not in rebuilt})
+
+
+def get_route_summary(username, route_name):
+    with db_connection(username, name="get_route_summary") as con:
+        cur = con.cursor()
+        return _load_route_summary(cur, username, route_name) or _rebuild_route_summary(cur, username, route_name)
+
+
+def get_route_bests_since(username, route_name, since):
+    # (best pace, best speed, best time) since the given date, one range scan on the primary key
+    with db_connection(username, name="get_route_bests_since") as con:
+        cur = con.cursor()
+        return cur.execute("SELECT MIN(pace), MAX(speed), MIN(time) FROM activities "
+                           "WHERE username = (?) AND route_name = (?) AND date >= (?)",
+                           (username, route_name, since)).fetchone()
+
+
+def add_activity(username, route_name, date, time, pace, speed, heart_rate, wait=True):
+    return _add_one(username, "activities", (route_name, date, time, pace, speed, heart_rate), wait)
+
+
+def add_activities_many(username, activities):
+    # inserts rows of (route_name, date, time, pace, speed, heart_rate) in one transaction, returns the new row count
+    if not activities:
+        return 0
+    with db_connection(username, name="add_activities_many") as con:
+        inserted = _insert_activities(con.cursor(), username, activities)
         con.commit()
+    view_cache.invalidate(username, "activities")
+    return inserted
+
+
+def _insert_activities(cur, username, activities):
+    cur.executemany("INSERT OR IGNORE INTO activities (username, route_name, date, time, pace, speed, heart_rate) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", [(username, *row) for row in activities])
+    inserted = cur.rowcount
+    if inserted == len(activities):
+        _update_route_summaries(cur, username, activities)
+    elif inserted:  # some activities already existed, there is no telling which rows were added
+        for route_name in {a[0] for a in activities}:
+            _rebuild_route_summary(cur, username, route_name)
+    _changed(cur, username, "activities", activities if inserted == len(activities) else None if inserted else [])
+    return inserted
+
+
+_inserts = {"stats": _insert_stats, "routes": _insert_routes, "activities": _insert_activities}
+
+
+def _add_one(username, collection, row, wait):
+    # returns whether the row was new, or True right away for wait=False with write-behind
+    if _write_behind is None:
+        with db_connection(username, name="_add_one") as con:
+            inserted = _inserts[collection](con.cursor(), username, [row])
+            con.commit()
+        view_cache.invalidate(username, collection)
+        return inserted == 1
+    future = _write_behind.submit(username, (collection, row), urgent=wait)
+    view_cache.invalidate(username, collection)  # views computed from now on wait for the write, see db_connection
+    return future.result() if wait else True
+
+
+def _apply_writes(writes):
+    # group commit of queued (username, (collection, row)) writes, one transaction per db file
+    results = [None] * len(writes)
+    by_file = {}
+    for i, (username, _) in enumerate(writes):
+        by_file.setdefault(shard_file(username), []).append(i)
+    for indices in by_file.values():
+        try:
+            with db_connection(writes[indices[0]][0], name="_apply_writes") as con:
+                cur = con.cursor()
+                for i in indices:
+                    username, (collection, row) = writes[i]
+                    results[i] = _inserts[collection](cur, username, [row]) == 1
+        except Exception:  # one bad write must not fail the others, retry them one by one
+            for i in indices:
+                username, (collection, row) = writes[i]
+                try:
+                    with db_connection(username, name="_apply_writes") as con:
+                        results[i] = _inserts[collection](con.cursor(), username, [row]) == 1
+                except Exception as e:
+                    results[i] = e
+    for username, collection in {(username, collection) for username, (collection, _) in writes}:
+        view_cache.invalidate(username, collection)
+    return results
+
+
+_write_behind = WriteBehind(_apply_writes, WRITE_BEHIND_QUEUE, WRITE_BEHIND_LATENCY, WRITE_BEHIND_BATCH) \
+    if WRITE_BEHIND else None
 
 
 def edit_activity(username, route_name, date, time, pace, speed, heart_rate):
-    with connect(DB) as con:
+    with db_connection(username, name="edit_activity") as con:
         cur = con.cursor()
-        cur.execute("UPDATE activities WHERE username = (?) AND route_name = (?) AND date = (?) "
-                    "SET time = (?), pace = (?), speed = (?), heart_rate = (?)",
-                    (username, route_name, date, time, pace, speed, heart_rate))
+        cur.execute("UPDATE activities SET time = (?), pace = (?), speed = (?), heart_rate = (?) "
+                    "WHERE username = (?) AND route_name = (?) AND date = (?)",
+                    (time, pace, speed, heart_rate, username, route_name, date))
+        changed = cur.rowcount == 1
+        _rebuild_route_summary(cur, username, route_name)
+        _changed(cur, username, "activities")
         con.commit()
+    view_cache.invalidate(username, "activities")
+    return changed
 
 
 def delete_activity(username, route_name, date):
-    with connect(DB) as con:
+    with db_connection(username, name="delete_activity") as con:
         cur = con.cursor()
         cur.execute("DELETE FROM activities WHERE username = (?) AND route_name = (?) AND date = (?)",
                     (username, route_name, date))
+        changed = cur.rowcount == 1
+        _rebuild_route_summary(cur, username, route_name)
+        _changed(cur, username, "activities")
         con.commit()
+    view_cache.invalidate(username, "activities")
+    return changed
+
+
+def _iter_rows(name, query, inputs, after, key):
+    # reads EXPORT_CHUNK rows at a time from after, key(row) gives the after of the next chunk. the pooled connection
+    # and its read transaction are given back while the rows are sent. query takes inputs, then after and the limit
+    while True:
+        with db_connection(inputs[0], name=name) as con:  # inputs start with the username
+            rows = con.execute(query, (*inputs, *after, EXPORT_CHUNK)).fetchall()
+        yield from rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        after = key(rows[-1])
+
+
+# sqlite seeks to only one lower bound of a column, the chunks start at the later of from and after so that every
+# chunk is a seek instead of a scan from the first row in range
+def iter_stats(username, start=0, end=2**62, after=None):
+    return _iter_rows("iter_stats", "SELECT date, weight, body_fat, water, muscles FROM stats "
+                      "WHERE username = (?) AND date <= (?) AND date >= (?) ORDER BY date LIMIT (?)",
+                      (username, end), (start if after is None else max(start, after + 1),),
+                      lambda row: (row[0] + 1,))
+
+
+def iter_routes(username, after=None):
+    return _iter_rows("iter_routes", "SELECT route_name, distance, height FROM routes "
+                      "WHERE username = (?) AND route_name > (?) ORDER BY route_name LIMIT (?)", (username,),
+                      (after or "",), lambda row: row[:1])
+
+
+def iter_activities(username, start=0, end=2**62, after=None):
+    # after is the (date, route_name) of the last row already received
+    after = after or (-1, "")
+    return _iter_rows("iter_activities", "SELECT route_name, date, time, pace, speed, heart_rate FROM activities "
+                      "WHERE username = (?) AND date <= (?) AND date >= (?) AND (date, route_name) > (?, ?) "
+                      "ORDER BY date, route_name LIMIT (?)", (username, end), (max(start, after[0]), *after),
+                      lambda row: (row[1], row[1], row[0]))
@@ -0,0 +1,27 @@
+def lttb(xs, ys, threshold):
+    # largest triangle three buckets, returns the indices of the points to keep
+    n = len(xs)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1][:max(threshold, 0)]
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        # the average of the next bucket is the third corner of the triangle
+        next_xs, next_ys = xs[end:next_end] or [xs[-1]], ys[end:next_end] or [ys[-1]]
+        avg_x, avg_y = sum(next_xs) / len(next_xs), sum(next_ys) / len(next_ys)
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
@@ -0,0 +1,116 @@
+import json
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+from os import environ, getpid
+from threading import Condition, Lock, Thread
+from time import sleep
+
+EVENTS_POLL = float(environ.get("EVENTS_POLL_MS", 250)) / 1000  # seconds until a write reaches the open pages
+EVENTS_KEEPALIVE = float(environ.get("EVENTS_KEEPALIVE", 15))  # seconds between comments on an idle connection
+EVENTS_MAX_AGE = float(environ.get("EVENTS_MAX_AGE", 300))  # seconds until a page reconnects, so reloads can finish
+# open live pages per worker, gunicorn.conf.py lowers it for workers with a thread per connection. 0 disables them
+EVENTS_MAX_STREAMS = int(environ.get("EVENTS_MAX_STREAMS", 100))
+EVENTS_BUFFER = 64  # events queued per connection, a page that falls further behind reloads
+
+log = getLogger(__name__)
+
+
+class Subscription:
+    # the events of one open page. gevent workers patch the condition, so idle pages cost no thread
+    def __init__(self, username):
+        self.username = username
+        self.events = deque()
+        self.ready = Condition()
+
+    def put(self, event):
+        with self.ready:
+            if len(self.events) >= EVENTS_BUFFER:
+                self.events.clear()
+                event = (*event[:2], None)  # no rows, the page reloads
+            self.events.append(event)
+            self.ready.notify()
+
+    def get(self, timeout):
+        # (collection, version, rows) or None after timeout seconds without an event
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.events, timeout):
+                return None
+            return self.events.popleft()
+
+
+class Channels:
+    # a channel per user. writes are logged in the db file of the user, see db._changed, one thread per process
+    # reads the new events of the files with open pages and hands them to the subscriptions of the user
+    def __init__(self, fetch, file_of):
+        self.fetch = fetch  # (username, after seq) -> (last seq, [(seq, username, collection, version, rows)])
+        self.file_of = file_of  # username -> db file, users in one file are polled together
+        self.subscribers = {}  # username -> {Subscription}
+        self.last_seq = {}  # db file -> last event handed out
+        self.lock = Lock()
+        self.thread = self.pid = None
+
+    def _start(self):
+        if self.pid != getpid():  # first page of this (possibly forked) process
+            self.subscribers, self.last_seq, self.pid = {}, {}, getpid()
+            self.thread = Thread(target=self._run, daemon=True, name="live-events")
+            self.thread.start()
+
+    @contextmanager
+    def subscribe(self, username):
+        # events written from now on, older ones are read with db.get_events
+        db_file, subscription = self.file_of(username), Subscription(username)
+        with self.lock:
+            self._start()
+            self.subscribers.setdefault(username, set()).add(subscription)
+            known = db_file in self.last_seq
+        try:
+            if not known:
+                last_seq, _ = self.fetch(username, None)
+                with self.lock:
+                    self.last_seq.setdefault(db_file, last_seq)
+            yield subscription
+        finally:
+            with self.lock:
+                subscriptions = self.subscribers.get(username, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.subscribers.pop(username, None)
+
+    def connections(self):
+        with self.lock:
+            return sum(map(len, self.subscribers.values()))
+
+    def _poll(self):
+        with self.lock:
+            files = {}
+            for username in self.subscribers:
+                files.setdefault(self.file_of(username), username)
+            for db_file in list(self.last_seq):
+                if db_file not in files:  # no open pages, start from the latest event when one opens again
+                    del self.last_seq[db_file]
+        for db_file, username in files.items():
+            after = self.last_seq.get(db_file)
+            if after is None:
+                continue  # its subscribe() is reading the last seq
+            last_seq, events = self.fetch(username, after)
+            with self.lock:
+                self.last_seq[db_file] = last_seq
+                for _, name, collection, version, rows in events:
+                    for subscription in self.subscribers.get(name, ()):
+                        subscription.put((collection, version, rows))
+
+    def _run(self):
+        while True:
+            sleep(EVENTS_POLL)
+            if not self.subscribers:
+                continue
+            try:
+                self._poll()
+            except Exception:  # a locked or dropped db file must not end the live updates of everyone
+                log.exception("reading live update events failed")
+
+
+def sse(event, data):
+    # one server-sent event of json data
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,130 @@
+import csv
+import json
+import sys
+from argparse import ArgumentParser
+from io import StringIO
+from itertools import islice
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None  # parquet exports are disabled without pyarrow
+
+from db import db_init, iter_activities, iter_routes, iter_stats
+
+CHUNK_ROWS = 1000        # rows per yielded csv / ndjson chunk
+ROW_GROUP_ROWS = 10_000  # rows per parquet row group
+export_formats = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+export_columns = {
+    "stats": [("date", "int64"), ("weight", "float64"), ("body_fat", "float64"), ("water", "float64"),
+              ("muscles", "float64")],
+    "routes": [("route_name", "string"), ("distance", "int64"), ("height", "int64")],
+    "activities": [("route_name", "string"), ("date", "int64"), ("time", "int64"), ("pace", "float64"),
+                   ("speed", "float64"), ("heart_rate", "int64")],
+}
+
+
+def export_rows(username, table, start=0, end=2**62, after=None, after_route=""):
+    # after resumes an interrupted export: the last date received (stats, activities) or route name (routes)
+    if table == "stats":
+        return iter_stats(username, start, end, None if after is None else int(after))
+    if table == "routes":
+        return iter_routes(username, after)
+    return iter_activities(username, start, end, None if after is None else (int(after), after_route))
+
+
+def to_csv(table, rows):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(c for c, _ in export_columns[table])
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_ndjson(table, rows):
+    columns = [c for c, _ in export_columns[table]]
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(columns, row))) + "\n")
+        if len(chunk) == CHUNK_ROWS:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
+
+
+class _Sink:
+    # file object for pyarrow, keeps written bytes until they are handed to the response
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def to_parquet(table, rows):
+    schema = pa.schema([(c, getattr(pa, t)()) for c, t in export_columns[table]])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema)
+    while chunk := list(islice(rows, ROW_GROUP_ROWS)):
+        writer.write_table(pa.Table.from_arrays([pa.array(column, field.type)
+                                                 for column, field in zip(zip(*chunk), schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+serializers = {"csv": to_csv, "ndjson": to_ndjson, "parquet": to_parquet}
+
+
+def format_available(export_format):
+    return export_format in serializers and (export_format != "parquet" or pq is not None)
+
+
+def main():
+    parser = ArgumentParser(description="export stats, routes or activities of a user")
+    parser.add_argument("username")
+    parser.add_argument("table", choices=export_columns.keys())
+    parser.add_argument("format", choices=serializers.keys())
+    parser.add_argument("-o", "--output", help="file to write, stdout if omitted")
+    parser.add_argument("--from", dest="start", type=int, default=0, help="epoch timestamp")
+    parser.add_argument("--to", dest="end", type=int, default=2**62, help="epoch timestamp")
+    parser.add_argument("--after", help="resume after this date (or route name for routes)")
+    parser.add_argument("--after-route", default="", help="route name of the last activity received")
+    args = parser.parse_args()
+    if not format_available(args.format):
+        parser.error("parquet exports need the pyarrow package")
+    db_init()
+    rows = export_rows(args.username, args.table, args.start, args.end, args.after, args.after_route)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    with out:
+        for chunk in serializers[args.format](args.table, rows):
+            out.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+from math import asin, cos, hypot, radians, sin, sqrt
+
+EARTH_RADIUS = 6_371_000  # meters
+COORD_SCALE = 1_000_000   # lat/lon are stored in millionths of a degree, about 0.1 m
+ELE_SCALE = 10            # elevation is stored in decimeters
+SIMPLIFY_TOLERANCE = 5    # meters a simplified route may deviate from the recorded track
+ASCENT_HYSTERESIS = 2     # meters, gps elevation noise below this is not counted as climbing
+MATCH_TOLERANCE = 50      # meters between a track and a route that is the same way
+MATCH_SHARE = 0.9         # share of points of both lines that have to be close to the other one
+MATCH_SAMPLES = 64        # points per line compared when matching
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # great circle distance in meters
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+def path_length(points):
+    # haversine over all consecutive (lat, lon, ele) points, radians and cosines are computed once per point
+    lats = [radians(p[0]) for p in points]
+    lons = [radians(p[1]) for p in points]
+    cos_lats = list(map(cos, lats))
+    return 2 * EARTH_RADIUS * sum(
+        asin(sqrt(sin((lat2 - lat1) / 2) ** 2 + c1 * c2 * sin((lon2 - lon1) / 2) ** 2))
+        for lat1, lat2, lon1, lon2, c1, c2 in zip(lats, lats[1:], lons, lons[1:], cos_lats, cos_lats[1:]))
+
+
+def ascent(points):
+    # meters climbed, a climb only counts once it exceeds ASCENT_HYSTERESIS above the last low point
+    total, base = 0.0, None
+    for _, _, ele in points:
+        if ele is None:
+            continue
+        if base is None or ele < base:
+            base = ele
+        elif ele - base >= ASCENT_HYSTERESIS:
+            total += ele - base
+            base = ele
+    return total
+
+
+def _projection(lat0, lon0):
+    # local equirectangular projection to meters, exact enough for the extent of a running route
+    scale_x = radians(1) * EARTH_RADIUS * cos(radians(lat0))
+    scale_y = radians(1) * EARTH_RADIUS
+    return lambda lat, lon: ((lon - lon0) * scale_x, (lat - lat0) * scale_y)
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, ((px - ax) * dx + (py - ay) * dy) / length))
+    x, y = ax + t * dx - px, ay + t * dy - py
+    return sqrt(x * x + y * y)
+
+
+def simplify(points, tolerance=SIMPLIFY_TOLERANCE):
+    # douglas-peucker, keeps the points that deviate more than tolerance meters from the simplified line
+    if len(points) < 3:
+        return list(points)
+    project = _projection(points[0][0], points[0][1])
+    xs, ys = zip(*(project(p[0], p[1]) for p in points))
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay, bx, by = xs[first], ys[first], xs[last], ys[last]
+        dx, dy = bx - ax, by - ay
+        norm = sqrt(dx * dx + dy * dy)
+        if norm:  # distance to the line through a and b, scaled by its length so no division per point
+            c = bx * ay - by * ax
+            distances = [abs(dy * px - dx * py + c) for px, py in zip(xs[first + 1:last], ys[first + 1:last])]
+        else:  # a loop, distance to its start
+            distances = [hypot(px - ax, py - ay) for px, py in zip(xs[first + 1:last], ys[first + 1:last])]
+            norm = 1
+        worst_distance = max(distances)
+        if worst_distance > tolerance * norm:
+            worst = first + 1 + distances.index(worst_distance)
+            keep[worst] = True
+            stack += [(first, worst), (worst, last)]
+    return [p for p, k in zip(points, keep) if k]
+
+
+def bounding_box(points):
+    lats, lons = [p[0] for p in points], [p[1] for p in points]
+    return min(lats), max(lats), min(lons), max(lons)
+
+
+def encode_points(points):
+    # delta coded fixed point int32 triples, zlib compressed. missing elevations are stored as 0
+    values = array("i", (round(v * scale) for lat, lon, ele in points
+                         for v, scale in ((lat, COORD_SCALE), (lon, COORD_SCALE), (ele or 0, ELE_SCALE))))
+    deltas = array("i", (v - values[i - 3] if i >= 3 else v for i, v in enumerate(values)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return zlib.compress(deltas.tobytes())
+
+
+def decode_points(blob):
+    deltas = array("i")
+    deltas.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    lats, lons, eles = (accumulate(deltas[k::3]) for k in range(3))
+    return [(lat / COORD_SCALE, lon / COORD_SCALE, ele / ELE_SCALE) for lat, lon, ele in zip(lats, lons, eles)]
+
+
+def _sample(points, n):
+    step = max(len(points) / n, 1)
+    return [points[int(i * step)] for i in range(min(n, len(points)))]
+
+
+def distance_to_path(lat, lon, points):
+    # meters from a position to the closest segment of a polyline
+    project = _projection(lat, lon)
+    xy = [project(p[0], p[1]) for p in points]
+    if len(xy) == 1:
+        return sqrt(xy[0][0] ** 2 + xy[0][1] ** 2)
+    return min(_segment_distance(0, 0, *a, *b) for a, b in zip(xy, xy[1:]))
+
+
+def _share_close(points, path_xy, project, tolerance, least):
+    # share of sampled points within tolerance of the path, 0 as soon as it cannot reach least
+    segments = list(zip(path_xy, path_xy[1:])) or [(path_xy[0], path_xy[0])]
+    samples = _sample(points, MATCH_SAMPLES)
+    misses_allowed, close = len(samples) * (1 - least), 0
+    for k, (lat, lon, _) in enumerate(samples):
+        px, py = project(lat, lon)
+        if any(_segment_distance(px, py, *a, *b) <= tolerance for a, b in segments):
+            close += 1
+        elif k + 1 - close > misses_allowed:
+            return 0
+    return close / len(samples)
+
+
+def similarity(track, route, tolerance=MATCH_TOLERANCE, least=0):
+    # share of sampled points of either line within tolerance of the other line, a partial overlap scores low.
+    # scores below least are returned as 0 without comparing all points
+    project = _projection(route[0][0], route[0][1])
+    route_xy = [project(p[0], p[1]) for p in route]
+    track_xy = [project(p[0], p[1]) for p in track]
+    share = _share_close(track, route_xy, project, tolerance, least)
+    return share and min(share, _share_close(route, track_xy, project, tolerance, least))
+
+
+def meters_to_degrees(lat, meters):
+    # (lat, lon) degrees covering at least meters around lat, for bounding box queries
+    return meters / (radians(1) * EARTH_RADIUS), meters / (radians(1) * EARTH_RADIUS * max(cos(radians(lat)), 0.01))
@@ -0,0 +1,63 @@
+# production server profile, start with `gunicorn -c gunicorn.conf.py app:app` (see start_server.sh).
+# kill -HUP <master pid> replaces the workers one generation at a time without dropping requests
+import sys
+from multiprocessing import cpu_count
+from os import environ
+
+from gunicorn.arbiter import Arbiter
+
+bind = environ.get("BIND", "0.0.0.0:9900")
+workers = int(environ.get("WEB_CONCURRENCY", cpu_count()))
+worker_class = environ.get("WORKER_CLASS", "gthread")  # sync, gthread or gevent (needs gevent)
+threads = int(environ.get("WORKER_THREADS", 4))        # per worker with gthread
+worker_connections = int(environ.get("WORKER_CONNECTIONS", 1000))  # per worker with gevent
+preload_app = environ.get("PRELOAD", "1") == "1"
+timeout = int(environ.get("WORKER_TIMEOUT", 60))
+graceful_timeout = int(environ.get("GRACEFUL_TIMEOUT", 30))  # seconds a stopping worker has to finish its requests
+keepalive = 5
+max_requests = int(environ.get("MAX_REQUESTS", 0))  # recycle workers after this many requests, 0 never
+max_requests_jitter = max_requests // 10
+# open live pages per worker (see events.py). each holds a thread of a gthread worker, half of them are kept for
+# requests and /health, sync workers have none to spare
+environ.setdefault("EVENTS_MAX_STREAMS", str({"gthread": threads // 2, "sync": 0}.get(worker_class,
+                                                                                    worker_connections // 2)))
+
+if workers > 1:
+    # a cached table must see the writes handled by the other workers, see cache.py
+    environ.setdefault("VIEW_CACHE_SHARED", "1")
+    if environ.get("WRITE_BEHIND", "0") == "1":  # queued writes are only known to the worker that queued them
+        sys.exit("WRITE_BEHIND=1 loses read-your-writes across workers, run it with WEB_CONCURRENCY=1")
+
+
+def pre_fork(server, worker):
+    # a preloaded app must not hand open sqlite handles to its workers
+    import db
+    db.db_close()
+
+
+def post_fork(server, worker):
+    # backups run in one worker, which holds the lock of backup.py, not in the master of a preloaded app where the
+    # last_backup gauge would never reach /metrics
+    from backup import start_backup_thread
+    start_backup_thread()
+
+
+def post_worker_init(worker):
+    # startup health check, a worker that cannot serve /health stops the server instead of serving errors
+    with worker.wsgi.test_client() as client:
+        response = client.get("/health")
+    if response.status_code != 200:
+        worker.log.error("health check failed: %s", response.get_data(as_text=True))
+        sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+def on_reload(server):
+    server.log.info("reloading workers%s", ", code is not reloaded with PRELOAD=1" if preload_app else "")
+
+
+def worker_exit(server, worker):
+    # queued writes are committed before the worker is gone
+    import db
+    if db._write_behind is not None:
+        db._write_behind.close()
+    db.db_close()
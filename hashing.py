@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import pbkdf2_hmac
+from hmac import compare_digest
+from os import O_CREAT, O_EXCL, O_WRONLY, environ, getpid, link, open as os_open, remove
+from secrets import token_bytes
+from threading import BoundedSemaphore
+
+from metrics import timed
+
+LEGACY_ITERATIONS = 2**18  # hashes stored without an iteration prefix
+HASH_ITERATIONS = int(environ.get("HASH_ITERATIONS", LEGACY_ITERATIONS))
+HASH_WORKERS = int(environ.get("HASH_WORKERS", 2))           # concurrent pbkdf2 computations per worker process
+HASH_QUEUE_DEPTH = int(environ.get("HASH_QUEUE_DEPTH", 8))   # hashes allowed to wait for a free hash worker
+SECRET_KEY_FILE = environ.get("SECRET_KEY_FILE", "secret_key")
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_executor = None
+_executor_pid = None
+_slots = BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_DEPTH)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor_pid != getpid():  # threads do not survive a fork, start a fresh pool in every gunicorn worker
+        _executor, _executor_pid = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash"), getpid()
+    return _executor
+
+
+def _pbkdf2(password: str, salt: str, iterations: int) -> str:
+    return pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations).hex()
+
+
+@timed("hash")
+def h(password: str, salt: str, iterations: int) -> str:
+    # runs on the hash pool so a burst of logins cannot occupy every request thread
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy("Server busy, try again later")
+    try:
+        future = _get_executor().submit(_pbkdf2, password, salt, iterations)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
+
+
+def encode_hash(hashed_pw: str, iterations: int) -> str:
+    if iterations == LEGACY_ITERATIONS:
+        return hashed_pw
+    return f"{iterations}${hashed_pw}"
+
+
+def decode_hash(stored: str) -> (str, int):
+    if "$" not in stored:
+        return stored, LEGACY_ITERATIONS
+    iterations, hashed_pw = stored.split("$", 1)
+    return hashed_pw, int(iterations)
+
+
+def hash_password(password: str, salt: str) -> str:
+    return encode_hash(h(password, salt, HASH_ITERATIONS), HASH_ITERATIONS)
+
+
+def verify_password(password: str, salt: str, stored: str) -> (bool, bool):
+    # returns (password ok, stored hash should be upgraded to HASH_ITERATIONS)
+    hashed_pw, iterations = decode_hash(stored)
+    ok = compare_digest(h(password, salt, iterations), hashed_pw)
+    return ok, ok and iterations != HASH_ITERATIONS
+
+
+def load_secret_key():
+    # SECRET_KEY, or a key created once in SECRET_KEY_FILE, so sessions survive restarts and work on every worker
+    if key := environ.get("SECRET_KEY"):
+        return key
+    try:
+        with open(SECRET_KEY_FILE, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    tmp_file = f"{SECRET_KEY_FILE}.{getpid()}"
+    with open(os_open(tmp_file, O_WRONLY | O_CREAT | O_EXCL, 0o600), "wb") as f:
+        f.write(token_bytes(32))
+    try:
+        link(tmp_file, SECRET_KEY_FILE)  # atomic, of workers starting at the same time the first one wins
+    except FileExistsError:
+        pass
+    finally:
+        remove(tmp_file)
+    with open(SECRET_KEY_FILE, "rb") as f:
+        return f.read()
@@ -0,0 +1,275 @@
+import csv
+from argparse import ArgumentParser
+from datetime import datetime
+from io import TextIOWrapper
+from itertools import islice
+from os import path
+from resource import RUSAGE_SELF, getrusage
+from string import ascii_letters, digits
+from time import perf_counter
+from xml.etree.ElementTree import ParseError, iterparse
+
+try:
+    from fitparse import FitFile
+except ImportError:
+    FitFile = None  # FIT imports are disabled without fitparse
+
+from db import add_activities_many, add_route, add_stats_many, check_save_query_input, db_init, get_route_details, \
+    match_route, set_route_geometry
+from geo import ascent, path_length, simplify
+from utils import activity_metrics, check_activity_values, check_stats_values
+
+BATCH_SIZE = 5000  # rows per transaction
+MAX_REPORTED_ERRORS = 20
+date_formats = ["%d-%m-%Y", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+import_kinds = ["stats", "activities"]
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.errors = []
+        self.error_count = 0
+        self.seconds = 0.0
+
+    def error(self, where, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"{where}: {message}")
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        peak_mb = getrusage(RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KiB on linux
+        return f"{self.rows} rows, {self.inserted} new, {self.error_count} invalid, " \
+               f"{self.rows_per_sec:.0f} rows/sec, peak rss {peak_mb:.1f} MB"
+
+
+def parse_import_date(value):
+    value = (value or "").strip()
+    if value.isdigit():
+        return int(value)  # epoch timestamp
+    for date_format in date_formats:
+        try:
+            return int(datetime.strptime(value, date_format).timestamp())
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown date '{value}'")
+
+
+def route_name_from(name):
+    name = "".join(c if c in ascii_letters + digits + "-_" else "_" for c in name.strip())
+    return name[:64] or "imported"
+
+
+def read_stats_csv(lines):
+    # yields (line number, (date, weight, body_fat, water, muscles) or None, error)
+    for line, row in enumerate(csv.DictReader(lines), start=2):
+        weight, body_fat, water, muscles = row.get("weight"), row.get("body_fat"), row.get("water"), row.get("muscles")
+        ok, err = check_stats_values(weight, body_fat, water, muscles)
+        if not ok:
+            yield line, None, err
+            continue
+        try:
+            date = parse_import_date(row.get("date"))
+        except ValueError as e:
+            yield line, None, str(e)
+            continue
+        yield line, (date, float(weight), float(body_fat), float(water), float(muscles)), ""
+
+
+def read_activities_csv(lines):
+    # yields (line number, activity dict or None, error), distance and height are only needed for new routes
+    for line, row in enumerate(csv.DictReader(lines), start=2):
+        route_name, time_min, time_sec = row.get("route_name"), row.get("time_min"), row.get("time_sec") or "0"
+        heart_rate = row.get("heart_rate")
+        ok, err = check_activity_values(route_name, time_min, time_sec, heart_rate)
+        if not ok:
+            yield line, None, err
+            continue
+        try:
+            date = parse_import_date(row.get("date"))
+            distance = int(float(row["distance"])) if row.get("distance") else None
+            height = int(float(row["height"])) if row.get("height") else 0
+        except ValueError as e:
+            yield line, None, str(e)
+            continue
+        yield line, dict(route_name=route_name, date=date, time_sec=60 * int(time_min) + int(time_sec),
+                         heart_rate=int(heart_rate), distance=distance, height=height), ""
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]  # drop the xml namespace
+
+
+def read_gpx(file, default_name):
+    # yields one activity per track with its (lat, lon, ele) points, elements are dropped as soon as they are read
+    track = None
+    for event, element in iterparse(file, events=("start", "end")):
+        tag = _local_name(element.tag)
+        if event == "start":
+            if tag == "trk":
+                track = dict(name=None, points=[], start=None, end=None, hr_sum=0, hr_n=0)
+            continue
+        if track is None:
+            element.clear()
+            continue
+        if tag == "name" and track["name"] is None and not track["points"]:
+            track["name"] = element.text or ""
+        elif tag == "hr" and element.text:
+            track["hr_sum"] += int(float(element.text))
+            track["hr_n"] += 1
+        elif tag == "trkpt":
+            lat, lon = float(element.get("lat")), float(element.get("lon"))
+            ele = time = None
+            for child in element.iter():
+                child_tag = _local_name(child.tag)
+                if child_tag == "ele" and child.text:
+                    ele = float(child.text)
+                elif child_tag == "time" and child.text:
+                    time = datetime.fromisoformat(child.text.replace("Z", "+00:00")).timestamp()
+            track["points"].append((lat, lon, ele))
+            if time is not None:
+                track["start"] = track["start"] or time
+                track["end"] = time
+            element.clear()
+        elif tag == "trk":
+            points = track["points"]
+            if len(points) < 2 or track["start"] is None:
+                yield 0, None, "Track has no timed points"
+            else:
+                yield 0, dict(route_name=route_name_from(track["name"] or default_name), date=int(track["start"]),
+                              time_sec=int(track["end"] - track["start"]),
+                              heart_rate=round(track["hr_sum"] / track["hr_n"]) if track["hr_n"] else 0,
+                              distance=int(path_length(points)), height=int(ascent(points)),
+                              points=simplify(points)), ""
+            track = None
+            element.clear()
+
+
+def read_gpx_track(file):
+    # (lat, lon, ele) points of the first track of a gpx file, for routes drawn from a recorded run
+    points = []
+    for event, element in iterparse(file, events=("end",)):
+        tag = _local_name(element.tag)
+        if tag == "trkpt":
+            ele = next((float(child.text) for child in element.iter()
+                        if _local_name(child.tag) == "ele" and child.text), None)
+            points.append((float(element.get("lat")), float(element.get("lon")), ele))
+            element.clear()  # children end before their point, so only points are cleared
+        elif tag == "trk" and points:
+            break
+    return points
+
+
+def read_fit(file, default_name):
+    if FitFile is None:
+        yield 0, None, "FIT imports need the fitparse package"
+        return
+    for session in FitFile(file).get_messages("session"):
+        values = session.get_values()
+        if not values.get("start_time") or not values.get("total_elapsed_time"):
+            yield 0, None, "Session without start time or duration"
+            continue
+        yield 0, dict(route_name=route_name_from(default_name), date=int(values["start_time"].timestamp()),
+                      time_sec=int(values["total_elapsed_time"]), heart_rate=int(values.get("avg_heart_rate") or 0),
+                      distance=int(values.get("total_distance") or 0), height=int(values.get("total_ascent") or 0)), ""
+
+
+def _valid_rows(parsed, report, where):
+    for line, row, err in parsed:
+        if row is None:
+            report.error(f"{where}:{line}", err)
+        else:
+            yield line, row
+
+
+def _batches(parsed, report, where):
+    valid = _valid_rows(parsed, report, where)
+    while batch := list(islice(valid, BATCH_SIZE)):
+        report.rows += len(batch)
+        yield batch
+
+
+def import_stats(username, parsed, report, where):
+    for batch in _batches(parsed, report, where):
+        report.inserted += add_stats_many(username, [row for _, row in batch])
+
+
+def import_activities(username, parsed, report, where):
+    routes = {}  # route name -> (distance, height), looked up once per import
+    for batch in _batches(parsed, report, where):
+        activities = []
+        for line, a in batch:
+            if a.get("points"):  # gpx tracks belong to the route they follow, whatever the track is called
+                a["route_name"] = match_route(username, a["points"]) or a["route_name"]
+            route_name = a["route_name"]
+            if route_name not in routes:
+                if not check_save_query_input(route_name):
+                    report.error(f"{where}:{line}", "Route Name can only contain Letters, Numbers and '-_'.")
+                    continue
+                if (details := get_route_details(username, route_name)) is None and a["distance"]:
+                    add_route(username, route_name, a["distance"], a["height"])
+                    if a.get("points"):
+                        set_route_geometry(username, route_name, a["points"])
+                    details = (a["distance"], a["height"])
+                routes[route_name] = details
+            if routes[route_name] is None:
+                report.error(f"{where}:{line}", f"Unknown route '{route_name}', add distance and height columns")
+                continue
+            distance, height = routes[route_name]
+            if a["time_sec"] <= 0 or distance + 10 * height <= 0:
+                report.error(f"{where}:{line}", "Time and Distance must be positive")
+                continue
+            time_sec, pace, speed = activity_metrics(*divmod(a["time_sec"], 60), distance, height)
+            activities.append((route_name, a["date"], time_sec, pace, speed, a["heart_rate"]))
+        report.inserted += add_activities_many(username, activities)
+
+
+def import_file(username, kind, filename, stream, report=None):
+    # stream is a binary file object, csv files hold either stats or activities, gpx and fit files hold activities
+    report = report or ImportReport()
+    start = perf_counter()
+    name, extension = path.splitext(path.basename(filename))
+    extension = extension.lower()
+    try:
+        if extension == ".csv":
+            lines = TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+            if kind == "stats":
+                import_stats(username, read_stats_csv(lines), report, filename)
+            else:
+                import_activities(username, read_activities_csv(lines), report, filename)
+        elif extension == ".gpx":
+            import_activities(username, read_gpx(stream, name), report, filename)
+        elif extension == ".fit":
+            import_activities(username, read_fit(stream, name), report, filename)
+        else:
+            report.error(filename, "Only .csv, .gpx and .fit files can be imported")
+    except (ParseError, TypeError, ValueError) as e:  # broken xml, missing attributes, bad numbers, dates or bytes
+        # rows of batches before the error are kept, like those of the other files
+        report.error(filename, f"Cannot read the file: {e}")
+    report.seconds += perf_counter() - start
+    return report
+
+
+def main():
+    parser = ArgumentParser(description="bulk import stats or activities for a user")
+    parser.add_argument("username")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--kind", choices=import_kinds, default="activities", help="content of csv files")
+    args = parser.parse_args()
+    db_init()
+    report = ImportReport()
+    for filename in args.files:
+        with open(filename, "rb") as f:
+            import_file(args.username, args.kind, filename, f, report)
+    for error in report.errors:
+        print(error)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+from bisect import bisect_left
+from cProfile import Profile
+from contextvars import ContextVar
+from functools import wraps
+from io import StringIO
+from logging import getLogger
+from os import environ, getpid
+from pstats import Stats
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, before_render_template, g, request, template_rendered
+
+SLOW_QUERY_MS = float(environ.get("SLOW_QUERY_MS", 100))
+PROFILING = environ.get("PROFILING", "0") == "1"  # allows ?profile=1 on any request
+METRICS_TOKEN = environ.get("METRICS_TOKEN", "")   # if set, /metrics needs ?token=
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
+phases = ["db", "hash", "format", "render"]
+
+log = getLogger(__name__)
+_phase_times = ContextVar("phase_times", default=None)  # phase -> seconds of the current request
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+        self.lock = Lock()
+
+    def observe(self, seconds, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * (len(BUCKETS) + 2) + [0.0])
+            series[bisect_left(BUCKETS, seconds)] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted(self.series.items())
+        for label_values, series in items:
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for le, count in zip([*BUCKETS, "+Inf"], series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_count{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]:.6f}")
+        return lines
+
+
+request_seconds = Histogram("tracker_request_seconds", "Request latency by endpoint and phase", ["endpoint", "phase"])
+query_seconds = Histogram("tracker_db_seconds", "Time a db.py function held a db connection", ["function"])
+gauges = {}  # name -> callable returning {label string: value}, for state owned by other modules
+
+
+def add_phase(phase, seconds):
+    if (times := _phase_times.get()) is not None:
+        times[phase] = times.get(phase, 0.0) + seconds
+
+
+def timed(phase):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_phase(phase, perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record_query(function, seconds):
+    query_seconds.observe(seconds, function)
+    add_phase("db", seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        log.warning("slow query in %s: %.1fms", function, seconds * 1000)
+
+
+def _before_request():
+    g.metrics_start = perf_counter()
+    g.metrics_phases = _phase_times.set({})
+    if PROFILING and request.args.get("profile") == "1":
+        g.profiler = Profile()
+        g.profiler.enable()
+
+
+def _after_request(response):
+    if profiler := g.pop("profiler", None):
+        profiler.disable()
+        out = StringIO()
+        Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        response = Response(out.getvalue(), mimetype="text/plain")
+    return response
+
+
+def _teardown_request(_):
+    if (start := g.pop("metrics_start", None)) is None:
+        return
+    total = perf_counter() - start
+    times = _phase_times.get() or {}
+    endpoint = request.endpoint or "unmatched"
+    request_seconds.observe(total, endpoint, "total")
+    for phase in phases:
+        request_seconds.observe(times.get(phase, 0.0), endpoint, phase)
+    request_seconds.observe(max(total - sum(times.values()), 0.0), endpoint, "other")
+    _phase_times.reset(g.pop("metrics_phases"))
+
+
+def _render_started(sender, template, context, **extra):
+    g.setdefault("render_starts", []).append(perf_counter())
+
+
+def _render_done(sender, template, context, **extra):
+    if starts := g.get("render_starts"):
+        add_phase("render", perf_counter() - starts.pop())
+
+
+def exposition():
+    lines = request_seconds.exposition() + query_seconds.exposition()
+    for name, collect in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{{{labels}}} {value}" for labels, value in collect().items())
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_done, app)
+
+    @app.route("/metrics")
+    def metrics():
+        if METRICS_TOKEN and request.args.get("token") != METRICS_TOKEN:
+            return "Forbidden", 403
+        # every gunicorn worker keeps its own metrics, the pid tells the scraped worker apart
+        return Response(exposition(), mimetype="text/plain; version=0.0.4",
+                        headers={"X-Worker-Pid": str(getpid())})
@@ -0,0 +1,137 @@
+from argparse import ArgumentParser
+from contextlib import suppress
+from fcntl import LOCK_EX, flock
+from logging import getLogger
+from os import environ, remove
+from time import perf_counter, sleep
+
+MIGRATION_BATCH = int(environ.get("MIGRATION_BATCH", 5000))  # rows copied per transaction when a table is rewritten
+MIGRATION_PAUSE = 0.005  # seconds between batches, gives the writers of a running app room
+MIGRATION_LOCK = ".migrate.lock"  # suffix of the lock file next to a db file, only there while it is migrated
+
+log = getLogger(__name__)
+
+
+def user_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def is_strict(con, table):
+    row = con.execute("SELECT strict FROM pragma_table_list WHERE schema = 'main' AND name = (?)", (table,)).fetchone()
+    return row is not None and row[0] == 1
+
+
+def _columns(con, table):
+    return [row[1] for row in con.execute(f"PRAGMA table_info({table})")]
+
+
+def _keyed(key, prefix=""):
+    return "(" + ", ".join(prefix + k for k in key) + ")"
+
+
+def rewrite_table(con, table, create, types, key):
+    # copies table into a new one made by create(name) and swaps them, in batches of MIGRATION_BATCH rows, so the
+    # app keeps reading and writing while a large table is rewritten. triggers mirror writes to rows that were already
+    # copied, an interrupted rewrite continues on the next run. types: column -> declared type of the new table
+    new = f"{table}_migrating"
+    columns = [c for c in _columns(con, table) if c in types]
+    values = ", ".join(f"CAST({c} AS {types[c]})" if types[c] in ("INTEGER", "REAL", "TEXT") else c for c in columns)
+    names = ", ".join(columns)
+    where_key = " AND ".join(f"{k} = old.{k}" for k in key)
+    con.execute("BEGIN IMMEDIATE")
+    create(con, new)
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {new}_insert AFTER INSERT ON {table} BEGIN "
+                f"INSERT OR REPLACE INTO {new} ({names}) SELECT {values} FROM (SELECT "
+                + ", ".join(f"new.{c} AS {c}" for c in columns) + "); END")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {new}_update AFTER UPDATE ON {table} BEGIN "
+                f"DELETE FROM {new} WHERE {where_key}; INSERT OR REPLACE INTO {new} ({names}) SELECT {values} FROM "
+                f"(SELECT " + ", ".join(f"new.{c} AS {c}" for c in columns) + "); END")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {new}_delete AFTER DELETE ON {table} BEGIN "
+                f"DELETE FROM {new} WHERE {where_key}; END")
+    con.execute("COMMIT")
+
+    after, copied = None, 0
+    while True:
+        con.execute("BEGIN IMMEDIATE")
+        after_clause = f"WHERE {_keyed(key)} > ({', '.join('?' * len(key))})" if after else ""
+        last = con.execute(f"SELECT {', '.join(key)} FROM {table} {after_clause} ORDER BY {', '.join(key)} "
+                           f"LIMIT 1 OFFSET (?)", (*(after or ()), MIGRATION_BATCH - 1)).fetchone()
+        upto_clause = f"{_keyed(key)} <= ({', '.join('?' * len(key))})" if last else "1"
+        cur = con.execute(f"INSERT OR IGNORE INTO {new} ({names}) SELECT {values} FROM {table} "
+                          f"{after_clause or 'WHERE 1'} AND {upto_clause}", (*(after or ()), *(last or ())))
+        con.execute("COMMIT")
+        copied += max(cur.rowcount, 0)
+        if last is None:
+            break
+        after = last
+        sleep(MIGRATION_PAUSE)
+
+    con.execute("BEGIN IMMEDIATE")
+    for trigger in ("insert", "update", "delete"):
+        con.execute(f"DROP TRIGGER {new}_{trigger}")
+    con.execute(f"DROP TABLE {table}")
+    con.execute(f"ALTER TABLE {new} RENAME TO {table}")
+    con.execute("COMMIT")
+    return copied
+
+
+def migrate(con, db_file, create_schema, migrations, latest):
+    # brings db_file to version latest. a new file gets the latest schema at once, an older one the migrations
+    # [(version, name, apply(con))] above its user_version. con must be in autocommit mode, processes starting at
+    # the same time wait on a lock file until the first one is done
+    if user_version(con) == latest:
+        return []
+    lock_file = db_file + MIGRATION_LOCK
+    with open(lock_file, "w") as lock:
+        flock(lock, LOCK_EX)
+        applied = _migrate_locked(con, db_file, create_schema, migrations, latest)
+        # removed while locked: whoever opens it from now on finds the file at latest, those waiting on it check that.
+        # the first of them already removed it
+        with suppress(FileNotFoundError):
+            remove(lock_file)
+        return applied
+
+
+def _migrate_locked(con, db_file, create_schema, migrations, latest):
+    version = user_version(con)
+    if version == latest:
+        return []
+    if not con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+        con.execute("BEGIN IMMEDIATE")
+        create_schema(con.cursor())
+        con.execute(f"PRAGMA user_version = {latest}")
+        con.execute("COMMIT")
+        return []
+    applied = []
+    con.execute("PRAGMA foreign_keys = OFF")  # rows are moved between tables, the data itself does not change
+    try:
+        for number, name, apply in migrations:
+            if number <= version:
+                continue
+            start = perf_counter()
+            apply(con)
+            con.execute(f"PRAGMA user_version = {number}")
+            applied.append((number, name, perf_counter() - start))
+            log.info("migrated %s to version %d (%s) in %.2fs", db_file, number, name, applied[-1][2])
+    finally:
+        con.execute("PRAGMA foreign_keys = ON")
+    return applied
+
+
+def main():
+    parser = ArgumentParser(description="schema versions of the db files, migrate them before starting a new version "
+                                        "of the app or let the first worker do it")
+    parser.add_argument("command", choices=["status", "migrate"])
+    args = parser.parse_args()
+    import db
+    for db_file in [db.DB, *db.shard_files()]:
+        if args.command == "migrate":
+            applied = db.migrate_file(db_file)
+            print(db_file, ", ".join(f"{number} {name} {seconds:.2f}s" for number, name, seconds in applied) or
+                  "up to date")
+        else:
+            print(db_file, "version", db.schema_version(db_file), "of", db.SCHEMA_VERSION)
+
+
+if __name__ == "__main__":
+    main()
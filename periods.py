@@ -0,0 +1,72 @@
+import json
+from datetime import date as Date, datetime, time as Time, timedelta
+from os import environ
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+TIMEZONE = environ.get("TIMEZONE", "UTC")  # calendar periods of pages that do not ask for a timezone
+MAX_PERIODS = 5000  # per query, about 13 years of days
+period_kinds = ["day", "week", "month", "year"]
+
+
+def timezone(name=None):
+    # ValueError for unknown names, like every other bad query argument
+    try:
+        return ZoneInfo(name or TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone '{name}'")
+
+
+def _period_start(day, period):
+    if period == "day":
+        return day
+    if period == "week":  # iso weeks start on monday
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+
+def _next_period(day, period):
+    if period == "day":
+        return day + timedelta(days=1)
+    if period == "week":
+        return day + timedelta(days=7)
+    if period == "month":
+        return Date(day.year + day.month // 12, day.month % 12 + 1, 1)
+    return Date(day.year + 1, 1, 1)
+
+
+def period_bounds(period, tz, start, end):
+    # [(first day, start epoch, end epoch)] of the calendar periods in tz that overlap [start, end).
+    # local midnights are converted one by one, so periods spanning a dst change are an hour shorter or longer
+    if period not in period_kinds:
+        raise ValueError(f"period must be one of {', '.join(period_kinds)}")
+    try:
+        day = _period_start(datetime.fromtimestamp(start, tz).date(), period)
+        bounds, lower = [], int(datetime.combine(day, Time(), tz).timestamp())
+        while lower < end:
+            if len(bounds) == MAX_PERIODS:
+                raise ValueError(f"more than {MAX_PERIODS} periods, choose a longer period or a shorter range")
+            next_day = _next_period(day, period)
+            upper = int(datetime.combine(next_day, Time(), tz).timestamp())
+            bounds.append((day, lower, upper))
+            day, lower = next_day, upper
+    except (OverflowError, OSError):  # beyond the dates datetime and the platform can convert
+        raise ValueError("from and to must be dates between the years 1 and 9999")
+    return bounds
+
+
+def bounds_json(bounds):
+    # [[start, end], ...] for json_each in the period queries of db.py
+    return json.dumps([[lower, upper] for _, lower, upper in bounds])
+
+
+def period_label(day, period):
+    if period == "day":
+        return day.isoformat()
+    if period == "week":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == "month":
+        return day.strftime("%Y-%m")
+    return str(day.year)
@@ -0,0 +1,75 @@
+from argparse import ArgumentParser
+from collections import Counter
+from os import path
+from sqlite3 import connect
+
+import db
+
+# every table keyed by username, copied in this order so foreign keys hold
+user_tables = ["data_version", "stats", "stats_summary", "stats_rollup", "routes", "activities", "route_summary",
+               "route_geometry"]
+
+
+def migrate(purge=False):
+    # copies every user of the single file DB into its shard, run it with the app stopped.
+    # rows already in a shard are kept, so an interrupted migration can simply be run again
+    if not db.SHARDS:
+        raise RuntimeError("set DB_SHARDS to the layout to migrate to")
+    source = connect(db.DB, isolation_level=None)
+    try:
+        source.execute("PRAGMA foreign_keys = ON")
+        usernames = [row[0] for row in source.execute("SELECT username FROM user ORDER BY username")]
+        copied = Counter()
+        for username in usernames:
+            with db.db_connection(username, name="migrate"):  # creates the shard and its tables
+                pass
+            source.execute("ATTACH DATABASE (?) AS shard", (db.shard_file(username),))
+            try:
+                source.execute("BEGIN")
+                source.execute("INSERT OR IGNORE INTO shard.user (username) VALUES (?)", (username,))
+                for table in user_tables:
+                    cur = source.execute(f"INSERT OR IGNORE INTO shard.{table} SELECT * FROM main.{table} "
+                                         f"WHERE username = (?)", (username,))
+                    copied[table] += cur.rowcount
+                source.execute("INSERT OR IGNORE INTO shard.route_bbox SELECT b.* FROM main.route_bbox b "
+                               "JOIN main.route_geometry g ON g.id = b.id WHERE g.username = (?)", (username,))
+                source.execute("COMMIT")
+            except BaseException:
+                source.execute("ROLLBACK")
+                raise
+            finally:
+                source.execute("DETACH DATABASE shard")
+        if purge:  # the data now lives in the shards, DB keeps the credentials
+            source.execute("BEGIN")
+            for table in reversed(user_tables):
+                source.execute(f"DELETE FROM {table}")
+            source.execute("COMMIT")
+            source.execute("VACUUM")
+    finally:
+        source.close()
+    db.db_close()
+    return len(usernames), copied
+
+
+def status():
+    files = db.shard_files()
+    return {"layout": db.SHARDS or "single file", "db": db.DB, "shard_dir": db.shard_dir(), "shards": len(files),
+            "shard_bytes": sum(path.getsize(f) for f in files)}
+
+
+def main():
+    parser = ArgumentParser(description="move users from the single db file into shards (set DB_SHARDS first)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate").add_argument("--purge", action="store_true",
+                                                help="delete the migrated rows from the single db file")
+    commands.add_parser("status")
+    args = parser.parse_args()
+    if args.command == "migrate":
+        users, copied = migrate(args.purge)
+        print(f"migrated {users} users:", ", ".join(f"{n} {table}" for table, n in copied.items()))
+    else:
+        print(status())
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-gunicorn -b "0.0.0.0:9900" -w 1 app:app
+gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,37 @@
+// live updates of an open page, see /events in app.py. versions: collection -> data version the page shows,
+// handlers: collection -> function(update) applying the new rows. a page that cannot apply an update reloads
+function liveUpdates(versions, handlers) {
+    let delay = 1000;
+    function connect() {
+        const source = new EventSource("/events?" + new URLSearchParams(versions));
+        source.onopen = () => { delay = 1000; };
+        for (const collection of Object.keys(versions)) {
+            source.addEventListener(collection, (event) => {
+                const update = JSON.parse(event.data);
+                if (update.version <= versions[collection]) {
+                    return;
+                }
+                versions[collection] = update.version;
+                if (update.reload || handlers[collection](update) === false) {
+                    source.close();
+                    location.reload();
+                }
+            });
+        }
+        // reconnect with the versions shown now, the server sends what was missed in between. a worker with all its
+        // live streams taken answers 204, the page then keeps polling at growing intervals until one is free
+        source.onerror = () => {
+            source.close();
+            setTimeout(connect, delay);
+            delay = Math.min(delay * 2, 30000);
+        };
+    }
+    connect();
+}
+
+function appendRow(table, cells) {
+    const row = table.insertRow();
+    for (const cell of cells) {
+        row.insertCell().textContent = cell;
+    }
+}
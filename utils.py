@@ -1,12 +1,19 @@
 from datetime import datetime
+from math import isfinite
 from time import time
 
 from db import check_save_query_input, get_route_details
+from metrics import timed
+from periods import period_label
 
+auth_user = "user"  # session key of the logged in username
 margin_per_category = {"weight": 5, "body_fat": 2, "water": 5, "muscles": 5}
 stats_headers = ["Date", "Weight", "% Fat", "% H2O", "% Msl"]
 routes_headers = ["Name", "Distance [km]", "Height [m]"]
 activities_headers = ["Name", "Date", "Time", "Pace", "Speed", "Heart Rate"]
+stats_periods_headers = ["Period", "Entries", "Weight", "% Fat", "% H2O", "% Msl"]
+activities_periods_headers = ["Period", "Activities", "Distance", "Time", "Height", "Heart Rate"]
+_date_labels = {}  # local day ordinal -> label, a few hundred per year of history
 
 
 def check_stats_submission(request):
@@ -14,12 +21,18 @@ def check_stats_submission(request):
     body_fat = request.form.get("body_fat")
     water = request.form.get("water")
     muscles = request.form.get("muscles")
+    return check_stats_values(weight, body_fat, water, muscles)
+
+
+def check_stats_values(weight, body_fat, water, muscles):
     if not all(e for e in [weight, body_fat, water, muscles]):
         return False, "Values cannot be Null"
     try:
-        _ = float(weight), float(body_fat), float(water), float(muscles)
-    except ValueError:
+        values = float(weight), float(body_fat), float(water), float(muscles)
+    except (TypeError, ValueError):
         return False, "Values must be Numbers"
+    if not all(map(isfinite, values)):  # nan is stored as null, inf breaks the summaries
+        return False, "Values must be finite Numbers"
     return True, ""
 
 
@@ -35,18 +48,26 @@ def parse_stats_submission(request):
 
 def check_routes_submission(request):
     route_name = request.form.get("route_name")
+    distance = request.form.get("distance")
+    height = request.form.get("height")
+    return check_route_values(route_name, distance, height)
+
+
+def check_route_values(route_name, distance, height):
     if not route_name:
         return False, "Route Name cannot be Empty"
     if not check_save_query_input(route_name):
         return False, "Route Name can only contain Letters, Numbers and '-_'."
-    distance = request.form.get("distance")
-    height = request.form.get("height")
     if not all(e for e in [distance, height]):
         return False, "Values cannot be Null"
     try:
-        _ = float(distance), float(height)
-    except ValueError:
+        values = float(distance), float(height)
+    except (TypeError, ValueError):
         return False, "Values must be Numbers"
+    if not all(map(isfinite, values)):
+        return False, "Values must be finite Numbers"
+    if int(values[0]) + 10 * int(values[1]) <= 0:  # stored as integers, activities are divided by it
+        return False, "Distance must be positive"
     return True, ""
 
 
@@ -60,18 +81,29 @@ def parse_route_submission(request):
 
 def check_activity_submission(request):
     route_name = request.form.get("route_name")
-    if not check_save_query_input(route_name):
-        return False, "Name can only contain Letters, Numbers and '-_'."
     time_min = request.form.get("time_min")
     time_sec = request.form.get("time_sec")
     heart_rate = request.form.get("heart_rate")
+    return check_activity_values(route_name, time_min, time_sec, heart_rate)
+
+
+def check_activity_values(route_name, time_min, time_sec, heart_rate):
+    if not route_name:
+        return False, "Route Name cannot be Empty"
+    try:
+        if not check_save_query_input(route_name):
+            return False, "Name can only contain Letters, Numbers and '-_'."
+    except TypeError:
+        return False, "Route Name must be Text"
     if not time_min:
         return False, "Time [min] cannot be Null"
+    if not heart_rate:
+        return False, "Heart Rate cannot be Null"
     try:
         _ = int(time_min), int(heart_rate)
         if time_sec is not None:
             _ = int(time_sec)
-    except ValueError:
+    except (TypeError, ValueError):
         return False, "Time and Heart Rate must be Numbers"
     return True, ""
 
@@ -85,30 +117,33 @@ def parse_activity_submission(request, username):
     if time_sec is None:
         time_sec = 0
     distance, height = get_route_details(username, route_name)
+    total_time_sec, pace, speed = activity_metrics(time_min, time_sec, distance, height)
+    return date, route_name, total_time_sec, pace, speed, heart_rate
 
+
+def activity_metrics(time_min, time_sec, distance, height):
     total_time_sec = 60 * time_min + time_sec
     total_time_min = time_min + time_sec / 60
     total_time_h = time_min / 60 + time_sec / 3600
     total_distance_km = (distance + 10 * height) / 1000
     pace = round(total_time_min / total_distance_km, 3)  # min/km
     speed = round(total_distance_km / total_time_h, 3)  # km/h
-    return date, route_name, total_time_sec, pace, speed, heart_rate
+    return total_time_sec, pace, speed
 
 
 def parse_date(epoch_time):
-    return datetime.fromtimestamp(epoch_time).strftime('%d-%m-%Y')
+    # strftime is the most expensive part of formatting a row and the same days are formatted on every request
+    day = datetime.fromtimestamp(epoch_time)
+    key = day.toordinal()
+    return _date_labels.get(key) or _date_labels.setdefault(key, day.strftime('%d-%m-%Y'))
 
 
+@timed("format")
 def parse_stats_for_category(stats, round_to):
-    datapoints = []
-    date_labels = []
-    for row in stats:
-        _date, _data_point = row
-        date = parse_date(_date)
-        datapoint = round(_data_point, round_to)
-        datapoints.append(datapoint)
-        date_labels.append(date)
-    return datapoints, date_labels
+    if not stats:
+        return [], []
+    dates, data_points = zip(*stats)
+    return [round(d, round_to) for d in data_points], list(map(parse_date, dates))
 
 
 def get_y_boarder(datapoints, margin):
@@ -118,19 +153,24 @@ def get_y_boarder(datapoints, margin):
     return start_y, end_y
 
 
+@timed("format")
 def beautify_stats(stats) -> [[str]]:
-    beautified_stats = []
-    for row in stats:
-        _date, _weight, _body_fat, _water, _muscles = row
-        date = parse_date(_date)
-        weight = "%.1f" % round(_weight, 1) + " kg"
-        body_fat = "%.1f" % round(_body_fat, 1) + " %"
-        water = "%.1f" % round(_water, 1) + " %"
-        muscles = "%.1f" % round(_muscles, 1) + " %"
-        beautified_stats.append((date, weight, body_fat, water, muscles))
-    return beautified_stats
+    # formats column by column, "%.1f" rounds exactly like round(x, 1) did
+    if not stats:
+        return []
+    dates, weights, body_fats, waters, muscles = zip(*stats)
+    percent = "%.1f %%".__mod__
+    return list(zip(map(parse_date, dates), map("%.1f kg".__mod__, weights), map(percent, body_fats),
+                    map(percent, waters), map(percent, muscles)))
+
+
+def beautify_page(beautify, page, date_index):
+    # also the date of the last row, live updates append rows after it
+    rows, next_after = page
+    return beautify(rows), next_after, rows[-1][date_index] if rows else None
 
 
+@timed("format")
 def beautify_routes(routes) -> [[str]]:
     beautified_routes = []
     for row in routes:
@@ -141,15 +181,66 @@ def beautify_routes(routes) -> [[str]]:
     return beautified_routes
 
 
+@timed("format")
 def beautify_activities(activities) -> [[str]]:
-    beautified_activities = []
-    for row in activities:
-        route_name, _date, _time, _pace, _speed, _heart_rate = row
-        date = parse_date(_date)
-        _time_min, _time_sec = divmod(_time, 60)
-        t = f"{_time_min:02}:{_time_sec:02}"  # pad 5:9 to 05:09
-        pace = f"{_pace} min/km"
-        speed = "%.1f" % round(_speed, 1) + " km/h"
-        heart_rate = f"{_heart_rate} bpm"
-        beautified_activities.append((route_name, date, t, pace, speed, heart_rate))
-    return beautified_activities
+    if not activities:
+        return []
+    route_names, dates, times, paces, speeds, heart_rates = zip(*activities)
+    return list(zip(route_names, map(parse_date, dates), map(format_seconds, times),  # pad 5:9 to 05:09
+                    map("{} min/km".format, paces), map("%.1f km/h".__mod__, speeds),
+                    map("{} bpm".format, heart_rates)))
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes:02}:{seconds:02}"
+
+
+def format_hours(seconds):
+    minutes = round(seconds / 60)
+    return f"{minutes // 60}:{minutes % 60:02} h"
+
+
+def _average(unit, value):
+    # periods without entries have no average
+    return "-" if value is None else unit % value
+
+
+@timed("format")
+def beautify_stats_periods(rows, period) -> [[str]]:
+    return [(period_label(day, period), n, _average("%.1f kg", weight), _average("%.1f %%", fat),
+             _average("%.1f %%", water), _average("%.1f %%", muscles))
+            for day, _, n, weight, fat, water, muscles in rows]
+
+
+@timed("format")
+def beautify_activities_periods(rows, period) -> [[str]]:
+    return [(period_label(day, period), n, "%.1f km" % (distance / 1000), format_hours(time), f"{height} m",
+             "-" if heart_rate is None else f"{round(heart_rate)} bpm")
+            for day, _, n, distance, time, height, heart_rate in rows]
+
+
+@timed("format")
+def beautify_route_report(report) -> [[str]]:
+    if not report:
+        return []
+    p = report["pace_percentiles"]
+    none = "-"
+    rows = [
+        ("Activities", report["activities"]),
+        ("Best Time", f"{format_seconds(report['best_time'])} ({parse_date(report['best_time_date'])})"),
+        ("Best Pace", f"{report['best_pace']} min/km"),
+        ("Best Speed", "%.1f km/h" % report["best_speed"]),
+        ("Average Time", format_seconds(report["average_time"])),
+        ("Average Speed", "%.1f km/h" % report["average_speed"]),
+        ("Pace p10 / p50 / p90", " / ".join(none if v is None else f"{v}" for v in p.values()) + " min/km"),
+        (f"Best Pace last {report['rolling_weeks']} Weeks",
+         none if report["rolling_best_pace"] is None else f"{report['rolling_best_pace']} min/km"),
+        (f"Best Time last {report['rolling_weeks']} Weeks",
+         none if report["rolling_best_time"] is None else format_seconds(report["rolling_best_time"])),
+        ("Efficiency (avg / best)", none if report["average_efficiency"] is None else
+         f"{report['average_efficiency'] * 1000:.1f} / {report['best_efficiency'] * 1000:.1f} m/h per bpm"),
+        ("Pace Trend", none if report["pace_trend_per_week"] is None else
+         "%+.3f min/km per week" % report["pace_trend_per_week"]),
+    ]
+    return [(label, str(value)) for label, value in rows]
@@ -0,0 +1,99 @@
+from atexit import register
+from concurrent.futures import Future
+from logging import getLogger
+from os import getpid
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread, get_ident
+from time import monotonic
+
+log = getLogger(__name__)
+_FLUSH = object()  # queued to end the wait for more writes
+
+
+class WriteBehind:
+    # queues writes and applies them in group commits on a background thread, see db.py
+    def __init__(self, apply, max_queue, max_latency, max_batch):
+        self.apply = apply  # [(key, write)] -> one result or exception per write
+        self.max_queue = max_queue
+        self.max_latency = max_latency  # seconds the first write of a batch waits for more
+        self.max_batch = max_batch
+        self.pending = {}  # key -> writes queued but not committed
+        self.committed = Condition()
+        self.lock = Lock()
+        self.queue = self.thread = self.pid = None
+        register(self.close)  # gunicorn workers and the dev server run atexit handlers on a graceful stop
+
+    def _start(self):
+        with self.lock:
+            if self.pid != getpid():  # first write of this (possibly forked) process
+                self.queue, self.pid = Queue(self.max_queue), getpid()
+                self.thread = Thread(target=self._run, daemon=True, name="write-behind")
+                self.thread.start()
+
+    def submit(self, key, write, urgent=False):
+        # returns a future of the write's result, blocks while the queue is full.
+        # urgent writes have someone waiting for them and are committed without lingering for more
+        self._start()
+        future = Future()
+        with self.committed:
+            self.pending[key] = self.pending.get(key, 0) + 1
+        self.queue.put((key, write, future, urgent))
+        return future
+
+    def wait(self, key):
+        # read-your-writes: returns once every write queued for key is committed
+        if not self.pending.get(key) or self.thread is None or get_ident() == self.thread.ident:
+            return
+        self.queue.put(_FLUSH)
+        with self.committed:
+            self.committed.wait_for(lambda: not self.pending.get(key))
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, flush = [], False
+            item = self.queue.get()
+            deadline = monotonic() + self.max_latency
+            while True:
+                if item is None:
+                    stop = flush = True
+                elif item is _FLUSH:
+                    flush = True
+                else:
+                    batch.append(item)
+                    flush = flush or item[3]
+                if len(batch) >= self.max_batch:
+                    break
+                try:  # a flush still takes what is queued already, the commit costs the same
+                    item = self.queue.get_nowait() if flush else self.queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.apply([(key, write) for key, write, _, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (key, write, future, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                log.error("queued write of %s failed: %r", key, result)
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        with self.committed:
+            for key, *_ in batch:
+                self.pending[key] -= 1
+                if not self.pending[key]:
+                    del self.pending[key]
+            self.committed.notify_all()
+
+    def close(self):
+        # commits everything still queued, later writes start a new thread
+        with self.lock:
+            if self.pid != getpid() or not self.thread.is_alive():
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.pid = None